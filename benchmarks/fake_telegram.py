@@ -0,0 +1,291 @@
+"""Local stand-in for the parts of telegram that file transfers talk to.
+
+:class:`FakeFileServer` answers ``GetFileRequest`` for synthetic documents
+with configurable latency, jitter, bandwidth, errors and flood waits, and can
+redirect them to a :class:`FakeCdnServer`. :class:`FakeClient` plus
+:class:`FakeSenderPool` let the real ``ParallelTransferrer`` run against them
+without a network.
+"""
+
+import asyncio
+import hashlib
+import os
+import random
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from telethon import errors
+from telethon.tl.functions.help import GetCdnConfigRequest
+from telethon.tl.functions.upload import (
+    GetCdnFileHashesRequest,
+    GetCdnFileRequest,
+    GetFileHashesRequest,
+    GetFileRequest,
+    ReuploadCdnFileRequest,
+)
+from telethon.tl.types import (
+    CdnConfig,
+    Document,
+    FileHash,
+    Message,
+    MessageMediaDocument,
+    PeerChannel,
+)
+from telethon.tl.types.upload import CdnFile, CdnFileReuploadNeeded, FileCdnRedirect
+
+from src.FastTelethon import SenderPool, _decrypt_cdn_part
+
+# Files repeat one random block, every part size divides it
+BLOCK_SIZE = 1024 * 1024
+# Telegram hashes files in ranges of this size and returns this many per request
+HASH_RANGE_SIZE = 128 * 1024
+HASHES_PER_REQUEST = 8
+
+
+class FakeFileServer:
+    """Serves every document as the same repeating random block.
+
+    ``bandwidth`` (bytes per second, 0 for unlimited) is shared by all
+    connections like a single link, responses queue for it after waiting
+    ``latency`` plus up to ``jitter`` seconds. ``error_rate`` and
+    ``flood_wait_rate`` are the chances of a request failing with a dropped
+    connection or a flood wait of ``flood_wait_seconds``. ``corrupt_rate`` is
+    the chance of a part arriving with a flipped byte, which only the file
+    hashes reveal. With a ``cdn``, requests that allow it are redirected there.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.01,
+        bandwidth: float = 0,
+        error_rate: float = 0.0,
+        flood_wait_rate: float = 0.0,
+        flood_wait_seconds: int = 1,
+        corrupt_rate: float = 0.0,
+        cdn: Optional["FakeCdnServer"] = None,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.flood_wait_rate = flood_wait_rate
+        self.flood_wait_seconds = flood_wait_seconds
+        self.corrupt_rate = corrupt_rate
+        self.cdn = cdn
+        self.random = random.Random(seed)
+        self.block = self.random.randbytes(BLOCK_SIZE)
+        if cdn:
+            # It serves the same documents
+            cdn.block = self.block
+        self.link_free_at = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.flood_waits = 0
+        self.corrupted = 0
+        self.hash_requests = 0
+        self.redirects = 0
+        self.reuploads = 0
+        self.connections = 0
+
+    def expected_bytes(self, offset: int, limit: int, size: int) -> bytes:
+        end = min(offset + limit, size)
+        chunks = []
+        while offset < end:
+            start = offset % BLOCK_SIZE
+            length = min(BLOCK_SIZE - start, end - offset)
+            chunks.append(self.block[start : start + length])
+            offset += length
+        return b"".join(chunks)
+
+    async def handle(self, sender: "FakeSender", request):
+        await self.answer_delay(sender, request)
+        if isinstance(request, GetFileHashesRequest):
+            self.hash_requests += 1
+            return self.file_hashes(request.offset, sender.sizes[request.location.id])
+        if isinstance(request, GetCdnFileHashesRequest):
+            self.hash_requests += 1
+            size = sender.sizes[token_document_id(request.file_token)]
+            return self.file_hashes(request.offset, size)
+        if isinstance(request, ReuploadCdnFileRequest):
+            self.reuploads += 1
+            self.cdn.cached[request.file_token] = True
+            size = sender.sizes[token_document_id(request.file_token)]
+            return self.file_hashes(0, size)
+        if not isinstance(request, GetFileRequest):
+            return SimpleNamespace()
+
+        size = sender.sizes[request.location.id]
+        if self.cdn and request.cdn_supported:
+            self.redirects += 1
+            return FileCdnRedirect(
+                self.cdn.dc_id,
+                request.location.id.to_bytes(8, "big"),
+                self.cdn.key,
+                self.cdn.iv,
+                self.file_hashes(0, size),
+            )
+        return SimpleNamespace(
+            bytes=await self.read(request.offset, request.limit, size)
+        )
+
+    async def answer_delay(self, sender: "FakeSender", request):
+        """Wait out the latency, failing the request at the configured rates"""
+        self.requests += 1
+        await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+        roll = self.random.random()
+        if roll < self.error_rate:
+            self.errors += 1
+            sender.connected = False
+            raise ConnectionError("Connection reset by fake server")
+        if roll < self.error_rate + self.flood_wait_rate:
+            self.flood_waits += 1
+            raise errors.FloodWaitError(request, capture=self.flood_wait_seconds)
+
+    async def read(self, offset: int, limit: int, size: int) -> bytes:
+        data = self.expected_bytes(offset, limit, size)
+        if self.bandwidth:
+            now = time.monotonic()
+            self.link_free_at = max(now, self.link_free_at) + len(data) / self.bandwidth
+            await asyncio.sleep(self.link_free_at - now)
+        if data and self.random.random() < self.corrupt_rate:
+            self.corrupted += 1
+            position = self.random.randrange(len(data))
+            data = (
+                data[:position] + bytes([data[position] ^ 0xFF]) + data[position + 1 :]
+            )
+        return data
+
+    def file_hashes(self, offset: int, size: int) -> List[FileHash]:
+        start = offset - offset % HASH_RANGE_SIZE
+        hashes = []
+        for range_offset in range(
+            start,
+            min(size, start + HASH_RANGE_SIZE * HASHES_PER_REQUEST),
+            HASH_RANGE_SIZE,
+        ):
+            data = self.expected_bytes(range_offset, HASH_RANGE_SIZE, size)
+            hashes.append(
+                FileHash(range_offset, HASH_RANGE_SIZE, hashlib.sha256(data).digest())
+            )
+        return hashes
+
+
+def token_document_id(file_token: bytes) -> int:
+    return int.from_bytes(file_token, "big")
+
+
+class FakeCdnServer(FakeFileServer):
+    """A CDN DC that sends the documents of a :class:`FakeFileServer` encrypted.
+
+    ``reupload_rate`` of the files are only served after the server they
+    belong to was asked to reupload them.
+    """
+
+    def __init__(self, dc_id: int = 203, reupload_rate: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.dc_id = dc_id
+        self.reupload_rate = reupload_rate
+        self.key = self.random.randbytes(32)
+        self.iv = self.random.randbytes(16)
+        # Whether the CDN has a file, by file token
+        self.cached: Dict[bytes, bool] = {}
+        self.reupload_requests = 0
+
+    async def handle(self, sender: "FakeSender", request):
+        if not isinstance(request, GetCdnFileRequest):
+            return await super().handle(sender, request)
+        await self.answer_delay(sender, request)
+        token = request.file_token
+        if token not in self.cached:
+            self.cached[token] = self.random.random() >= self.reupload_rate
+        if not self.cached[token]:
+            self.reupload_requests += 1
+            return CdnFileReuploadNeeded(request_token=self.random.randbytes(8))
+        data = await self.read(
+            request.offset, request.limit, sender.sizes[token_document_id(token)]
+        )
+        # AES-CTR encrypts and decrypts alike
+        return CdnFile(_decrypt_cdn_part(self.key, self.iv, request.offset, data))
+
+
+class FakeSender:
+    """Takes the place of ``MTProtoSender`` for one connection"""
+
+    def __init__(self, server: FakeFileServer, sizes: dict):
+        self.server = server
+        self.sizes = sizes
+        self.connected = True
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    async def send(self, request):
+        if not self.connected:
+            raise ConnectionError("Cannot send requests while disconnected")
+        return await self.server.handle(self, request)
+
+    async def disconnect(self):
+        self.connected = False
+
+
+class FakeClient:
+    """Just enough of ``TelegramClient`` for ``ParallelTransferrer``"""
+
+    def __init__(self, server: FakeFileServer, dc_id: int = 2):
+        self.server = server
+        self.session = SimpleNamespace(dc_id=dc_id, auth_key=os.urandom(8))
+        self.loop = asyncio.get_running_loop()
+        # Document sizes by id, the server needs them to end files correctly
+        self.sizes = {}
+
+    def document(self, size: int, document_id: int = 1) -> Document:
+        self.sizes[document_id] = size
+        return Document(
+            id=document_id,
+            access_hash=0,
+            file_reference=b"",
+            date=None,
+            mime_type="application/octet-stream",
+            size=size,
+            dc_id=self.session.dc_id,
+            attributes=[],
+        )
+
+    def message(self, size: int, message_id: int = 1) -> Message:
+        """A channel message with a document of ``size`` bytes and the same id"""
+        return Message(
+            id=message_id,
+            peer_id=PeerChannel(1),
+            date=None,
+            message="",
+            media=MessageMediaDocument(document=self.document(size, message_id)),
+        )
+
+    async def get_messages(self, entity, ids: int) -> Optional[Message]:
+        """The message of a document this account knows, like a channel member"""
+        if ids not in self.sizes:
+            return None
+        return self.message(self.sizes[ids], ids)
+
+    async def _call(self, sender: FakeSender, request, ordered=False):
+        return await sender.send(request)
+
+    async def __call__(self, request):
+        if isinstance(request, GetCdnConfigRequest):
+            return CdnConfig(public_keys=[])
+        raise NotImplementedError(f"{type(request).__name__} isn't faked")
+
+
+class FakeSenderPool(SenderPool):
+    """Connects :class:`FakeSender` objects, a handshake costs three round trips"""
+
+    async def _connect(self, dc_id: int) -> FakeSender:
+        server = self.client.server
+        if dc_id in self._cdn_dcs:
+            server = server.cdn
+        server.connections += 1
+        await asyncio.sleep(server.latency * 3)
+        return FakeSender(server, self.client.sizes)
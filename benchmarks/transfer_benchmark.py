@@ -0,0 +1,573 @@
+"""Benchmark ``download_file`` against the fake file server.
+
+Runs every combination of file size and connection count and writes the
+results as JSON, so runs of different versions can be compared::
+
+    python -m benchmarks.transfer_benchmark --output before.json
+    python -m benchmarks.transfer_benchmark --compare before.json
+
+``--accounts`` downloads ``--files`` files at once spread over that many fake
+accounts, each with its own server, through the download manager to check
+how downloads are sharded and fail over.
+``--cdn`` redirects every file to a fake CDN with its own latency and
+bandwidth. ``--concurrent`` downloads several files at once, with
+``--disk-bandwidth`` through a slow disk, and ``--buffer-pool`` caps the
+memory their parts may hold.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from benchmarks.fake_telegram import (
+    FakeCdnServer,
+    FakeClient,
+    FakeFileServer,
+    FakeSenderPool,
+)
+from src.account_pool import AccountPool, AccountShard
+from src.buffer_pool import BufferPool, current_rss, peak_rss
+from src.download_checkpoint import DownloadCheckpoint
+from src.FastTelethon import ConnectionBudget, download_file
+from src.transfer_retry import RateLimiter, RetryPolicy
+
+RESULTS_VERSION = 1
+MB = 1024 * 1024
+
+
+class VerifyingSink:
+    """File-like target that checks every byte instead of keeping it"""
+
+    def __init__(self, server: FakeFileServer, size: int):
+        self.server = server
+        self.size = size
+        self.position = 0
+
+    def write(self, data: bytes) -> int:
+        expected = self.server.expected_bytes(self.position, len(data), self.size)
+        if data != expected:
+            raise ValueError(f"Wrong data at offset {self.position}")
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+
+class MemorySampler:
+    """Samples the resident set size in a thread to find the peak of one run"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current_rss() -> int:
+        # Without procfs, the peak of the whole process is the best we have
+        return current_rss() or peak_rss()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current_rss())
+
+
+class SlowDiskExecutor(ThreadPoolExecutor):
+    """Writer threads sharing one disk that writes ``bandwidth`` bytes per second"""
+
+    def __init__(self, bandwidth: float, max_workers: int = 4):
+        super().__init__(max_workers, thread_name_prefix="slow-disk")
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args, **kwargs):
+        size = sum(len(arg) for arg in args if isinstance(arg, (bytes, memoryview)))
+        if not size:
+            return super().submit(function, *args, **kwargs)
+
+        def throttled():
+            with self.lock:
+                time.sleep(size / self.bandwidth)
+            return function(*args, **kwargs)
+
+        return super().submit(throttled)
+
+
+async def run_once(
+    server: FakeFileServer,
+    size: int,
+    connections: int,
+    window: int,
+    directory: Optional[str],
+    rate_limit: float,
+    verify: bool = False,
+    concurrent: int = 1,
+    buffer_pool: float = 0,
+    disk_bandwidth: float = 0,
+) -> Dict[str, float]:
+    client = FakeClient(server)
+    pool = FakeSenderPool(
+        client, max_connections=connections * concurrent, idle_timeout=0
+    )
+    documents = [client.document(size, index + 1) for index in range(concurrent)]
+    buffers = BufferPool(int(buffer_pool * MB)) if buffer_pool else None
+    executor = SlowDiskExecutor(disk_bandwidth * MB) if disk_bandwidth else None
+    requests, errors, flood_waits = server.requests, server.errors, server.flood_waits
+    corrupted, redirects = server.corrupted, server.redirects
+    first_byte: Optional[float] = None
+
+    def progress_callback(downloaded, total):
+        nonlocal first_byte
+        if first_byte is None:
+            first_byte = time.perf_counter()
+
+    options = dict(
+        progress_callback=progress_callback,
+        connection_count=connections,
+        pool=pool,
+        window=window,
+        rate_limiter=RateLimiter(rate_limit),
+        retry_policy=RetryPolicy(base_delay=0.05),
+        verify=verify,
+        use_cdn=server.cdn is not None,
+        executor=executor,
+        buffers=buffers,
+    )
+
+    async def download(document):
+        if directory:
+            path = os.path.join(directory, f"benchmark{document.id}.bin")
+            checkpoint = DownloadCheckpoint.load(path, document.id, size)
+            with checkpoint.open() as file:
+                await download_file(
+                    client, document, file, checkpoint=checkpoint, **options
+                )
+            checkpoint.complete()
+            os.remove(path)
+        else:
+            sink = VerifyingSink(server, size)
+            await download_file(client, document, sink, **options)
+            if sink.position != size:
+                raise ValueError(f"Got {sink.position} of {size} bytes")
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    with MemorySampler() as memory:
+        await asyncio.gather(*[download(document) for document in documents])
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    await pool.close()
+    if executor:
+        executor.shutdown()
+    return {
+        "seconds": elapsed,
+        "mb_per_s": size * concurrent / MB / elapsed,
+        "ttfb_ms": ((first_byte or time.perf_counter()) - started) * 1000,
+        "peak_rss_mb": memory.peak / MB,
+        "peak_buffer_mb": buffers.peak / MB if buffers else 0,
+        "buffer_waits": buffers.waits if buffers else 0,
+        "cpu_s_per_gb": cpu / (size * concurrent / 1024**3),
+        "requests": server.requests - requests,
+        "errors": server.errors - errors,
+        "flood_waits": server.flood_waits - flood_waits,
+        "corrupted_parts": server.corrupted - corrupted,
+        "cdn_redirects": server.redirects - redirects,
+        "connections_opened": pool.created,
+    }
+
+
+async def run_accounts(
+    args: argparse.Namespace, size: int, connections: int
+) -> Dict[str, object]:
+    """Download ``args.files`` files over ``args.accounts`` fake accounts at once.
+
+    The files go through ``DownloadManager.download_with_retry``, so account
+    choice and failover on flood waits are the ones of a real run.
+    """
+    # The settings need an account to load, any values do for fake ones
+    for name, value in (
+        ("API_ID", "1"),
+        ("API_HASH", "benchmark"),
+        ("PHONE_NUMBER", "0"),
+        ("CHANNEL_USERNAME", "benchmark"),
+    ):
+        os.environ.setdefault(name, value)
+    from src.config import settings
+    from src.download_manager import DownloadManager, DownloadResources
+    from src.progress import NullProgress
+
+    shards = []
+    for index in range(args.accounts):
+        client = FakeClient(create_server(args, args.seed + index))
+        if shards:
+            # Every account sees the same files
+            client.server.block = shards[0].client.server.block
+            if client.server.cdn:
+                client.server.cdn.block = client.server.block
+        pool = FakeSenderPool(client, max_connections=connections, idle_timeout=0)
+        shards.append(
+            AccountShard(
+                f"account{index}",
+                client,
+                pool,
+                ConnectionBudget(connections),
+                RateLimiter(args.rate_limit),
+                primary=index == 0,
+            )
+        )
+    failovers_before = {shard.name: shard.failovers.value for shard in shards}
+    downloaded_before = {shard.name: shard.downloaded_bytes.value for shard in shards}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        settings.OUTPUT_BASE_DIR = temp_dir
+        settings.MANIFEST_PATH = os.path.join(temp_dir, "manifest.db")
+        settings.MAX_CONNECTIONS = connections
+        settings.MAX_CONCURRENT_DOWNLOADS = 4
+        settings.PIPELINE_WINDOW = args.window
+        settings.VERIFY_PARTS = args.verify
+        settings.CDN_DOWNLOADS = args.cdn
+        settings.MAX_FLOOD_WAIT = args.max_flood_wait
+        # Nothing is kept between runs or done with the files afterwards
+        settings.ADAPTIVE_TUNING = False
+        settings.STARTUP_CACHE = False
+        settings.MIRROR_TO = ""
+        settings.METADATA_SIDECARS = False
+        settings.POST_PROCESS_HOOKS = []
+        settings.DEDUP_VERIFY_HASH = False
+        resources = DownloadResources(shards[0].client)
+        resources.accounts = AccountPool(shards)
+        resources.retry_policy = RetryPolicy(
+            base_delay=0.05, max_flood_wait=args.max_flood_wait
+        )
+        manager = DownloadManager(shards[0].client, "benchmark", resources)
+        manager.set_progress(NullProgress())
+        failed = 0
+
+        async def download(document_id: int):
+            nonlocal failed
+            for shard in shards:
+                shard.client.document(size, document_id)
+            message = shards[0].client.message(size, document_id)
+            filepath = os.path.join(temp_dir, f"{document_id}.bin")
+            success, result = await manager.download_with_retry(
+                message, filepath, os.path.basename(filepath)
+            )
+            if not success:
+                print(result, file=sys.stderr)
+                failed += 1
+                return
+            sink = VerifyingSink(shards[0].client.server, size)
+            with open(filepath, "rb") as file:
+                for chunk in iter(lambda: file.read(MB), b""):
+                    sink.write(chunk)
+            os.remove(filepath)
+
+        # Every account runs four downloads at a time, like MAX_CONCURRENT_DOWNLOADS
+        slots = asyncio.Semaphore(4 * args.accounts)
+
+        async def limited(document_id: int):
+            async with slots:
+                await download(document_id)
+
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*[limited(index + 1) for index in range(args.files)])
+            elapsed = time.perf_counter() - started
+        finally:
+            await resources.close()
+    return {
+        "seconds": elapsed,
+        "mb_per_s": size * (args.files - failed) / MB / elapsed,
+        "failovers": int(
+            sum(
+                shard.failovers.value - failovers_before[shard.name] for shard in shards
+            )
+        ),
+        "failed": failed,
+        "accounts": {
+            shard.name: {
+                "files": shard.files,
+                "mb_per_s": (
+                    shard.downloaded_bytes.value - downloaded_before[shard.name]
+                )
+                / MB
+                / elapsed,
+                "flood_waits": shard.client.server.flood_waits,
+            }
+            for shard in shards
+        },
+    }
+
+
+def create_server(args: argparse.Namespace, seed: int) -> FakeFileServer:
+    cdn = None
+    if args.cdn:
+        cdn = FakeCdnServer(
+            reupload_rate=args.reupload_rate,
+            latency=args.cdn_latency,
+            jitter=args.jitter,
+            bandwidth=args.cdn_bandwidth * MB,
+            error_rate=args.error_rate,
+            corrupt_rate=args.corrupt_rate,
+            seed=seed,
+        )
+    return FakeFileServer(
+        latency=args.latency,
+        jitter=args.jitter,
+        bandwidth=args.bandwidth * MB,
+        error_rate=args.error_rate,
+        flood_wait_rate=args.flood_wait_rate,
+        flood_wait_seconds=args.flood_wait_seconds,
+        corrupt_rate=args.corrupt_rate,
+        cdn=cdn,
+        seed=seed,
+    )
+
+
+async def run_benchmarks(args: argparse.Namespace) -> List[Dict[str, object]]:
+    if args.accounts:
+        return await run_account_benchmarks(args)
+    server = create_server(args, args.seed)
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        directory = temp_dir if args.disk else None
+        for size_mb in args.sizes:
+            for connections in args.connections:
+                runs = [
+                    await run_once(
+                        server,
+                        int(size_mb * MB),
+                        connections,
+                        args.window,
+                        directory,
+                        args.rate_limit,
+                        args.verify,
+                        args.concurrent,
+                        args.buffer_pool,
+                        args.disk_bandwidth,
+                    )
+                    for _ in range(args.repeat)
+                ]
+                # Medians, so one unlucky run doesn't look like a regression
+                result = {
+                    key: statistics.median(run[key] for run in runs) for key in runs[0]
+                }
+                result.update(
+                    file_size=int(size_mb * MB), connections=connections, runs=len(runs)
+                )
+                results.append(result)
+                print(
+                    f"{size_mb:>8g} MB x{connections:<3} "
+                    f"{result['mb_per_s']:8.1f} MB/s  "
+                    f"ttfb {result['ttfb_ms']:7.1f} ms  "
+                    f"rss {result['peak_rss_mb']:7.1f} MB  "
+                    f"parts {result['peak_buffer_mb']:6.1f} MB  "
+                    f"cpu {result['cpu_s_per_gb']:6.2f} s/GB",
+                    file=sys.stderr,
+                )
+    return results
+
+
+async def run_account_benchmarks(args: argparse.Namespace) -> List[Dict[str, object]]:
+    results = []
+    for size_mb in args.sizes:
+        for connections in args.connections:
+            result = await run_accounts(args, int(size_mb * MB), connections)
+            result.update(
+                file_size=int(size_mb * MB),
+                connections=connections,
+                files=args.files,
+                runs=1,
+            )
+            results.append(result)
+            print(
+                f"{size_mb:>8g} MB x{connections:<3} {args.files} files over "
+                f"{args.accounts} accounts {result['mb_per_s']:8.1f} MB/s  "
+                f"{result['failovers']} failovers, {result['failed']} failed",
+                file=sys.stderr,
+            )
+            for name, account in result["accounts"].items():
+                print(
+                    f"    {name}: {account['files']} files "
+                    f"{account['mb_per_s']:8.1f} MB/s "
+                    f"{account['flood_waits']} flood waits",
+                    file=sys.stderr,
+                )
+    return results
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[Dict[str, object]], baseline_path: str, threshold: float):
+    """Print throughput changes against an earlier run, return False on regressions"""
+    with open(baseline_path) as file:
+        baseline = {
+            (
+                result["file_size"],
+                result["connections"],
+                len(result.get("accounts", ())),
+            ): result
+            for result in json.load(file)["results"]
+        }
+    passed = True
+    for result in results:
+        previous = baseline.get(
+            (
+                result["file_size"],
+                result["connections"],
+                len(result.get("accounts", ())),
+            )
+        )
+        if not previous:
+            continue
+        change = result["mb_per_s"] / previous["mb_per_s"] - 1
+        regressed = change < -threshold
+        passed = passed and not regressed
+        print(
+            f"{result['file_size'] / MB:>8g} MB x{result['connections']:<3} "
+            f"{previous['mb_per_s']:8.1f} -> {result['mb_per_s']:8.1f} MB/s "
+            f"({change:+.1%}){'  REGRESSION' if regressed else ''}",
+            file=sys.stderr,
+        )
+    return passed
+
+
+def parse_list(value: str, type_=float) -> list:
+    return [type_(item) for item in value.split(",") if item]
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=parse_list, default=[1, 10, 100])
+    parser.add_argument(
+        "--connections", type=lambda v: parse_list(v, int), default=[1, 4, 8, 16]
+    )
+    parser.add_argument("--window", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Seconds")
+    parser.add_argument("--bandwidth", type=float, default=0, help="MB/s, 0 = no cap")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--flood-wait-rate", type=float, default=0.0)
+    parser.add_argument("--flood-wait-seconds", type=int, default=1)
+    parser.add_argument("--corrupt-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--verify", action="store_true", help="Check parts against the file hashes"
+    )
+    parser.add_argument(
+        "--cdn", action="store_true", help="Redirect every file to a fake CDN"
+    )
+    parser.add_argument("--cdn-latency", type=float, default=0.02, help="Seconds")
+    parser.add_argument(
+        "--cdn-bandwidth", type=float, default=0, help="MB/s, 0 = no cap"
+    )
+    parser.add_argument(
+        "--reupload-rate",
+        type=float,
+        default=0.0,
+        help="Share of files the CDN only has after a reupload",
+    )
+    parser.add_argument(
+        "--rate-limit", type=float, default=0, help="Requests per second, 0 = none"
+    )
+    parser.add_argument(
+        "--disk", action="store_true", help="Write through a checkpoint to a temp dir"
+    )
+    parser.add_argument(
+        "--disk-bandwidth",
+        type=float,
+        default=0,
+        help="MB/s of the disk behind --disk, 0 = no cap",
+    )
+    parser.add_argument(
+        "--concurrent", type=int, default=1, help="Files downloaded at the same time"
+    )
+    parser.add_argument(
+        "--buffer-pool",
+        type=float,
+        default=0,
+        help="MB of parts held in memory by all files, 0 = no pool",
+    )
+    parser.add_argument(
+        "--accounts", type=int, default=0, help="Shard --files over fake accounts"
+    )
+    parser.add_argument("--files", type=int, default=32)
+    parser.add_argument(
+        "--max-flood-wait",
+        type=int,
+        default=300,
+        help="Longer flood waits move the download to another account",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.1,
+        help="Allowed throughput drop against --compare, 0.1 = 10%%",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    results = asyncio.run(run_benchmarks(args))
+    report = {
+        "version": RESULTS_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "compare")
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+    if args.compare and not compare(results, args.compare, args.max_regression):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,68 @@
-import asyncio
+import argparse
+
+from src.startup_profile import profile
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Download media from Telegram channels"
+    )
+    parser.add_argument(
+        "--mirror-to",
+        metavar="CHANNEL",
+        help="Re-upload downloaded media to this channel (overrides MIRROR_TO)",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Stream media over HTTP at /<channel>/<message_id> instead of downloading",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Catch up, then keep downloading new media as it is posted",
+    )
+    parser.add_argument(
+        "--plan",
+        metavar="FILE",
+        help="Only scan, and write what a run would download to FILE (.json or .csv)",
+    )
+    parser.add_argument(
+        "--execute-plan",
+        metavar="FILE",
+        help="Download exactly the files of a plan written by --plan, without scanning",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="Print how long each step before the first downloaded byte took",
+    )
+    return parser.parse_args()
 
-from src.telegram_downloader import TelegramDownloader
 
 if __name__ == "__main__":
+    args = parse_args()
+    profile.enabled = args.profile_startup
+    # Loaded after the arguments, so --help doesn't wait for telethon
+    import asyncio
+
+    from src.config import settings
+    from src.telegram_downloader import TelegramDownloader
+
+    profile.mark("imports")
+    if args.mirror_to:
+        settings.MIRROR_TO = args.mirror_to
     app = TelegramDownloader()
     try:
-        asyncio.run(app.run())
+        if args.serve:
+            asyncio.run(app.serve())
+        elif args.watch:
+            asyncio.run(app.watch())
+        elif args.plan:
+            asyncio.run(app.plan(args.plan))
+        elif args.execute_plan:
+            asyncio.run(app.execute_plan(args.execute_plan))
+        else:
+            asyncio.run(app.run())
     except KeyboardInterrupt:
         print("\nOperation cancelled by user")
@@ -4,23 +4,32 @@
 import asyncio
 import hashlib
 import inspect
+import io
 import logging
 import math
 import os
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import (
+    TYPE_CHECKING,
     AsyncGenerator,
     Awaitable,
     BinaryIO,
+    Callable,
     DefaultDict,
+    Dict,
+    Iterable,
     List,
     Optional,
+    Set,
     Tuple,
     Union,
 )
 
-from telethon import TelegramClient, helpers, utils
-from telethon.crypto import AuthKey
+from telethon import TelegramClient, errors, helpers, utils
+from telethon.crypto import AuthKey, rsa
 from telethon.network import MTProtoSender
 from telethon.tl.alltlobjects import LAYER
 from telethon.tl.functions import InvokeWithLayerRequest
@@ -28,27 +37,67 @@ from telethon.tl.functions.auth import (
     ExportAuthorizationRequest,
     ImportAuthorizationRequest,
 )
+from telethon.tl.functions.help import GetCdnConfigRequest
 from telethon.tl.functions.upload import (
+    GetCdnFileHashesRequest,
+    GetCdnFileRequest,
+    GetFileHashesRequest,
     GetFileRequest,
+    ReuploadCdnFileRequest,
     SaveBigFilePartRequest,
     SaveFilePartRequest,
 )
+from telethon.tl.functions.users import GetUsersRequest
+from telethon.tl.tlobject import TLRequest
 from telethon.tl.types import (
     Document,
+    FileHash,
     InputDocumentFileLocation,
     InputFile,
     InputFileBig,
     InputFileLocation,
     InputPeerPhotoFileLocation,
     InputPhotoFileLocation,
+    InputUserSelf,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+    Photo,
+    PhotoSize,
+    PhotoSizeProgressive,
     TypeInputFile,
 )
+from telethon.tl.types.upload import CdnFileReuploadNeeded, FileCdnRedirect
+
+from src.file_writer import PositionalWriter
+from src.metrics import TransferMetrics
+from src.startup_profile import profile
+from src.transfer_retry import (
+    CONNECTION_ERRORS,
+    FLOOD_ERRORS,
+    SERVER_ERRORS,
+    RateLimiter,
+    RetryPolicy,
+)
+
+if TYPE_CHECKING:
+    from src.buffer_pool import BufferPool
+    from src.deduplication import PartHasher
+    from src.download_checkpoint import DownloadCheckpoint
+    from src.startup_cache import StartupCache
+    from src.transfer_tuner import TransferTuner
 
 try:
     from mautrix.crypto.attachments import async_encrypt_attachment
 except ImportError:
     async_encrypt_attachment = None
 
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    # Telethon's pure python AES is too slow for CDN parts, files then come
+    # from their own DC
+    Cipher = None
+
 log: logging.Logger = logging.getLogger("telethon")
 
 TypeLocation = Union[
@@ -59,42 +108,320 @@ TypeLocation = Union[
     InputPhotoFileLocation,
 ]
 
+# GetFileRequest returns at most 1 MB, small files are fetched in parts this big
+SMALL_PART_SIZE = 1024 * 1024
+# Seconds an auth key cached by an earlier run gets to prove it still works
+AUTH_KEY_CHECK_TIMEOUT = 10
+
+
+class CdnRedirected(Exception):
+    """Telegram answered a part request with a redirect to a CDN DC"""
+
+    def __init__(self, redirect: FileCdnRedirect) -> None:
+        super().__init__(f"File redirected to CDN DC {redirect.dc_id}")
+        self.redirect = redirect
+
+
+class CdnReuploadNeeded(Exception):
+    """The CDN still didn't have a part after the file's DC reuploaded it"""
+
+
+def _decrypt_cdn_part(key: bytes, iv: bytes, offset: int, data: bytes) -> bytes:
+    # The last 4 bytes of the IV count the 16 byte blocks before the part
+    counter = iv[:12] + (offset // 16).to_bytes(4, "big")
+    decryptor = Cipher(algorithms.AES(key), modes.CTR(counter)).decryptor()
+    return decryptor.update(data) + decryptor.finalize()
+
 
 class DownloadSender:
     client: TelegramClient
     sender: MTProtoSender
-    request: GetFileRequest
-    remaining: int
-    stride: int
+    file: TypeLocation
+    part_size: int
+    dc_id: int
+    shared: bool
+    cdn_supported: bool
+    cdn: Optional["CdnSource"]
+    retired: bool
+    lock: asyncio.Lock
 
     def __init__(
         self,
         client: TelegramClient,
         sender: MTProtoSender,
         file: TypeLocation,
-        offset: int,
-        limit: int,
-        stride: int,
-        count: int,
+        part_size: int,
+        dc_id: int,
+        shared: bool = False,
+        cdn_supported: bool = False,
+        cdn: Optional["CdnSource"] = None,
     ) -> None:
         self.sender = sender
         self.client = client
-        self.request = GetFileRequest(file, offset=offset, limit=limit)
-        self.stride = stride
-        self.remaining = count
+        self.file = file
+        self.part_size = part_size
+        # The DC of the connection, a CDN DC once the file was redirected
+        self.dc_id = dc_id
+        self.shared = shared
+        self.cdn_supported = cdn_supported
+        self.cdn = cdn
+        self.retired = False
+        # Held while the connection is replaced after it failed
+        self.lock = asyncio.Lock()
 
-    async def next(self) -> Optional[bytes]:
-        if not self.remaining:
-            return None
-        result = await self.client._call(self.sender, self.request)
-        self.remaining -= 1
-        self.request.offset += self.stride
+    async def fetch(self, part: int) -> bytes:
+        offset = part * self.part_size
+        if self.cdn:
+            return await self.cdn.fetch(self.sender, offset, self.part_size)
+        request = GetFileRequest(
+            self.file,
+            offset=offset,
+            limit=self.part_size,
+            cdn_supported=self.cdn_supported or None,
+        )
+        # Sent directly, the transferrer handles flood waits and retries itself
+        result = await self.sender.send(request)
+        if isinstance(result, FileCdnRedirect):
+            raise CdnRedirected(result)
         return result.bytes
 
     def disconnect(self) -> Awaitable[None]:
         return self.sender.disconnect()
 
 
+class HashMismatchError(ValueError):
+    """A part still didn't match its hash, or had none, after being fetched again"""
+
+
+def _check_hashes(data: bytes, ranges: List[Tuple[int, int, bytes]]) -> bool:
+    return all(
+        hashlib.sha256(data[start : start + limit]).digest() == expected
+        for start, limit, expected in ranges
+    )
+
+
+class PartVerifier:
+    """Checks downloaded parts against the SHA-256 hashes telegram has for a file.
+
+    Telegram hashes files in fixed ranges, usually of 128 KB, and returns
+    several of them per request. :meth:`prepare` requests them together with
+    the part that needs them, once per batch and ``read_ahead`` batches
+    ahead, since they may come from a slower DC than the parts. They are
+    cached, the parts are hashed in ``executor``. Ranges that don't lie
+    entirely within one part can't be checked and are skipped.
+    """
+
+    # Whether a download fails when the hashes can't be fetched
+    required = False
+
+    def __init__(
+        self,
+        location: Optional[TypeLocation],
+        file_size: int,
+        executor: Optional[ThreadPoolExecutor] = None,
+        read_ahead: int = 4,
+    ) -> None:
+        self.location = location
+        self.file_size = file_size
+        self.executor = executor
+        self.read_ahead = read_ahead
+        self.hashes: Dict[int, FileHash] = {}
+        self.range_size: Optional[int] = None
+        # How much of the file one answer covers, known after the first one
+        self.batch_size: Optional[int] = None
+        self.requests: Dict[Optional[int], asyncio.Future] = {}
+        # Set when the file has no hashes, e.g. for some photo sizes
+        self.disabled = False
+
+    async def _request(self, sender: MTProtoSender, offset: int) -> List[FileHash]:
+        return await sender.send(GetFileHashesRequest(self.location, offset))
+
+    def add_hashes(self, hashes: List[FileHash]) -> None:
+        for file_hash in hashes:
+            self.hashes[file_hash.offset] = file_hash
+            self.range_size = self.range_size or file_hash.limit
+        if hashes and not self.batch_size:
+            self.batch_size = self.range_size * len(hashes)
+
+    def _find(self, offset: int) -> Optional[FileHash]:
+        if not self.range_size:
+            return None
+        return self.hashes.get(offset - offset % self.range_size)
+
+    def _fetch(self, sender: MTProtoSender, offset: int) -> asyncio.Future:
+        """Request the batch of hashes ``offset`` is in, unless already requested"""
+        # All parts wait for the first answer, it tells the batch size
+        batch = offset // self.batch_size if self.batch_size else None
+        request = self.requests.get(batch)
+        if request:
+            return request
+
+        async def receive() -> None:
+            start = batch * self.batch_size if batch is not None else offset
+            hashes = await self._request(sender, start)
+            if not hashes and not self.required:
+                log.debug(f"No file hashes for {self.location!s}")
+                self.disabled = True
+            self.add_hashes(hashes)
+
+        def forget(future: asyncio.Future) -> None:
+            if self.requests.get(batch) is future:
+                del self.requests[batch]
+            if not future.cancelled():
+                # Read here, batches fetched ahead may have nobody waiting for them
+                future.exception()
+
+        request = self.requests[batch] = asyncio.ensure_future(receive())
+        request.add_done_callback(forget)
+        return request
+
+    async def _get_hash(self, sender: MTProtoSender, offset: int) -> Optional[FileHash]:
+        for _ in range(2):
+            file_hash = self._find(offset)
+            if file_hash or self.disabled:
+                return file_hash
+            batch_known = self.batch_size is not None
+            request = self._fetch(sender, offset)
+            try:
+                await asyncio.shield(request)
+            except errors.RPCError as e:
+                if self.required:
+                    raise
+                if isinstance(e, FLOOD_ERRORS):
+                    # Only the parts waiting for this batch go unchecked
+                    return None
+                log.debug(f"No file hashes for {self.location!s}: {e}")
+                self.disabled = True
+                return None
+            if batch_known:
+                break
+        return self._find(offset)
+
+    def prepare(self, sender: MTProtoSender, offset: int, size: int) -> None:
+        """Start fetching the hashes for a part, so they arrive along with it"""
+        position = offset
+        end = min(
+            offset + size + self.read_ahead * (self.batch_size or 0), self.file_size
+        )
+        while position < end and not self.disabled:
+            if not self._find(position):
+                self._fetch(sender, position)
+            if not self.batch_size:
+                return
+            position = (position // self.batch_size + 1) * self.batch_size
+
+    async def verify(self, sender: MTProtoSender, offset: int, data: bytes) -> bool:
+        """Whether ``data`` read at ``offset`` matches every hash it fully covers.
+
+        A required verifier rejects data it has no hash for, so the part and
+        its hashes are fetched again instead of being accepted unchecked.
+        """
+        end = offset + len(data)
+        ranges = []
+        position = offset
+        while position < end and not self.disabled:
+            file_hash = await self._get_hash(sender, position)
+            if not file_hash:
+                if self.required:
+                    log.info(f"No hash for offset {position}, fetching the part again")
+                    return False
+                break
+            hash_end = min(file_hash.offset + file_hash.limit, self.file_size)
+            if file_hash.offset >= offset and hash_end <= end:
+                ranges.append(
+                    (
+                        file_hash.offset - offset,
+                        hash_end - file_hash.offset,
+                        file_hash.hash,
+                    )
+                )
+            position = file_hash.offset + file_hash.limit
+        if not ranges:
+            return not self.required
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, _check_hashes, data, ranges
+        )
+
+
+class CdnPartVerifier(PartVerifier):
+    """Checks decrypted CDN parts, with hashes from the DC the file belongs to.
+
+    Telegram requires clients to check everything a CDN sends, so downloads
+    fail instead of continuing unchecked when there are no hashes.
+    """
+
+    required = True
+
+    def __init__(
+        self,
+        file_token: bytes,
+        file_size: int,
+        call_master: Callable[[TLRequest], Awaitable],
+        executor: Optional[ThreadPoolExecutor] = None,
+    ) -> None:
+        super().__init__(None, file_size, executor)
+        self.file_token = file_token
+        self.call_master = call_master
+
+    async def _request(self, sender: MTProtoSender, offset: int) -> List[FileHash]:
+        return await self.call_master(GetCdnFileHashesRequest(self.file_token, offset))
+
+
+class CdnSource:
+    """Where the parts of a file telegram redirected to a CDN DC come from.
+
+    CDN DCs send parts encrypted with AES-256-CTR under the key and IV of the
+    redirect. When a CDN doesn't have a part yet, the DC the file belongs to
+    is asked to reupload it there, which also returns more of its hashes.
+    """
+
+    def __init__(
+        self,
+        redirect: FileCdnRedirect,
+        file_size: int,
+        call_master: Callable[[TLRequest], Awaitable],
+        executor: Optional[ThreadPoolExecutor] = None,
+    ) -> None:
+        self.dc_id = redirect.dc_id
+        self.file_token = redirect.file_token
+        self.key = redirect.encryption_key
+        self.iv = redirect.encryption_iv
+        self.call_master = call_master
+        self.executor = executor
+        self.verifier = CdnPartVerifier(
+            self.file_token, file_size, call_master, executor
+        )
+        self.verifier.add_hashes(redirect.file_hashes)
+        self.reuploads = 0
+        self.lock = asyncio.Lock()
+
+    async def fetch(self, sender: MTProtoSender, offset: int, limit: int) -> bytes:
+        request = GetCdnFileRequest(self.file_token, offset, limit)
+        reuploads = self.reuploads
+        result = await sender.send(request)
+        if isinstance(result, CdnFileReuploadNeeded):
+            await self.reupload(result.request_token, reuploads)
+            result = await sender.send(request)
+            if isinstance(result, CdnFileReuploadNeeded):
+                raise CdnReuploadNeeded(f"CDN DC {self.dc_id} is missing {offset}")
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, _decrypt_cdn_part, self.key, self.iv, offset, result.bytes
+        )
+
+    async def reupload(self, request_token: bytes, reuploads: int) -> None:
+        """Have the file's DC reupload it, unless that happened since ``reuploads``"""
+        # Parts that went missing together share one reupload
+        async with self.lock:
+            if self.reuploads != reuploads:
+                return
+            log.debug(f"Asking for a reupload to CDN DC {self.dc_id}")
+            hashes = await self.call_master(
+                ReuploadCdnFileRequest(self.file_token, request_token)
+            )
+            self.reuploads += 1
+            self.verifier.add_hashes(hashes)
+
+
 class UploadSender:
     client: TelegramClient
     sender: MTProtoSender
@@ -146,29 +473,413 @@ class UploadSender:
         return await self.sender.disconnect()
 
 
+class ConnectionBudget:
+    """Global cap on the number of senders held by all running transfers."""
+
+    limit: int
+    available: int
+    waiting: int
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.available = limit
+        self.waiting = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, wanted: int) -> int:
+        """Wait until at least one connection is free and take up to ``wanted``."""
+        async with self._condition:
+            self.waiting += 1
+            try:
+                await self._condition.wait_for(lambda: self.available > 0)
+            finally:
+                self.waiting -= 1
+            granted = min(wanted, self.available)
+            self.available -= granted
+            return granted
+
+    def try_acquire(self, count: int = 1) -> bool:
+        """Take ``count`` spare connections, free right now and wanted by nobody."""
+        if self.waiting or self.available < count:
+            return False
+        self.available -= count
+        return True
+
+    async def release(self, count: int) -> None:
+        async with self._condition:
+            self.available += count
+            self._condition.notify_all()
+
+
+class SenderPool:
+    """Long-lived, already authorized senders per DC, shared by all transfers.
+
+    Senders are handed out with :meth:`acquire` and given back with :meth:`release`
+    instead of being disconnected, so consecutive files skip the connection
+    handshake and the cross-DC authorization export. Idle senders are closed
+    after ``idle_timeout`` seconds, and the oldest idle sender is evicted when
+    ``max_connections`` would otherwise be exceeded. CDN DCs registered with
+    :meth:`add_cdn` get an auth key of their own instead of the login.
+
+    With a ``cache``, DC addresses and exported auth keys are reused from
+    earlier runs; a cached key is checked with one request before it is used.
+    """
+
+    client: TelegramClient
+    max_connections: int
+    idle_timeout: float
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        max_connections: int = 20,
+        idle_timeout: float = 60.0,
+        cache: Optional["StartupCache"] = None,
+    ) -> None:
+        self.client = client
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.cache = cache
+        self._idle: DefaultDict[int, List[Tuple[MTProtoSender, float]]] = defaultdict(
+            list
+        )
+        self._leased: DefaultDict[int, int] = defaultdict(int)
+        self._auth_keys: Dict[int, AuthKey] = {}
+        self._cdn_dcs: Set[int] = set()
+        self._cdn_keys_loaded = False
+        self._reaper: Optional[asyncio.Task] = None
+        self.created = 0
+        self.reused = 0
+        self.closed = 0
+
+    @property
+    def open_connections(self) -> int:
+        return sum(self._leased.values()) + sum(len(i) for i in self._idle.values())
+
+    def _get_auth_key(self, dc_id: int) -> Optional[AuthKey]:
+        if dc_id == self.client.session.dc_id:
+            return self.client.session.auth_key
+        return self._auth_keys.get(dc_id)
+
+    def is_authorized(self, dc_id: int) -> bool:
+        """Whether connections to ``dc_id`` skip the authorization export"""
+        return self._get_auth_key(dc_id) is not None
+
+    async def add_cdn(self, dc_id: int) -> None:
+        """Let :meth:`acquire` connect to the CDN DC ``dc_id``"""
+        if not self._cdn_keys_loaded:
+            # CDN DCs prove who they are with keys of their own
+            config = await self.client(GetCdnConfigRequest())
+            for public_key in config.public_keys:
+                rsa.add_key(public_key.public_key, old=False)
+            self._cdn_keys_loaded = True
+        self._cdn_dcs.add(dc_id)
+
+    async def acquire(self, dc_id: int) -> MTProtoSender:
+        if self.idle_timeout > 0 and (not self._reaper or self._reaper.done()):
+            self._reaper = asyncio.create_task(self._reap_idle())
+        idle = self._idle[dc_id]
+        while idle:
+            sender, _ = idle.pop()
+            if sender.is_connected():
+                self._leased[dc_id] += 1
+                self.reused += 1
+                return sender
+            self.closed += 1
+        await self._evict_for_new_connection()
+        self._leased[dc_id] += 1
+        try:
+            sender = None
+            if not self._get_auth_key(dc_id):
+                # The first cross-DC sender exports+imports the authorization, so the
+                # others must wait for it instead of exporting it again.
+                async with parallel_transfer_locks[dc_id]:
+                    if not self._get_auth_key(dc_id):
+                        sender = await self._connect(dc_id)
+            if not sender:
+                sender = await self._connect(dc_id)
+        except BaseException:
+            self._leased[dc_id] -= 1
+            raise
+        self.created += 1
+        profile.mark("connect")
+        return sender
+
+    def release(self, dc_id: int, sender: MTProtoSender) -> None:
+        self._leased[dc_id] -= 1
+        if sender.is_connected():
+            self._idle[dc_id].append((sender, time.monotonic()))
+        else:
+            self.closed += 1
+
+    async def discard(self, dc_id: int, sender: MTProtoSender) -> None:
+        """Give back a sender that must not be reused, e.g. after a failed transfer."""
+        self._leased[dc_id] -= 1
+        self.closed += 1
+        await sender.disconnect()
+
+    async def _connect(self, dc_id: int) -> MTProtoSender:
+        auth_key = self._get_auth_key(dc_id)
+        cdn = dc_id in self._cdn_dcs
+        if not auth_key and not cdn and self.cache:
+            auth_key = self.cache.get_auth_key(self.client, dc_id)
+            if auth_key:
+                sender = await self._open(dc_id, cdn, auth_key)
+                if await self._check_auth_key(sender):
+                    self._auth_keys[dc_id] = auth_key
+                    return sender
+                # Revoked since it was cached, export a new one
+                log.debug(f"Cached auth key of DC {dc_id} is no longer valid")
+                self.cache.forget_auth_key(self.client, dc_id)
+                await sender.disconnect()
+                auth_key = None
+        sender = await self._open(dc_id, cdn, auth_key)
+        if not auth_key and cdn:
+            # Generated while connecting, CDN DCs don't need a login
+            self._auth_keys[dc_id] = sender.auth_key
+        elif not auth_key:
+            log.debug(f"Exporting auth to DC {dc_id}")
+            auth = await self.client(ExportAuthorizationRequest(dc_id))
+            self.client._init_request.query = ImportAuthorizationRequest(
+                id=auth.id, bytes=auth.bytes
+            )
+            req = InvokeWithLayerRequest(LAYER, self.client._init_request)
+            await sender.send(req)
+            self._auth_keys[dc_id] = sender.auth_key
+            if self.cache:
+                self.cache.set_auth_key(self.client, dc_id, sender.auth_key)
+        return sender
+
+    async def _open(
+        self, dc_id: int, cdn: bool, auth_key: Optional[AuthKey]
+    ) -> MTProtoSender:
+        ipv6 = self.client._use_ipv6
+        dc = self.cache.get_dc(dc_id, cdn, ipv6) if self.cache else None
+        if dc:
+            try:
+                return await self._open_to(dc, auth_key)
+            except OSError:
+                # The DC moved since its address was cached
+                self.cache.forget_dc(dc_id, cdn, ipv6)
+        dc = await self.client._get_dc(dc_id, cdn=cdn)
+        if self.cache:
+            self.cache.set_dc(dc, ipv6)
+        return await self._open_to(dc, auth_key)
+
+    async def _open_to(self, dc, auth_key: Optional[AuthKey]) -> MTProtoSender:
+        sender = MTProtoSender(auth_key, loggers=self.client._log)
+        await sender.connect(
+            self.client._connection(
+                dc.ip_address,
+                dc.port,
+                dc.id,
+                loggers=self.client._log,
+                proxy=self.client._proxy,
+            )
+        )
+        return sender
+
+    async def _check_auth_key(self, sender: MTProtoSender) -> bool:
+        """Whether the login still accepts the auth key ``sender`` connected with"""
+        self.client._init_request.query = GetUsersRequest([InputUserSelf()])
+        req = InvokeWithLayerRequest(LAYER, self.client._init_request)
+        try:
+            await asyncio.wait_for(sender.send(req), AUTH_KEY_CHECK_TIMEOUT)
+        except (errors.RPCError, errors.AuthKeyNotFound, *CONNECTION_ERRORS):
+            # AuthKeyNotFound is the -404 of a DC that dropped the key
+            return False
+        return True
+
+    async def _evict_for_new_connection(self) -> None:
+        while self.open_connections >= self.max_connections:
+            candidates = [
+                (idle[0][1], dc_id) for dc_id, idle in self._idle.items() if idle
+            ]
+            if not candidates:
+                return
+            _, dc_id = min(candidates)
+            sender, _ = self._idle[dc_id].pop(0)
+            self.closed += 1
+            await sender.disconnect()
+
+    async def _reap_idle(self) -> None:
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            deadline = time.monotonic() - self.idle_timeout
+            expired = []
+            # Copied, acquire adds DCs while the disconnects below are awaited
+            for dc_id, idle in list(self._idle.items()):
+                dc_expired = [sender for sender, since in idle if since < deadline]
+                if not dc_expired:
+                    continue
+                idle[:] = [
+                    (sender, since) for sender, since in idle if since >= deadline
+                ]
+                log.debug(f"Closing {len(dc_expired)} idle connections to DC {dc_id}")
+                expired.extend(dc_expired)
+            self.closed += len(expired)
+            await asyncio.gather(
+                *[sender.disconnect() for sender in expired], return_exceptions=True
+            )
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "open_connections": self.open_connections,
+            "created": self.created,
+            "reused": self.reused,
+            "closed": self.closed,
+            "dcs": {
+                dc_id: {"leased": self._leased[dc_id], "idle": len(self._idle[dc_id])}
+                for dc_id in sorted(set(self._leased) | set(self._idle))
+            },
+        }
+
+    async def close(self) -> None:
+        if self._reaper:
+            self._reaper.cancel()
+            self._reaper = None
+        senders = [sender for idle in self._idle.values() for sender, _ in idle]
+        self._idle.clear()
+        self.closed += len(senders)
+        await asyncio.gather(*[sender.disconnect() for sender in senders])
+
+
+class SharedSenders:
+    """One pooled sender per DC that every small download uses at the same time.
+
+    Telegram answers requests on one connection concurrently, so photos,
+    stickers and voice notes don't need connections of their own. Each shared
+    sender takes one connection of the budget until :meth:`close`.
+    """
+
+    pool: SenderPool
+    budget: Optional[ConnectionBudget]
+
+    def __init__(
+        self, pool: SenderPool, budget: Optional[ConnectionBudget] = None
+    ) -> None:
+        self.pool = pool
+        self.budget = budget
+        self._senders: Dict[int, MTProtoSender] = {}
+        self._locks: DefaultDict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    async def get(self, dc_id: int) -> MTProtoSender:
+        sender = self._senders.get(dc_id)
+        if sender:
+            return sender
+        async with self._locks[dc_id]:
+            if dc_id not in self._senders:
+                if self.budget:
+                    await self.budget.acquire(1)
+                try:
+                    self._senders[dc_id] = await self.pool.acquire(dc_id)
+                except BaseException:
+                    if self.budget:
+                        await self.budget.release(1)
+                    raise
+            return self._senders[dc_id]
+
+    async def replace(self, dc_id: int, failed: MTProtoSender) -> MTProtoSender:
+        """Swap a broken sender for a new one, unless another download already did."""
+        async with self._locks[dc_id]:
+            if self._senders.get(dc_id) is failed:
+                replacement = await self.pool.acquire(dc_id)
+                await self.pool.discard(dc_id, failed)
+                self._senders[dc_id] = replacement
+            return self._senders[dc_id]
+
+    async def close(self) -> None:
+        senders, self._senders = self._senders, {}
+        for dc_id, sender in senders.items():
+            self.pool.release(dc_id, sender)
+        if self.budget:
+            await self.budget.release(len(senders))
+
+
 class ParallelTransferrer:
     client: TelegramClient
     loop: asyncio.AbstractEventLoop
     dc_id: int
     senders: Optional[List[Union[DownloadSender, UploadSender]]]
-    auth_key: AuthKey
     upload_ticker: int
+    budget: Optional[ConnectionBudget]
+    pool: SenderPool
+    tuner: Optional["TransferTuner"]
+    rate_limiter: Optional[RateLimiter]
+    retry_policy: RetryPolicy
+    shared: Optional[SharedSenders]
+    verifier: Optional[PartVerifier]
+    use_cdn: bool
+    cdn: Optional[CdnSource]
+    buffers: Optional["BufferPool"]
 
-    def __init__(self, client: TelegramClient, dc_id: Optional[int] = None) -> None:
+    def __init__(
+        self,
+        client: TelegramClient,
+        dc_id: Optional[int] = None,
+        budget: Optional[ConnectionBudget] = None,
+        pool: Optional[SenderPool] = None,
+        tuner: Optional["TransferTuner"] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        shared: Optional[SharedSenders] = None,
+        verifier: Optional[PartVerifier] = None,
+        use_cdn: bool = False,
+        executor: Optional[ThreadPoolExecutor] = None,
+        buffers: Optional["BufferPool"] = None,
+    ) -> None:
         self.client = client
         self.loop = self.client.loop
         self.dc_id = dc_id or self.client.session.dc_id
-        self.auth_key = (
-            None
-            if dc_id and self.client.session.dc_id != dc_id
-            else self.client.session.auth_key
-        )
         self.senders = None
         self.upload_ticker = 0
+        self.upload_connections = 0
+        self.budget = budget
+        self.tuner = tuner
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.shared = shared
+        self.verifier = verifier
+        # Lets telegram redirect the file to a CDN DC, set once it did
+        self.use_cdn = use_cdn and Cipher is not None
+        self.cdn = None
+        self.cdn_lock = asyncio.Lock()
+        self.executor = executor
+        self.buffers = buffers
+        # Room taken from the buffer pool and not given back yet
+        self.held_buffers = 0
+        self.file_size = 0
+        self.metrics = TransferMetrics(self.dc_id)
+        # Without a shared pool the connections only live as long as this transfer
+        self.owns_pool = pool is None
+        self.pool = pool or SenderPool(client, idle_timeout=0)
 
-    async def _cleanup(self) -> None:
-        await asyncio.gather(*[sender.disconnect() for sender in self.senders])
+    async def _cleanup(self, failed: bool = False) -> None:
+        if self.senders:
+            await asyncio.gather(
+                *[self._release_sender(sender, failed) for sender in self.senders]
+            )
         self.senders = None
+        if self.owns_pool:
+            await self.pool.close()
+
+    async def _release_sender(
+        self, sender: Union[DownloadSender, UploadSender], failed: bool
+    ) -> None:
+        error = None
+        if isinstance(sender, UploadSender) and sender.previous:
+            try:
+                await sender.previous
+            except Exception as e:
+                error, failed = e, True
+        dc_id = sender.dc_id if isinstance(sender, DownloadSender) else self.dc_id
+        if failed or self.owns_pool:
+            await self.pool.discard(dc_id, sender.sender)
+        else:
+            self.pool.release(dc_id, sender.sender)
+        if error:
+            # The last part of this sender was never confirmed
+            raise error
 
     @staticmethod
     def _get_connection_count(
@@ -179,49 +890,31 @@ class ParallelTransferrer:
         return math.ceil((file_size / full_size) * max_count)
 
     async def _init_download(
-        self, connections: int, file: TypeLocation, part_count: int, part_size: int
+        self, connections: int, file: TypeLocation, part_size: int
     ) -> None:
-        minimum, remainder = divmod(part_count, connections)
-
-        def get_part_count() -> int:
-            nonlocal remainder
-            if remainder > 0:
-                remainder -= 1
-                return minimum + 1
-            return minimum
-
-        # The first cross-DC sender will export+import the authorization, so we always create it
-        # before creating any other senders.
-        self.senders = [
-            await self._create_download_sender(
-                file, 0, part_size, connections * part_size, get_part_count()
-            ),
-            *await asyncio.gather(
+        # The pool makes the first cross-DC sender export+import the authorization
+        # before the others connect, so they can all be requested at once.
+        self.senders = list(
+            await asyncio.gather(
                 *[
-                    self._create_download_sender(
-                        file, i, part_size, connections * part_size, get_part_count()
-                    )
-                    for i in range(1, connections)
+                    self._create_download_sender(file, part_size)
+                    for _ in range(connections)
                 ]
-            ),
-        ]
+            )
+        )
 
     async def _create_download_sender(
-        self,
-        file: TypeLocation,
-        index: int,
-        part_size: int,
-        stride: int,
-        part_count: int,
+        self, file: TypeLocation, part_size: int
     ) -> DownloadSender:
+        dc_id = self.cdn.dc_id if self.cdn else self.dc_id
         return DownloadSender(
             self.client,
-            await self._create_sender(),
+            await self._create_sender(dc_id),
             file,
-            index * part_size,
             part_size,
-            stride,
-            part_count,
+            dc_id,
+            cdn_supported=self.use_cdn,
+            cdn=self.cdn,
         )
 
     async def _init_upload(
@@ -251,28 +944,161 @@ class ParallelTransferrer:
             loop=self.loop,
         )
 
-    async def _create_sender(self) -> MTProtoSender:
-        dc = await self.client._get_dc(self.dc_id)
-        sender = MTProtoSender(self.auth_key, loggers=self.client._log)
-        await sender.connect(
-            self.client._connection(
-                dc.ip_address,
-                dc.port,
-                dc.id,
-                loggers=self.client._log,
-                proxy=self.client._proxy,
-            )
-        )
-        if not self.auth_key:
-            log.debug(f"Exporting auth to DC {self.dc_id}")
-            auth = await self.client(ExportAuthorizationRequest(self.dc_id))
-            self.client._init_request.query = ImportAuthorizationRequest(
-                id=auth.id, bytes=auth.bytes
-            )
-            req = InvokeWithLayerRequest(LAYER, self.client._init_request)
-            await sender.send(req)
-            self.auth_key = sender.auth_key
-        return sender
+    async def _take_buffer(self, size: int) -> None:
+        if self.buffers:
+            await self.buffers.acquire(size)
+            self.held_buffers += size
+
+    def release_buffer(self, size: int) -> None:
+        """Give back the room of a part that is no longer held in memory"""
+        if self.buffers and size > 0:
+            self.held_buffers -= size
+            self.buffers.release(size)
+
+    def release_buffers(self) -> None:
+        """Give back the room of every part, e.g. after a failed transfer"""
+        self.release_buffer(self.held_buffers)
+
+    async def _create_sender(self, dc_id: Optional[int] = None) -> MTProtoSender:
+        return await self.pool.acquire(dc_id or self.dc_id)
+
+    async def _fetch_part(self, sender: DownloadSender, part: int) -> bytes:
+        """Fetch one part, waiting out flood waits and retrying failures in place."""
+        attempt = 0
+        while True:
+            if self.cdn and sender.cdn is not self.cdn:
+                await self._move_to_cdn(sender)
+            # CDN DCs have flood waits of their own
+            dc_id = sender.dc_id
+            if self.rate_limiter:
+                await self.rate_limiter.acquire(dc_id)
+            connection = sender.sender
+            started = time.monotonic()
+            verifier = sender.cdn.verifier if sender.cdn else self.verifier
+            if verifier:
+                verifier.prepare(connection, part * sender.part_size, sender.part_size)
+            try:
+                data = await sender.fetch(part)
+                verified = not verifier or await verifier.verify(
+                    sender.sender, part * sender.part_size, data
+                )
+            except CdnRedirected as e:
+                await self._move_to_cdn(sender, e.redirect)
+                continue
+            except FLOOD_ERRORS as e:
+                if e.seconds > self.retry_policy.max_flood_wait:
+                    raise
+                attempt += 1
+                if attempt > self.retry_policy.attempts:
+                    raise
+                self.metrics.retries["flood_wait"].inc()
+                self.metrics.flood_wait_seconds.inc(e.seconds)
+                log.info(f"Flood wait of {e.seconds}s for DC {dc_id}")
+                if self.rate_limiter:
+                    # Pauses every transfer to this DC, not only this sender
+                    self.rate_limiter.flood_wait(dc_id, e.seconds)
+                else:
+                    await asyncio.sleep(e.seconds)
+                continue
+            except (*SERVER_ERRORS, *CONNECTION_ERRORS, CdnReuploadNeeded) as e:
+                attempt += 1
+                if attempt > self.retry_policy.attempts:
+                    raise
+                if isinstance(e, CONNECTION_ERRORS):
+                    self.metrics.retries["connection_error"].inc()
+                elif isinstance(e, CdnReuploadNeeded):
+                    self.metrics.retries["cdn_reupload"].inc()
+                else:
+                    self.metrics.retries["server_error"].inc()
+                log.debug(
+                    f"Part {part} failed ({type(e).__name__}: {e}), "
+                    f"retry {attempt}/{self.retry_policy.attempts}"
+                )
+                await asyncio.sleep(self.retry_policy.delay(attempt))
+                if isinstance(e, CONNECTION_ERRORS):
+                    try:
+                        await self._reconnect(sender, connection)
+                    except CONNECTION_ERRORS as reconnect_error:
+                        # The next attempt fails fast and tries again
+                        log.debug(
+                            f"Reconnecting to DC {dc_id} failed: {reconnect_error}"
+                        )
+                continue
+            if not verified:
+                # Only this part is requested again
+                attempt += 1
+                self.metrics.retries["hash_mismatch"].inc()
+                if attempt > self.retry_policy.attempts:
+                    raise HashMismatchError(
+                        f"Part {part} couldn't be verified by its hash"
+                    )
+                log.info(f"Part {part} doesn't match its hash, fetching it again")
+                continue
+            if self.rate_limiter:
+                self.rate_limiter.success(dc_id)
+            self.metrics.parts.inc()
+            self.metrics.bytes.inc(len(data))
+            self.metrics.latency.observe(time.monotonic() - started)
+            return data
+
+    async def _reconnect(self, sender: DownloadSender, failed: MTProtoSender) -> None:
+        """Replace the connection of ``sender``, unless another request already did."""
+        async with sender.lock:
+            if sender.sender is not failed:
+                return
+            if sender.shared:
+                sender.sender = await self.shared.replace(sender.dc_id, failed)
+                self.metrics.reconnects.inc()
+                return
+            # The broken connection stays leased until a new one is in place
+            replacement = await self.pool.acquire(sender.dc_id)
+            await self.pool.discard(sender.dc_id, failed)
+            sender.sender = replacement
+            self.metrics.reconnects.inc()
+
+    async def _move_to_cdn(
+        self, sender: DownloadSender, redirect: Optional[FileCdnRedirect] = None
+    ) -> None:
+        """Connect ``sender`` to the CDN DC the file was redirected to"""
+        async with self.cdn_lock:
+            if not self.cdn:
+                log.info(
+                    f"File on DC {self.dc_id} redirected to CDN DC {redirect.dc_id}"
+                )
+                await self.pool.add_cdn(redirect.dc_id)
+                self.cdn = CdnSource(
+                    redirect,
+                    self.file_size,
+                    self._call_master,
+                    self.executor or _get_writer_executor(),
+                )
+                self.metrics.cdn_redirects.inc()
+        async with sender.lock:
+            if sender.cdn is self.cdn:
+                return
+            previous = sender.sender
+            if sender.shared:
+                sender.sender = await self.shared.get(self.cdn.dc_id)
+            else:
+                sender.sender = await self.pool.acquire(self.cdn.dc_id)
+                # Requests still in flight on it complete all the same
+                self.pool.release(sender.dc_id, previous)
+            sender.dc_id = self.cdn.dc_id
+            sender.cdn = self.cdn
+
+    async def _call_master(self, request: TLRequest):
+        """Send ``request`` to the DC the file belongs to, for CDN hashes and reuploads"""
+        sender = await self.pool.acquire(self.dc_id)
+        try:
+            result = await sender.send(request)
+        except CONNECTION_ERRORS:
+            await self.pool.discard(self.dc_id, sender)
+            raise
+        except BaseException:
+            self.pool.release(self.dc_id, sender)
+            raise
+        self.pool.release(self.dc_id, sender)
+        return result
 
     async def init_upload(
         self,
@@ -282,50 +1108,315 @@ class ParallelTransferrer:
         connection_count: Optional[int] = None,
     ) -> Tuple[int, int, bool]:
         connection_count = connection_count or self._get_connection_count(file_size)
-        part_size = (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
+        part_size = int(
+            (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
+        )
         part_count = (file_size + part_size - 1) // part_size
         is_large = file_size > 10 * 1024 * 1024
-        await self._init_upload(connection_count, file_id, part_count, is_large)
+        connection_count = max(1, min(connection_count, part_count))
+        if self.budget:
+            connection_count = await self.budget.acquire(connection_count)
+        self.upload_connections = connection_count
+        try:
+            await self._init_upload(connection_count, file_id, part_count, is_large)
+        except BaseException:
+            await self.finish_upload(failed=True)
+            raise
         return part_size, part_count, is_large
 
     async def upload(self, part: bytes) -> None:
         await self.senders[self.upload_ticker].next(part)
         self.upload_ticker = (self.upload_ticker + 1) % len(self.senders)
+        self.metrics.uploaded_bytes.inc(len(part))
 
-    async def finish_upload(self) -> None:
-        await self._cleanup()
+    async def finish_upload(self, failed: bool = False) -> None:
+        try:
+            await self._cleanup(failed)
+        finally:
+            if self.budget:
+                await self.budget.release(self.upload_connections)
+            self.upload_connections = 0
 
-    async def download(
+    async def iter_parts(
         self,
         file: TypeLocation,
         file_size: int,
         part_size_kb: Optional[float] = None,
         connection_count: Optional[int] = None,
-    ) -> AsyncGenerator[bytes, None]:
+        window: int = 2,
+        parts: Optional[Iterable[int]] = None,
+        max_ahead: Optional[int] = None,
+        keep_buffers: bool = False,
+    ) -> AsyncGenerator[Tuple[int, bytes], None]:
+        """Yield ``(part_index, data)`` pairs in the order the parts arrive.
+
+        Every sender keeps ``window`` requests in flight and picks the next part
+        as soon as one of its own requests completes, so a slow connection only
+        delays its own parts. ``parts`` restricts the download to the given part
+        indices and ``max_ahead`` stops requesting parts that are more than that
+        many positions past the oldest part still outstanding.
+
+        With a buffer pool, every request first takes room for its part. The
+        room is given back when the next part is asked for, or with
+        ``keep_buffers`` by the caller through :meth:`release_buffer` once it
+        no longer holds the data.
+        """
         connection_count = connection_count or self._get_connection_count(file_size)
-        part_size = (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
-        part_count = math.ceil(file_size / part_size)
+        part_size = int(
+            (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
+        )
+        self.file_size = file_size
+        order = (
+            list(parts)
+            if parts is not None
+            else list(range(math.ceil(file_size / part_size)))
+        )
+        if not order:
+            return
+        total = len(order)
+        connection_count = min(connection_count, total) or 1
+        session = None
+        if self.tuner:
+            session = self.tuner.start(self.dc_id, part_size, total, connection_count)
+            connection_count = session.connections
+        # The caller's fair share, more only while nobody else needs the budget
+        share = connection_count
+        if self.budget:
+            connection_count = await self.budget.acquire(connection_count)
+        held_connections = connection_count
+        # Not granted at the start, taken as soon as the budget has them spare
+        missing = share - connection_count
         log.debug(
             "Starting parallel download: "
-            f"{connection_count} {part_size} {part_count} {file!s}"
+            f"{connection_count}x{window} {part_size} {total} {file!s}"
         )
-        await self._init_download(connection_count, file, part_count, part_size)
 
-        part = 0
-        while part < part_count:
-            tasks = []
+        next_position = 0
+        oldest_position = 0
+        finished = [False] * total
+        max_ahead = max_ahead or total
+        condition = asyncio.Condition()
+        max_connections = session.max_connections if session else connection_count
+        results: asyncio.Queue = asyncio.Queue(maxsize=max_connections * window)
+        workers: Dict[DownloadSender, List[asyncio.Task]] = {}
+        retiring: List[asyncio.Task] = []
+        # Room taken for parts that were not yielded yet
+        unclaimed = 0
+
+        async def fetch_parts(sender: DownloadSender) -> None:
+            nonlocal next_position, oldest_position, unclaimed
+            while True:
+                # Taken before a position, so the oldest part never waits for room
+                await self._take_buffer(part_size)
+                if self.buffers:
+                    unclaimed += part_size
+                async with condition:
+                    await condition.wait_for(
+                        lambda: sender.retired
+                        or next_position >= total
+                        or next_position < oldest_position + max_ahead
+                    )
+                    if sender.retired or next_position >= total:
+                        if self.buffers:
+                            unclaimed -= part_size
+                            self.release_buffer(part_size)
+                        return
+                    position = next_position
+                    next_position += 1
+                started = time.monotonic()
+                data = await self._fetch_part(sender, order[position])
+                if self.buffers:
+                    # The last part is shorter
+                    unclaimed -= part_size - len(data)
+                    self.release_buffer(part_size - len(data))
+                if session:
+                    session.record(len(data), time.monotonic() - started)
+                await results.put((order[position], data))
+                async with condition:
+                    finished[position] = True
+                    while oldest_position < total and finished[oldest_position]:
+                        oldest_position += 1
+                    condition.notify_all()
+
+        async def run_fetcher(sender: DownloadSender) -> None:
+            try:
+                await fetch_parts(sender)
+            except Exception as e:
+                await results.put((None, e))
+
+        def start_workers(sender: DownloadSender) -> None:
+            workers[sender] = [
+                self.loop.create_task(run_fetcher(sender)) for _ in range(window)
+            ]
+
+        async def retire_sender(sender: DownloadSender) -> None:
+            nonlocal held_connections
+            sender.retired = True
+            async with condition:
+                condition.notify_all()
+            # Its requests in flight still complete before it goes back to the pool
+            await asyncio.gather(*workers.pop(sender), return_exceptions=True)
+            self.senders.remove(sender)
+            await self._release_sender(sender, False)
+            held_connections -= 1
+            if self.budget:
+                await self.budget.release(1)
+
+        async def add_sender() -> bool:
+            """Add a connection if the budget has one spare"""
+            nonlocal held_connections
+            if self.budget and not self.budget.try_acquire(1):
+                return False
+            held_connections += 1
+            try:
+                sender = await self._create_download_sender(file, part_size)
+                self.senders.append(sender)
+                start_workers(sender)
+            except Exception as e:
+                log.debug(f"Could not add a connection to DC {self.dc_id}: {e}")
+                held_connections -= 1
+                if self.budget:
+                    await self.budget.release(1)
+            return True
+
+        async def tune_connections() -> None:
+            nonlocal missing
+            while True:
+                await asyncio.sleep(session.interval)
+                active = [sender for sender in self.senders if not sender.retired]
+                if self.budget and self.budget.waiting and len(active) > share:
+                    # Give back what was borrowed beyond the share
+                    for sender in active[share:]:
+                        retiring.append(self.loop.create_task(retire_sender(sender)))
+                    continue
+                if missing > 0 and next_position < total:
+                    while missing > 0 and await add_sender():
+                        missing -= 1
+                    continue
+                step = session.decide(len(active))
+                if step > 0 and next_position < total:
+                    await add_sender()
+                elif step < 0 and len(active) > 1:
+                    retiring.append(self.loop.create_task(retire_sender(active[-1])))
+
+        failed = False
+        tuner_task = None
+        started = time.monotonic()
+        received = 0
+        lent = 0
+        try:
+            await self._init_download(connection_count, file, part_size)
             for sender in self.senders:
-                tasks.append(self.loop.create_task(sender.next()))
-            for task in tasks:
-                data = await task
-                if not data:
-                    break
-                yield data
-                part += 1
+                start_workers(sender)
+            if session:
+                tuner_task = self.loop.create_task(tune_connections())
+            for _ in range(total):
+                part, data = await results.get()
+                if part is None:
+                    raise data
+                received += len(data)
+                if self.buffers:
+                    unclaimed -= len(data)
+                    lent = len(data)
+                yield part, data
+                if not keep_buffers:
+                    self.release_buffer(lent)
+                lent = 0
                 log.debug(f"Part {part} downloaded")
+            if session:
+                self.tuner.finish(session)
+            elapsed = time.monotonic() - started
+            if elapsed > 0:
+                self.metrics.file_throughput.observe(received / elapsed)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            if tuner_task:
+                tuner_task.cancel()
+                await asyncio.gather(tuner_task, return_exceptions=True)
+            for tasks in workers.values():
+                for worker in tasks:
+                    worker.cancel()
+            await asyncio.gather(
+                *[worker for tasks in workers.values() for worker in tasks],
+                *retiring,
+                return_exceptions=True,
+            )
+            log.debug("Parallel download finished, releasing connections")
+            self.release_buffer(unclaimed + (0 if keep_buffers else lent))
+            await self._cleanup(failed)
+            if self.budget:
+                await self.budget.release(held_connections)
 
-        log.debug("Parallel download finished, cleaning up connections")
-        await self._cleanup()
+    async def download_small(self, file: TypeLocation, file_size: int) -> bytes:
+        """Fetch a whole small file over the shared sender of its DC.
+
+        All parts are requested at once on that one connection, which skips the
+        setup of a parallel download and lets many small files share it.
+        """
+        started = time.monotonic()
+        self.file_size = file_size
+        # Given back by the caller with release_buffers() once it was written
+        await self._take_buffer(file_size)
+        sender = DownloadSender(
+            self.client,
+            await self.shared.get(self.dc_id),
+            file,
+            SMALL_PART_SIZE,
+            self.dc_id,
+            shared=True,
+            cdn_supported=self.use_cdn,
+        )
+        part_count = max(1, math.ceil(file_size / SMALL_PART_SIZE))
+        fetches = [
+            asyncio.create_task(self._fetch_part(sender, part))
+            for part in range(part_count)
+        ]
+        try:
+            parts = await asyncio.gather(*fetches)
+        finally:
+            # Stop the other requests of the file once one of them failed
+            for fetch in fetches:
+                fetch.cancel()
+            await asyncio.gather(*fetches, return_exceptions=True)
+        data = b"".join(parts)
+        elapsed = time.monotonic() - started
+        if elapsed > 0:
+            self.metrics.file_throughput.observe(len(data) / elapsed)
+        return data
+
+    async def download(
+        self,
+        file: TypeLocation,
+        file_size: int,
+        part_size_kb: Optional[float] = None,
+        connection_count: Optional[int] = None,
+        window: int = 2,
+    ) -> AsyncGenerator[bytes, None]:
+        """Like :meth:`iter_parts`, but reorders the parts into a byte stream."""
+        connection_count = connection_count or self._get_connection_count(file_size)
+        pending: Dict[int, bytes] = {}
+        next_part = 0
+        try:
+            # Parts waiting for an earlier one keep their room in the buffer pool
+            async for part, data in self.iter_parts(
+                file,
+                file_size,
+                part_size_kb,
+                connection_count,
+                window,
+                max_ahead=connection_count * window * 2,
+                keep_buffers=True,
+            ):
+                pending[part] = data
+                while next_part in pending:
+                    data = pending.pop(next_part)
+                    yield data
+                    self.release_buffer(len(data))
+                    next_part += 1
+        finally:
+            self.release_buffers()
 
 
 parallel_transfer_locks: DefaultDict[int, asyncio.Lock] = defaultdict(
@@ -333,50 +1424,134 @@ parallel_transfer_locks: DefaultDict[int, asyncio.Lock] = defaultdict(
 )
 
 
-def stream_file(file_to_stream: BinaryIO, chunk_size=1024):
-    while True:
-        data_read = file_to_stream.read(chunk_size)
-        if not data_read:
-            break
-        yield data_read
+def _read_part(
+    file: BinaryIO, offset: int, size: int, md5: Optional["hashlib._Hash"] = None
+) -> bytes:
+    """Read one whole part at ``offset``, also feeding it to ``md5`` if given."""
+    try:
+        fd = file.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        fd = None
+    if fd is not None and hasattr(os, "pread"):
+        data = os.pread(fd, size, offset)
+        # Only short at the end of the file or for special files
+        while len(data) < size:
+            more = os.pread(fd, size - len(data), offset + len(data))
+            if not more:
+                break
+            data += more
+    else:
+        file.seek(offset)
+        data = file.read(size)
+    if md5:
+        md5.update(data)
+    return data
+
+
+def _get_file_size(file: BinaryIO) -> int:
+    try:
+        return os.fstat(file.fileno()).st_size
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        position = file.tell()
+        size = file.seek(0, os.SEEK_END)
+        file.seek(position)
+        return size
 
 
 async def _internal_transfer_to_telegram(
-    client: TelegramClient, response: BinaryIO, progress_callback: callable
+    client: TelegramClient,
+    response: BinaryIO,
+    progress_callback: callable,
+    budget: Optional[ConnectionBudget] = None,
+    pool: Optional[SenderPool] = None,
+    connection_count: Optional[int] = None,
+    executor: Optional[ThreadPoolExecutor] = None,
 ) -> Tuple[TypeInputFile, int]:
     file_id = helpers.generate_random_long()
-    file_size = os.path.getsize(response.name)
+    file_size = _get_file_size(response)
+    name = os.path.basename(getattr(response, "name", "") or "upload")
 
+    # Only small files are sent with their MD5, big files skip hashing entirely
     hash_md5 = hashlib.md5()
-    uploader = ParallelTransferrer(client)
-    part_size, part_count, is_large = await uploader.init_upload(file_id, file_size)
-    buffer = bytearray()
-    for data in stream_file(response):
-        if progress_callback:
-            r = progress_callback(response.tell(), file_size)
-            if inspect.isawaitable(r):
-                await r
-        if not is_large:
-            hash_md5.update(data)
-        if len(buffer) == 0 and len(data) == part_size:
+    uploader = ParallelTransferrer(client, budget=budget, pool=pool)
+    part_size, part_count, is_large = await uploader.init_upload(
+        file_id, file_size, connection_count=connection_count
+    )
+    loop = asyncio.get_running_loop()
+    executor = executor or _get_writer_executor()
+
+    def read_part(part: int) -> Awaitable[bytes]:
+        # Whole parts are read and hashed in a thread, in order, one at a time
+        return loop.run_in_executor(
+            executor,
+            _read_part,
+            response,
+            part * part_size,
+            part_size,
+            None if is_large else hash_md5,
+        )
+
+    try:
+        next_part = read_part(0) if part_count else None
+        for part in range(part_count):
+            data = await next_part
+            # The next part is read while this one is being sent
+            if part + 1 < part_count:
+                next_part = read_part(part + 1)
             await uploader.upload(data)
-            continue
-        new_len = len(buffer) + len(data)
-        if new_len >= part_size:
-            cutoff = part_size - len(buffer)
-            buffer.extend(data[:cutoff])
-            await uploader.upload(bytes(buffer))
-            buffer.clear()
-            buffer.extend(data[cutoff:])
-        else:
-            buffer.extend(data)
-    if len(buffer) > 0:
-        await uploader.upload(bytes(buffer))
+            if progress_callback:
+                r = progress_callback(min((part + 1) * part_size, file_size), file_size)
+                if inspect.isawaitable(r):
+                    await r
+    except BaseException:
+        await uploader.finish_upload(failed=True)
+        raise
     await uploader.finish_upload()
     if is_large:
-        return InputFileBig(file_id, part_count, "upload"), file_size
+        return InputFileBig(file_id, part_count, name), file_size
     else:
-        return InputFile(file_id, part_count, "upload", hash_md5.hexdigest()), file_size
+        return InputFile(file_id, part_count, name, hash_md5.hexdigest()), file_size
+
+
+def _photo_size_bytes(size: Union[PhotoSize, PhotoSizeProgressive]) -> int:
+    return max(size.sizes) if isinstance(size, PhotoSizeProgressive) else size.size
+
+
+def get_media_location(media) -> Tuple[int, TypeLocation, int]:
+    """Get the DC, input location and size of a document or photo.
+
+    Photos are downloaded in their largest size. Sizes telegram sends inline
+    with the message, like stripped thumbnails, can't be requested.
+    """
+    if isinstance(media, MessageMediaDocument):
+        media = media.document
+    elif isinstance(media, MessageMediaPhoto):
+        media = media.photo
+    if isinstance(media, Photo):
+        sizes = [
+            size
+            for size in media.sizes
+            if isinstance(size, (PhotoSize, PhotoSizeProgressive))
+        ]
+        if not sizes:
+            raise ValueError(f"Photo {media.id} has no downloadable size")
+        largest = max(sizes, key=_photo_size_bytes)
+        location = InputPhotoFileLocation(
+            id=media.id,
+            access_hash=media.access_hash,
+            file_reference=media.file_reference,
+            thumb_size=largest.type,
+        )
+        return media.dc_id, location, _photo_size_bytes(largest)
+    dc_id, location = utils.get_input_location(media)
+    return dc_id, location, media.size
+
+
+def _write_whole(out: BinaryIO, data: bytes) -> None:
+    out.seek(0)
+    out.write(data)
+    out.truncate()
+    out.flush()
 
 
 async def download_file(
@@ -384,26 +1559,203 @@ async def download_file(
     location: TypeLocation,
     out: BinaryIO,
     progress_callback: callable = None,
+    budget: Optional[ConnectionBudget] = None,
+    connection_count: Optional[int] = None,
+    pool: Optional[SenderPool] = None,
+    window: int = 2,
+    checkpoint: Optional["DownloadCheckpoint"] = None,
+    executor: Optional[ThreadPoolExecutor] = None,
+    tuner: Optional["TransferTuner"] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    shared: Optional[SharedSenders] = None,
+    small_file_size: int = 4 * 1024 * 1024,
+    hasher: Optional["PartHasher"] = None,
+    verify: bool = False,
+    use_cdn: bool = False,
+    buffers: Optional["BufferPool"] = None,
 ) -> BinaryIO:
-    size = location.size
-    dc_id, location = utils.get_input_location(location)
-    # We lock the transfers because telegram has connection count limits
-    downloader = ParallelTransferrer(client, dc_id)
-    downloaded = downloader.download(location, size)
-    async for x in downloaded:
-        out.write(x)
+    """Download ``location`` into ``out``.
+
+    ``hasher`` is fed the downloaded data in file order, so the file doesn't
+    have to be read back to hash it. Parts a checkpoint already had on disk
+    are not fed to it. With ``verify`` every part is checked against the
+    hashes telegram has for the file before it is written. ``use_cdn`` lets
+    telegram send popular files from a CDN DC, whose parts are always checked.
+    Parts hold room in ``buffers`` from their request until they are written.
+    """
+    dc_id, location, size = get_media_location(location)
+    verifier = (
+        PartVerifier(location, size, executor or _get_writer_executor())
+        if verify
+        else None
+    )
+    # The budget is shared by every transfer because telegram has connection count limits
+    downloader = ParallelTransferrer(
+        client,
+        dc_id,
+        budget,
+        pool,
+        tuner,
+        rate_limiter,
+        retry_policy,
+        shared,
+        verifier,
+        use_cdn,
+        executor,
+        buffers,
+    )
+    if shared and size <= small_file_size:
+        # Too small to gain from parallel connections
+        try:
+            data = await downloader.download_small(location, size)
+            if hasher:
+                hasher.feed(0, data, executor or _get_writer_executor())
+            await asyncio.get_running_loop().run_in_executor(
+                executor or _get_writer_executor(), _write_whole, out, data
+            )
+            if checkpoint:
+                checkpoint.mark_all_done()
+        finally:
+            downloader.release_buffers()
+            if hasher:
+                await hasher.join()
         if progress_callback:
-            r = progress_callback(out.tell(), size)
+            r = progress_callback(len(data), size)
             if inspect.isawaitable(r):
                 await r
+        return out
+    if checkpoint:
+        return await _download_missing_parts(
+            downloader,
+            location,
+            size,
+            out,
+            checkpoint,
+            progress_callback,
+            connection_count,
+            window,
+            executor,
+            hasher,
+        )
+
+    downloaded = downloader.download(
+        location, size, connection_count=connection_count, window=window
+    )
+    part = 0
+    try:
+        async for x in downloaded:
+            out.write(x)
+            if hasher:
+                hasher.feed(part, x, executor or _get_writer_executor())
+                part += 1
+            if progress_callback:
+                r = progress_callback(out.tell(), size)
+                if inspect.isawaitable(r):
+                    await r
+    finally:
+        if hasher:
+            await hasher.join()
 
     return out
 
 
+async def _download_missing_parts(
+    downloader: ParallelTransferrer,
+    location: TypeLocation,
+    size: int,
+    out: BinaryIO,
+    checkpoint: "DownloadCheckpoint",
+    progress_callback: callable,
+    connection_count: Optional[int],
+    window: int,
+    executor: Optional[ThreadPoolExecutor],
+    hasher: Optional["PartHasher"] = None,
+) -> BinaryIO:
+    downloaded = checkpoint.downloaded_bytes
+    max_ahead = None
+    if checkpoint.done:
+        # The parts already on disk never pass through here
+        hasher = None
+    elif hasher:
+        # Bounds the parts the hasher holds until the ones before them arrive
+        max_ahead = (
+            (connection_count or downloader._get_connection_count(size)) * window * 4
+        )
+
+    def parts_synced(parts: List[int]) -> None:
+        for part in parts:
+            checkpoint.mark_done(part)
+        checkpoint.save()
+
+    writer = PositionalWriter(
+        out, size, executor or _get_writer_executor(), on_synced=parts_synced
+    )
+    await writer.preallocate()
+    try:
+        async for part, data in downloader.iter_parts(
+            location,
+            size,
+            part_size_kb=checkpoint.part_size / 1024,
+            connection_count=connection_count,
+            window=window,
+            parts=checkpoint.pending_parts,
+            max_ahead=max_ahead,
+            keep_buffers=True,
+        ):
+            await writer.write(
+                part * checkpoint.part_size,
+                data,
+                part,
+                on_written=partial(downloader.release_buffer, len(data)),
+            )
+            if hasher:
+                hasher.feed(part, data, writer.executor)
+            downloaded += len(data)
+            if progress_callback:
+                r = progress_callback(downloaded, size)
+                if inspect.isawaitable(r):
+                    await r
+        # Raises a failed write or fsync, close() stays quiet for aborts
+        await writer.sync()
+    finally:
+        # Whatever made it to disk is kept for the next attempt
+        await writer.close()
+        downloader.release_buffers()
+        if hasher:
+            await hasher.join()
+
+    return out
+
+
+_writer_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_writer_executor() -> ThreadPoolExecutor:
+    global _writer_executor
+    if _writer_executor is None:
+        _writer_executor = ThreadPoolExecutor(4, thread_name_prefix="part-writer")
+    return _writer_executor
+
+
 async def upload_file(
     client: TelegramClient,
     file: BinaryIO,
     progress_callback: callable = None,
+    budget: Optional[ConnectionBudget] = None,
+    pool: Optional[SenderPool] = None,
+    connection_count: Optional[int] = None,
+    executor: Optional[ThreadPoolExecutor] = None,
 ) -> TypeInputFile:
-    res = (await _internal_transfer_to_telegram(client, file, progress_callback))[0]
+    res = (
+        await _internal_transfer_to_telegram(
+            client,
+            file,
+            progress_callback,
+            budget,
+            pool,
+            connection_count,
+            executor,
+        )
+    )[0]
     return res
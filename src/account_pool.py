@@ -0,0 +1,125 @@
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+from telethon import TelegramClient, errors
+
+from src import metrics
+from src.FastTelethon import ConnectionBudget, SenderPool, SharedSenders
+from src.transfer_retry import CONNECTION_ERRORS, RateLimiter
+
+
+class AccountShard:
+    """One logged-in account with its own connections and flood wait state.
+
+    Telegram limits connections and requests per account, so every shard
+    gets a budget, sender pool and rate limiter of its own.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        client: TelegramClient,
+        pool: SenderPool,
+        budget: ConnectionBudget,
+        rate_limiter: RateLimiter,
+        shared_senders: Optional[SharedSenders] = None,
+        primary: bool = False,
+    ):
+        self.name = name
+        self.client = client
+        self.pool = pool
+        self.budget = budget
+        self.rate_limiter = rate_limiter
+        self.shared_senders = shared_senders or SharedSenders(pool, budget)
+        self.primary = primary
+        self.active = 0
+        self.files = 0
+        self.started = time.monotonic()
+        self.downloaded_bytes = metrics.account_bytes.labels(account=name)
+        self.active_downloads = metrics.account_active_downloads.labels(account=name)
+        self.failovers = metrics.account_failovers.labels(account=name)
+
+    def paused_for(self, dc_id: int) -> float:
+        """Seconds until this account may send requests to ``dc_id`` again"""
+        bucket = self.rate_limiter.buckets.get(dc_id)
+        return max(0.0, bucket.paused_until - time.monotonic()) if bucket else 0.0
+
+    def pause(self, dc_id: int, seconds: float):
+        self.rate_limiter.flood_wait(dc_id, seconds)
+        self.failovers.inc()
+
+    async def get_message(self, channel: str, message):
+        """Get ``message`` as this account sees it, file references are per account"""
+        if self.primary:
+            return message
+        try:
+            return await self.client.get_messages(channel, ids=message.id)
+        except (ValueError, errors.RPCError, *CONNECTION_ERRORS):
+            # E.g. a private channel this account didn't join
+            return None
+
+    def stats(self) -> Dict[str, object]:
+        elapsed = time.monotonic() - self.started
+        downloaded = self.downloaded_bytes.value
+        return {
+            "active": self.active,
+            "files": self.files,
+            "downloaded_bytes": int(downloaded),
+            "bytes_per_second": downloaded / elapsed if elapsed > 0 else 0.0,
+        }
+
+    async def close(self):
+        await self.shared_senders.close()
+        await self.pool.close()
+
+
+class AccountPool:
+    """Spreads downloads over the accounts by load and DC.
+
+    A download goes to the account with the fewest running downloads among
+    those not paused by a flood wait for its DC, preferring accounts that
+    are already authorized on that DC. Only when every account is paused
+    does it go to the one that can continue soonest.
+    """
+
+    def __init__(self, shards: List[AccountShard]):
+        self.shards = shards
+
+    @property
+    def primary(self) -> AccountShard:
+        return self.shards[0]
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def choose(self, dc_id: int) -> AccountShard:
+        ready = [shard for shard in self.shards if not shard.paused_for(dc_id)]
+        if not ready:
+            return min(self.shards, key=lambda shard: shard.paused_for(dc_id))
+        return min(
+            ready,
+            key=lambda shard: (
+                shard.active,
+                not shard.pool.is_authorized(dc_id),
+                self.shards.index(shard),
+            ),
+        )
+
+    def acquire(self, shard: AccountShard) -> AccountShard:
+        shard.active += 1
+        shard.active_downloads.inc()
+        return shard
+
+    def release(self, shard: AccountShard, downloaded: int = 0):
+        shard.active -= 1
+        shard.active_downloads.dec()
+        if downloaded:
+            shard.files += 1
+            shard.downloaded_bytes.inc(downloaded)
+
+    def stats(self) -> Dict[str, Dict[str, object]]:
+        return {shard.name: shard.stats() for shard in self.shards}
+
+    async def close(self):
+        await asyncio.gather(*[shard.close() for shard in self.shards])
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import sys
+from collections import deque
+from typing import Deque, Tuple
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+def current_rss() -> int:
+    """Get the resident memory of this process in bytes, 0 where unknown"""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def peak_rss() -> int:
+    """Get the highest resident memory of this process in bytes, 0 where unknown"""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes everywhere else
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class BufferPool:
+    """Fixed amount of memory for downloaded parts, shared by all transfers.
+
+    Telethon allocates every answer itself, so the pool hands out room for
+    parts instead of the buffers: a fetcher takes ``part_size`` bytes before
+    requesting a part and the room is given back once the part was written.
+    While the pool is full, fetchers wait in order, which stops the network
+    side until the writers catch up. With ``memory_limit`` they also wait
+    while the process uses more memory than that. One part can always be
+    taken from an empty pool, so a transfer never stalls completely.
+    """
+
+    def __init__(self, capacity: int, memory_limit: int = 0):
+        self.capacity = capacity
+        self.memory_limit = memory_limit
+        self.in_use = 0
+        self.peak = 0
+        self.waits = 0
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+
+    def _fits(self, size: int) -> bool:
+        if not self.in_use:
+            return True
+        if self.in_use + size > self.capacity:
+            return False
+        return not self.memory_limit or current_rss() <= self.memory_limit
+
+    def _take(self, size: int):
+        self.in_use += size
+        self.peak = max(self.peak, self.in_use)
+
+    async def acquire(self, size: int):
+        """Wait until there is room for ``size`` bytes and take it"""
+        if not self._waiters and self._fits(size):
+            self._take(size)
+            return
+        self.waits += 1
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((size, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just before the cancellation
+                self.release(size)
+            else:
+                self._wake()
+            raise
+
+    def release(self, size: int):
+        if size <= 0:
+            return
+        self.in_use -= size
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            size, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if not self._fits(size):
+                return
+            self._waiters.popleft()
+            self._take(size)
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "in_use": self.in_use,
+            "peak": self.peak,
+            "waits": self.waits,
+            "waiting": sum(not future.done() for _, future in self._waiters),
+        }
@@ -0,0 +1,134 @@
+import asyncio
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+from telethon import TelegramClient
+from telethon.tl.types import (
+    DocumentAttributeAnimated,
+    DocumentAttributeAudio,
+    DocumentAttributeSticker,
+    DocumentAttributeVideo,
+    MessageMediaDocument,
+)
+
+from src import metrics
+from src.FastTelethon import ParallelTransferrer, upload_file
+from src.startup_cache import resolve_channel
+
+if TYPE_CHECKING:
+    from src.download_manager import DownloadResources
+
+# Documents with these attributes are sent as media, everything else as a file
+MEDIA_ATTRIBUTES = (
+    DocumentAttributeAnimated,
+    DocumentAttributeAudio,
+    DocumentAttributeSticker,
+    DocumentAttributeVideo,
+)
+
+
+class ChannelMirror:
+    """Re-uploads downloaded media to ``target`` while downloads continue.
+
+    Finished downloads are handed over with :meth:`submit`, which only waits
+    when ``queue_size`` files are already waiting, and ``uploads`` workers send
+    them through the parallel uploader on the connections the downloads use.
+    Uploaded messages are recorded in the manifest so they are sent only once.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        target: str,
+        resources: "DownloadResources",
+        uploads: int = 2,
+        connections_per_file: int = 4,
+        queue_size: Optional[int] = None,
+    ):
+        self.client = client
+        self.target = target
+        self.resources = resources
+        self.uploads = max(1, uploads)
+        self.connections_per_file = connections_per_file
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size or self.uploads * 2)
+        self.workers: List[asyncio.Task] = []
+        self.entity = None
+
+    async def start(self):
+        self.entity, _ = await resolve_channel(
+            self.client, self.target, self.resources.startup_cache
+        )
+        self.workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.uploads)
+        ]
+
+    def get_pending(self, channel: str, message_ids: List[int]) -> List[int]:
+        """Get which of ``message_ids`` were not uploaded to the target yet"""
+        if not message_ids:
+            return []
+        mirrored = self.resources.manifest.get_mirrored(
+            channel, message_ids, self.target
+        )
+        return [message_id for message_id in message_ids if message_id not in mirrored]
+
+    async def submit(self, channel: str, message, path: str):
+        await self.queue.put((channel, message, path))
+
+    async def join(self):
+        await self.queue.join()
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def _worker(self):
+        while True:
+            channel, message, path = await self.queue.get()
+            try:
+                await self.upload(channel, message, path)
+                metrics.files.labels(channel=channel, result="mirrored").inc()
+            except Exception as e:
+                # Not recorded, so the next run tries again. Any error is caught,
+                # a dead worker would leave submit() waiting on a full queue
+                metrics.files.labels(channel=channel, result="mirror_failed").inc()
+                print(f"Failed to mirror {path}: {type(e).__name__} - {e}")
+            finally:
+                self.queue.task_done()
+
+    async def upload(self, channel: str, message, path: str):
+        with open(path, "rb") as file:
+            input_file = await upload_file(
+                self.client,
+                file,
+                budget=self.resources.connection_budget,
+                pool=self.resources.sender_pool,
+                connection_count=ParallelTransferrer._get_connection_count(
+                    message.file.size, max_count=self.connections_per_file
+                ),
+                executor=self.resources.writer_executor,
+            )
+        attributes, mime_type, force_document = self.get_media_options(message)
+        sent = await self.client.send_file(
+            self.entity,
+            input_file,
+            caption=message.message or None,
+            formatting_entities=message.entities,
+            attributes=attributes,
+            mime_type=mime_type,
+            force_document=force_document,
+        )
+        self.resources.manifest.record_mirror(channel, message.id, self.target, sent.id)
+        print(f"Mirrored: {path}")
+
+    @staticmethod
+    def get_media_options(message) -> Tuple[Optional[list], Optional[str], bool]:
+        """Get the attributes, MIME type and document flag of the original media"""
+        if not isinstance(message.media, MessageMediaDocument):
+            # Photos are recognised from the extension of the uploaded file
+            return None, None, False
+        document = message.media.document
+        force_document = not any(
+            isinstance(attribute, MEDIA_ATTRIBUTES) for attribute in document.attributes
+        )
+        return document.attributes, document.mime_type, force_document
@@ -0,0 +1,260 @@
+import asyncio
+from functools import partial
+from typing import Dict, Optional, Set
+
+from telethon import TelegramClient, errors, events, utils
+
+from src.config import settings
+from src.download_manager import DownloadManager
+from src.download_scheduler import DownloadScheduler
+from src.message_filters import get_message_filters, iter_filtered_messages
+from src.startup_cache import StartupCache, resolve_channel
+from src.transfer_retry import CONNECTION_ERRORS, RetryPolicy
+
+
+class ChannelWatcher:
+    """Downloads media posted to the channels for as long as it runs.
+
+    A catch-up scan from the last processed message comes first, after that
+    new messages arrive as events. They wait in a queue of ``queue_size``
+    messages; while it is full, new messages are not kept but fetched again
+    by a scan once there is room, so a burst can't grow memory without bound.
+    The last processed message of a channel only moves past messages whose
+    download finished, so a restart continues where this run stopped.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        download_managers: Dict[str, DownloadManager],
+        scheduler: DownloadScheduler,
+        queue_size: int = 1000,
+        drain_timeout: float = 60.0,
+        reconnect_policy: Optional[RetryPolicy] = None,
+        cache: Optional[StartupCache] = None,
+    ):
+        self.client = client
+        self.cache = cache
+        self.download_managers = download_managers
+        self.scheduler = scheduler
+        self.drain_timeout = drain_timeout
+        self.reconnect_policy = reconnect_policy or RetryPolicy(max_delay=60)
+        self.queue: asyncio.Queue = asyncio.Queue(max(1, queue_size))
+        self.message_filters = get_message_filters(
+            settings.ALLOWED_FORMATS, settings.DOWNLOAD_ALL
+        )
+        self.entities: Dict[str, object] = {}
+        self.channels_by_peer: Dict[int, str] = {}
+        # Queued or downloading message IDs, and the highest one seen, per channel
+        self.pending: Dict[str, Set[int]] = {}
+        self.highest: Dict[str, int] = {}
+        # Channels that need a scan for messages newer than the given ID
+        self.rescan_from: Dict[str, int] = {}
+        self.rescan_needed = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.event_filter: Optional[events.NewMessage] = None
+        self.feed_task: Optional[asyncio.Task] = None
+        self.catch_up_task: Optional[asyncio.Task] = None
+
+    def stop(self):
+        """Stop taking new messages and finish the queued ones, e.g. on SIGTERM"""
+        if not self.stopping.is_set():
+            print("Stopping, finishing queued downloads...")
+            self.stopping.set()
+
+    async def run(self):
+        for channel in self.download_managers:
+            try:
+                entity, _ = await resolve_channel(self.client, channel, self.cache)
+            except (ValueError, errors.RPCError) as e:
+                print(f"Skipping {channel}: {type(e).__name__} - {e}")
+                continue
+            self.entities[channel] = entity
+            self.channels_by_peer[utils.get_peer_id(entity)] = channel
+            self.pending[channel] = set()
+            manifest = self.download_managers[channel].manifest
+            self.highest[channel] = manifest.get_last_message_id(channel)
+            self.rescan_from[channel] = self.highest[channel]
+        if not self.entities:
+            return
+
+        self.event_filter = events.NewMessage(
+            chats=list(self.entities.values()),
+            func=lambda event: event.message.media is not None,
+        )
+        self.client.add_event_handler(self._on_new_message, self.event_filter)
+        self.feed_task = asyncio.create_task(self._feed())
+        self.catch_up_task = asyncio.create_task(self._catch_up())
+        for channel in self.entities:
+            await self._queue_unfinished(channel)
+        self.rescan_needed.set()
+        print(f"Watching {', '.join(self.entities)} for new media")
+        try:
+            await self._supervise()
+        finally:
+            self.client.remove_event_handler(self._on_new_message, self.event_filter)
+            await self._drain()
+
+    async def _queue_unfinished(self, channel: str):
+        """Queue downloads an earlier run started but didn't finish"""
+        manifest = self.download_managers[channel].manifest
+        message_ids = manifest.get_unfinished_message_ids(channel)
+        if not message_ids:
+            return
+        for message in await self.client.get_messages(
+            self.entities[channel], ids=message_ids
+        ):
+            if message and message.media:
+                await self._put(channel, message)
+
+    async def _on_new_message(self, event):
+        channel = self.channels_by_peer.get(event.chat_id)
+        if channel is None or self.stopping.is_set():
+            return
+        message = event.message
+        if message.id in self.pending[channel]:
+            return
+        if self.queue.full():
+            # Fetched again by a scan once the downloads caught up
+            self._request_rescan(channel, message.id - 1)
+            return
+        self._track(channel, message.id)
+        self.queue.put_nowait((channel, message))
+
+    async def _put(self, channel: str, message):
+        if message.id in self.pending[channel]:
+            return
+        self._track(channel, message.id)
+        await self.queue.put((channel, message))
+
+    def _track(self, channel: str, message_id: int):
+        self.pending[channel].add(message_id)
+        self.highest[channel] = max(self.highest[channel], message_id)
+
+    def _request_rescan(self, channel: str, min_id: int):
+        self.rescan_from[channel] = min(self.rescan_from.get(channel, min_id), min_id)
+        self.rescan_needed.set()
+
+    def get_watermark(self, channel: str) -> int:
+        """Get the highest message ID up to which every message was processed"""
+        watermark = self.highest[channel]
+        if self.pending[channel]:
+            watermark = min(self.pending[channel]) - 1
+        if channel in self.rescan_from:
+            watermark = min(watermark, self.rescan_from[channel])
+        return watermark
+
+    def _finished(self, channel: str, message_id: int):
+        self.pending[channel].discard(message_id)
+        self._save_watermark(channel)
+
+    def _save_watermark(self, channel: str):
+        manifest = self.download_managers[channel].manifest
+        manifest.set_last_message_id(channel, self.get_watermark(channel))
+
+    async def _feed(self):
+        """Hand queued messages to the scheduler, which waits while it is full"""
+        while True:
+            channel, message = await self.queue.get()
+            try:
+                manager = self.download_managers[channel]
+                if manager.select_downloads([message]):
+                    await self.scheduler.submit(
+                        manager, message, partial(self._on_result, channel)
+                    )
+                else:
+                    self._finished(channel, message.id)
+            finally:
+                self.queue.task_done()
+
+    def _on_result(self, channel: str, message, success: bool, result: str):
+        self._finished(channel, message.id)
+        if success:
+            print(f"Downloaded: {result}")
+        elif "not allowed" in result and settings.DEBUG:
+            print(result)
+
+    async def _catch_up(self):
+        while True:
+            await self.rescan_needed.wait()
+            self.rescan_needed.clear()
+            for channel, min_id in list(self.rescan_from.items()):
+                if not await self._scan(channel, min_id):
+                    return
+                # Unless more messages were dropped while scanning
+                if self.rescan_from.get(channel) == min_id:
+                    del self.rescan_from[channel]
+                self._save_watermark(channel)
+
+    async def _scan(self, channel: str, min_id: int) -> bool:
+        """Queue the messages after ``min_id``, ``False`` if stopped before the end"""
+        if min_id:
+            options = {"min_id": min_id, "reverse": True}
+        else:
+            # Never processed, start like a normal run
+            options = {
+                "limit": settings.HISTORY_LIMIT,
+                "reverse": settings.REVERSE_ORDER,
+            }
+        async for message in iter_filtered_messages(
+            self.client, self.entities[channel], self.message_filters, **options
+        ):
+            if self.stopping.is_set():
+                return False
+            await self._put(channel, message)
+        return True
+
+    async def _supervise(self):
+        """Wait for a stop, reconnecting whenever telethon gave up on the connection"""
+        stop = asyncio.ensure_future(self.stopping.wait())
+        try:
+            while not self.stopping.is_set():
+                await asyncio.wait(
+                    [stop, self.client.disconnected],
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if self.stopping.is_set():
+                    return
+                print("Disconnected from telegram, reconnecting...")
+                if await self._reconnect():
+                    # Events sent while disconnected are fetched by a scan
+                    for channel in self.entities:
+                        self._request_rescan(channel, self.get_watermark(channel))
+        finally:
+            stop.cancel()
+
+    async def _reconnect(self) -> bool:
+        attempt = 0
+        while not self.stopping.is_set():
+            try:
+                await self.client.connect()
+                if self.client.is_connected():
+                    print("Reconnected")
+                    return True
+            except CONNECTION_ERRORS as e:
+                print(f"Reconnecting failed: {type(e).__name__} - {e}")
+            attempt += 1
+            try:
+                await asyncio.wait_for(
+                    self.stopping.wait(), self.reconnect_policy.delay(attempt)
+                )
+            except asyncio.TimeoutError:
+                pass
+        return False
+
+    async def _drain(self):
+        """Finish queued and running downloads, up to ``drain_timeout`` seconds"""
+        # No new messages, but the feeder keeps handing the queued ones over
+        self.catch_up_task.cancel()
+        await asyncio.gather(self.catch_up_task, return_exceptions=True)
+        try:
+            await asyncio.wait_for(self._join(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            print("Stopped before every download finished, they resume on the next run")
+        finally:
+            self.feed_task.cancel()
+            await asyncio.gather(self.feed_task, return_exceptions=True)
+
+    async def _join(self):
+        await self.queue.join()
+        await self.scheduler.join()
@@ -1,6 +1,7 @@
 from functools import lru_cache
 from pathlib import Path
 
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 # Get the project root directory
@@ -11,7 +12,10 @@ class Settings(BaseSettings):
     API_ID: int
     API_HASH: str
     PHONE_NUMBER: str
-    CHANNEL_USERNAME: str
+    SESSION_FILES: list[str] = []  # More logged-in accounts that share the downloads
+    CHANNEL_USERNAME: str = ""  # Single channel to download from
+    CHANNEL_USERNAMES: list[str] = []  # Several channels downloaded in one run
+    CHANNELS_FILE: str = ""  # File with one channel per line, # starts a comment
     ALLOWED_FORMATS: list[str] = [
         "mp3",  # MPEG Audio Layer III
         "wav",  # Waveform Audio File Format
@@ -29,15 +33,105 @@ class Settings(BaseSettings):
         ""  # Base directory for downloads, empty means use PROJECT_ROOT
     )
     MAX_RETRIES: int = 3  # Number of retries for failed downloads
+    PART_RETRIES: int = 5  # Retries of a single part before its download fails
+    MAX_FLOOD_WAIT: int = 300  # Longest flood wait in seconds that is waited out
+    REQUESTS_PER_SECOND: float = 100.0  # Part requests per DC and second, 0 for no limit
+    MAX_CONCURRENT_DOWNLOADS: int = 4  # Number of files downloaded at the same time
+    MAX_CONNECTIONS: int = 20  # Connections shared by all running downloads
+    POOL_IDLE_TIMEOUT: float = 60.0  # Seconds before an unused pooled connection is closed
+    PIPELINE_WINDOW: int = 2  # Part requests kept in flight on every connection
+    SMALL_FILE_SIZE: int = 4  # Files up to this many MB share one connection per DC
+    VERIFY_PARTS: bool = True  # Check every part against telegram's SHA-256 hashes
+    CDN_DOWNLOADS: bool = True  # Fetch popular files from CDN DCs, needs cryptography
+    WRITER_THREADS: int = 4  # Threads writing downloaded parts to disk
+    BUFFER_POOL_SIZE: int = 256  # MB of downloaded parts held in memory by all downloads
+    MEMORY_LIMIT: int = 0  # Stop fetching parts while the process uses more MB, 0 for no limit
+    ADAPTIVE_TUNING: bool = True  # Learn connection count and part size per DC
+    TUNING_STATE_PATH: str = ""  # Learned settings, empty means inside the base directory
+    MANIFEST_PATH: str = ""  # Manifest database, empty means inside the base directory
+    STARTUP_CACHE_PATH: str = ""  # Resolved channels, DCs and auth keys, empty means inside the base directory
+    STARTUP_CACHE: bool = True  # Reuse what earlier runs resolved instead of asking telegram again
+    ENTITY_CACHE_TTL: float = 24.0  # Hours a resolved channel is reused before resolving it again
+    INCREMENTAL_SYNC: bool = False  # Only fetch messages newer than the last processed one
+    DEDUP_VERIFY_HASH: bool = False  # Check the SHA-256 of a local copy before linking it
+    POST_PROCESS_WORKERS: int = 2  # Processes hashing files and running hooks after downloads
+    METADATA_SIDECARS: bool = False  # Write <file>.json with the hash, caption and audio tags
+    POST_PROCESS_HOOKS: list[str] = []  # module:function called with each file's path and metadata
+    METRICS_PORT: int = 0  # Serve Prometheus metrics on this local port, 0 to disable
+    METRICS_HOST: str = "127.0.0.1"  # Address the metrics server listens on
+    METRICS_FILE: str = ""  # Write a JSON snapshot of the metrics here, empty to disable
+    METRICS_INTERVAL: float = 10.0  # Seconds between JSON snapshots
+    MIRROR_TO: str = ""  # Re-upload downloaded media to this channel, empty to disable
+    MIRROR_UPLOADS: int = 2  # Files uploaded to the mirror channel at the same time
+    SERVE_HOST: str = "127.0.0.1"  # Address of the media streaming server
+    SERVE_PORT: int = 8080  # Port of the media streaming server
+    STREAM_CACHE_PATH: str = ""  # Block cache of the server, empty means inside the base directory
+    STREAM_CACHE_SIZE: int = 1024  # Size limit of the block cache in MB
+    STREAM_READ_AHEAD: int = 8  # Blocks of 1 MB fetched ahead of a reader
+    HEADLESS: bool = False  # No progress display, for daemon and cron runs
+    WATCH_QUEUE_SIZE: int = 1000  # New messages buffered in watch mode before falling back to a scan
+    WATCH_DRAIN_TIMEOUT: float = 60.0  # Seconds a stopping watcher waits for running downloads
+    PROGRESS_ROWS: int = 10  # Downloads shown in the progress display
     DEBUG: bool = False  # Enable debug mode
     HISTORY_LIMIT: int = 100  # Number of messages to retrieve
     REVERSE_ORDER: bool = False  # Get messages in reverse order False=newest to oldest, True=oldest to newest
 
+    @property
+    def BASE_DIR(self) -> Path:
+        """Get the base directory that holds every channel directory"""
+        return Path(self.OUTPUT_BASE_DIR) if self.OUTPUT_BASE_DIR else PROJECT_ROOT
+
+    @property
+    def CHANNELS(self) -> list[str]:
+        """Get every configured channel, in order and without duplicates"""
+        channels = [self.CHANNEL_USERNAME, *self.CHANNEL_USERNAMES]
+        if self.CHANNELS_FILE:
+            for line in Path(self.CHANNELS_FILE).read_text().splitlines():
+                channels.append(line.split("#", 1)[0].strip())
+        return list(dict.fromkeys(channel for channel in channels if channel))
+
     @property
     def OUTPUT_DIR(self) -> Path:
-        """Get the output directory path for downloaded media"""
-        base_dir = Path(self.OUTPUT_BASE_DIR) if self.OUTPUT_BASE_DIR else PROJECT_ROOT
-        return base_dir / f"{self.CHANNEL_USERNAME}_media"
+        """Get the output directory path for downloaded media of the first channel"""
+        return self.get_output_dir(self.CHANNELS[0])
+
+    def get_output_dir(self, channel: str) -> Path:
+        """Get the output directory path for downloaded media of a channel"""
+        return self.BASE_DIR / f"{channel}_media"
+
+    @property
+    def MANIFEST_FILE(self) -> Path:
+        """Get the path of the SQLite download manifest"""
+        if self.MANIFEST_PATH:
+            return Path(self.MANIFEST_PATH)
+        return self.BASE_DIR / "download_manifest.sqlite3"
+
+    @property
+    def STREAM_CACHE_DIR(self) -> Path:
+        """Get the directory of the streaming server's block cache"""
+        if self.STREAM_CACHE_PATH:
+            return Path(self.STREAM_CACHE_PATH)
+        return self.BASE_DIR / ".stream_cache"
+
+    @property
+    def TUNING_STATE_FILE(self) -> Path:
+        """Get the path of the learned per-DC transfer settings"""
+        if self.TUNING_STATE_PATH:
+            return Path(self.TUNING_STATE_PATH)
+        return self.BASE_DIR / "transfer_tuning.json"
+
+    @property
+    def STARTUP_CACHE_FILE(self) -> Path:
+        """Get the path of the cache of resolved channels, DCs and auth keys"""
+        if self.STARTUP_CACHE_PATH:
+            return Path(self.STARTUP_CACHE_PATH)
+        return self.BASE_DIR / "startup_cache.json"
+
+    @model_validator(mode="after")
+    def check_channels(self) -> "Settings":
+        if not self.CHANNELS:
+            raise ValueError("Set CHANNEL_USERNAME, CHANNEL_USERNAMES or CHANNELS_FILE")
+        return self
 
     model_config = SettingsConfigDict(
         env_file=str(PROJECT_ROOT / ".env"), env_ignore_empty=True, extra="ignore"
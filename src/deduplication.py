@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import Executor
+from typing import Deque, Dict, Optional, Tuple
+
+# ioctl request that makes a file share the extents of another one (Linux)
+FICLONE = 0x40049409
+
+
+def _reflink(source: str, target: str):
+    import fcntl
+
+    with open(source, "rb") as source_file, open(target, "wb") as target_file:
+        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+
+
+def link_file(source: str, target: str) -> str:
+    """Make ``target`` hold the content of ``source`` without copying it if possible.
+
+    Tries a hardlink, then a reflink, and only copies the bytes as a last
+    resort. Returns the method that was used.
+    """
+    try:
+        os.link(source, target)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        _reflink(source, target)
+        return "reflink"
+    except (ImportError, OSError):
+        if os.path.exists(target):
+            os.remove(target)
+    shutil.copyfile(source, target)
+    return "copy"
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class PartHasher:
+    """SHA-256 of a file that is fed its parts in any order while they are written.
+
+    Parts that arrive before the ones preceding them are kept until the gap is
+    filled, so the caller should bound how far ahead parts can be downloaded.
+    :meth:`feed` hashes on an executor instead of the event loop, one part
+    at a time, and :meth:`join` waits until everything fed was hashed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued: Deque[Tuple[int, bytes]] = deque()
+        self.draining = False
+        self.drained: Optional[asyncio.Future] = None
+        self.reset()
+
+    def reset(self):
+        """Start over, e.g. for another attempt at the same download"""
+        self.sha256 = hashlib.sha256()
+        self.next_part = 0
+        self.hashed_bytes = 0
+        self.waiting: Dict[int, bytes] = {}
+
+    def feed(self, part: int, data: bytes, executor: Executor):
+        with self.lock:
+            self.queued.append((part, data))
+            if self.draining:
+                return
+            self.draining = True
+        self.drained = asyncio.get_running_loop().run_in_executor(executor, self._drain)
+
+    async def join(self):
+        if self.drained:
+            await self.drained
+
+    def _drain(self):
+        while True:
+            with self.lock:
+                if not self.queued:
+                    self.draining = False
+                    return
+                part, data = self.queued.popleft()
+            try:
+                self.update(part, data)
+            except BaseException:
+                with self.lock:
+                    self.queued.clear()
+                    self.draining = False
+                raise
+
+    def update(self, part: int, data: bytes):
+        if part != self.next_part:
+            self.waiting[part] = data
+            return
+        while data is not None:
+            self.sha256.update(data)
+            self.hashed_bytes += len(data)
+            self.next_part += 1
+            data = self.waiting.pop(self.next_part, None)
+
+    def hexdigest(self, file_size: int) -> Optional[str]:
+        """Get the hash, ``None`` unless all ``file_size`` bytes were fed in"""
+        if self.hashed_bytes != file_size:
+            return None
+        return self.sha256.hexdigest()
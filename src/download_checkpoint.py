@@ -0,0 +1,122 @@
+import json
+import os
+from typing import List, Optional, Set
+
+from telethon import utils
+
+
+class DownloadCheckpoint:
+    """Part-level progress of a download that is written to ``<file>.part``.
+
+    Finished part indices are recorded in a ``<file>.part.json`` sidecar, so a
+    retry or a later run only requests the parts that are still missing. The
+    sidecar is only saved after the partial file has been flushed to disk, and
+    the partial file is renamed to its final name once every part is there.
+    """
+
+    def __init__(self, filepath: str, document_id: int, file_size: int, part_size: int):
+        self.filepath = filepath
+        self.partial_path = f"{filepath}.part"
+        self.state_path = f"{filepath}.part.json"
+        self.document_id = document_id
+        self.file_size = file_size
+        self.part_size = part_size
+        self.done: Set[int] = set()
+
+    @classmethod
+    def load(
+        cls,
+        filepath: str,
+        document_id: int,
+        file_size: int,
+        part_size: Optional[int] = None,
+    ) -> "DownloadCheckpoint":
+        """Resume the sidecar of ``filepath`` if it belongs to the same document.
+
+        ``part_size`` is only used for a new download, a resumed one keeps the
+        part size its finished parts were written with.
+        """
+        part_size = part_size or utils.get_appropriated_part_size(file_size) * 1024
+        checkpoint = cls(filepath, document_id, file_size, part_size)
+        try:
+            with open(checkpoint.state_path) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return checkpoint
+
+        if (
+            state.get("document_id") == document_id
+            and state.get("file_size") == file_size
+            and os.path.exists(checkpoint.partial_path)
+        ):
+            checkpoint.part_size = state["part_size"]
+            checkpoint.done = set(state.get("done", []))
+        return checkpoint
+
+    @property
+    def part_count(self) -> int:
+        return (self.file_size + self.part_size - 1) // self.part_size
+
+    @property
+    def pending_parts(self) -> List[int]:
+        return [part for part in range(self.part_count) if part not in self.done]
+
+    @property
+    def downloaded_bytes(self) -> int:
+        downloaded = len(self.done) * self.part_size
+        last_part = self.part_count - 1
+        if last_part in self.done:
+            downloaded -= last_part * self.part_size + self.part_size - self.file_size
+        return downloaded
+
+    @property
+    def is_complete(self) -> bool:
+        return len(self.done) == self.part_count
+
+    def open(self):
+        """Open the partial file for positional writes, keeping finished parts."""
+        if os.path.exists(self.partial_path):
+            if self.done:
+                return open(self.partial_path, "r+b")
+        elif self.done:
+            # Completed or removed since, the finished parts are gone with it
+            self.done.clear()
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+        return open(self.partial_path, "wb")
+
+    def mark_done(self, part: int):
+        self.done.add(part)
+
+    def mark_all_done(self):
+        """For a file that was written in one piece"""
+        self.done = set(range(self.part_count))
+
+    def save(self):
+        state = {
+            "document_id": self.document_id,
+            "file_size": self.file_size,
+            "part_size": self.part_size,
+            "done": sorted(self.done),
+        }
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(state, file)
+        os.replace(temp_path, self.state_path)
+
+    def complete(self):
+        """Atomically move the finished partial file to its final name."""
+        size = (
+            os.path.getsize(self.partial_path)
+            if os.path.exists(self.partial_path)
+            else None
+        )
+        if not self.is_complete or size != self.file_size:
+            raise ValueError(
+                f"{self.partial_path} is incomplete: {len(self.done)} of "
+                f"{self.part_count} parts, {size} of {self.file_size} bytes"
+            )
+        os.replace(self.partial_path, self.filepath)
+        self.done.clear()
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
@@ -1,111 +1,431 @@
 import asyncio
 import os
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
-from typing import Optional, Tuple
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
 from rich.progress import Progress
-from telethon import TelegramClient
+from telethon import TelegramClient, errors, utils
 from telethon.tl.types import (
     DocumentAttributeFilename,
     MessageMediaDocument,
     MessageMediaPhoto,
 )
 
+from src import metrics
+from src.account_pool import AccountPool, AccountShard
+from src.buffer_pool import BufferPool, peak_rss
 from src.config import settings
+from src.deduplication import PartHasher, hash_file, link_file
+from src.download_checkpoint import DownloadCheckpoint
+from src.download_manifest import (
+    STATUS_COMPLETED,
+    STATUS_DOWNLOADING,
+    STATUS_FAILED,
+    DownloadManifest,
+    ManifestEntry,
+)
+from src.download_plan import (
+    ACTION_DOWNLOAD,
+    ACTION_FILTERED,
+    ACTION_LINK,
+    ACTION_PRESENT,
+    PlannedFile,
+)
 from src.download_statistics import DownloadStatistics
-from src.FastTelethon import download_file
+from src.FastTelethon import (
+    ConnectionBudget,
+    ParallelTransferrer,
+    SenderPool,
+    SharedSenders,
+    download_file,
+    get_media_location,
+)
+from src.startup_cache import StartupCache
+from src.startup_profile import profile
+from src.transfer_retry import FLOOD_ERRORS, RateLimiter, RetryPolicy
+from src.transfer_tuner import TransferTuner
+
+if TYPE_CHECKING:
+    from src.channel_mirror import ChannelMirror
+    from src.post_processing import PostProcessor
+
+
+def get_file_extension(message) -> str:
+    if isinstance(message.media, MessageMediaPhoto):
+        return ".jpg"
+    elif isinstance(message.media, MessageMediaDocument):
+        for attr in message.media.document.attributes:
+            if isinstance(attr, DocumentAttributeFilename):
+                return f".{attr.file_name.split('.')[-1]}"
+
+        # Fallback to mime type if available
+        mime_type = getattr(message.media.document, "mime_type", "")
+        if "image" in mime_type:
+            return ".jpg"
+        elif "audio" in mime_type:
+            return ".mp3"
+        elif "video" in mime_type:
+            return ".mp4"
+    return ".unknown"
+
+
+def get_file_name(message) -> str:
+    """Get the original filename from a message"""
+    if isinstance(message.media, MessageMediaDocument):
+        for attr in message.media.document.attributes:
+            if isinstance(attr, DocumentAttributeFilename):
+                return attr.file_name
+    # Fallback to message ID with extension
+    return f"{message.id}{get_file_extension(message)}"
+
+
+def is_allowed_format(
+    filename: str, allowed_formats: List[str], download_all: bool
+) -> bool:
+    if download_all:
+        return True
+    ext = os.path.splitext(filename)[1].lstrip(".").lower()
+    return ext in allowed_formats
+
+
+class DownloadResources:
+    """Connections, writer threads and the manifest shared by every channel of a run"""
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        extra_clients: Optional[Dict[str, TelegramClient]] = None,
+    ):
+        self.manifest = DownloadManifest(str(settings.MANIFEST_FILE))
+        # Documents being downloaded, resolved with their path or None on failure
+        self.in_flight: Dict[int, asyncio.Future] = {}
+        # Channels, DCs and auth keys resolved by earlier runs
+        self.startup_cache = (
+            StartupCache(
+                str(settings.STARTUP_CACHE_FILE), settings.ENTITY_CACHE_TTL * 3600
+            )
+            if settings.STARTUP_CACHE
+            else None
+        )
+        self.connection_budget = ConnectionBudget(settings.MAX_CONNECTIONS)
+        self.sender_pool = SenderPool(
+            client,
+            max_connections=settings.MAX_CONNECTIONS,
+            idle_timeout=settings.POOL_IDLE_TIMEOUT,
+            cache=self.startup_cache,
+        )
+        # Small files and photos are multiplexed over one connection per DC
+        self.shared_senders = SharedSenders(self.sender_pool, self.connection_budget)
+        self.writer_executor = ThreadPoolExecutor(
+            settings.WRITER_THREADS, thread_name_prefix="part-writer"
+        )
+        # Fetching pauses while the writers are this far behind
+        self.buffer_pool = BufferPool(
+            settings.BUFFER_POOL_SIZE * 1024 * 1024, settings.MEMORY_LIMIT * 1024 * 1024
+        )
+        self.tuner = (
+            TransferTuner(
+                str(settings.TUNING_STATE_FILE),
+                max_connections=min(20, settings.MAX_CONNECTIONS),
+            )
+            if settings.ADAPTIVE_TUNING
+            else None
+        )
+        # One limiter for all transfers, flood waits apply to the whole account
+        self.rate_limiter = RateLimiter(settings.REQUESTS_PER_SECOND)
+        self.retry_policy = RetryPolicy(
+            attempts=settings.PART_RETRIES, max_flood_wait=settings.MAX_FLOOD_WAIT
+        )
+        metrics.registry.gauge(
+            "tgdl_open_connections",
+            "Connections open to telegram, idle ones included",
+            function=lambda: self.sender_pool.open_connections,
+        )
+        metrics.registry.gauge(
+            "tgdl_connections_in_use",
+            "Connections currently held by transfers",
+            function=lambda: self.connection_budget.limit
+            - self.connection_budget.available,
+        )
+        metrics.registry.gauge(
+            "tgdl_buffer_bytes_in_use",
+            "Memory held by downloaded parts that were not written yet",
+            function=lambda: self.buffer_pool.in_use,
+        )
+        metrics.registry.gauge(
+            "tgdl_buffer_waits",
+            "Part requests that waited for room in the buffer pool",
+            function=lambda: self.buffer_pool.waits,
+        )
+        metrics.registry.gauge(
+            "tgdl_peak_rss_bytes",
+            "Highest resident memory of the process",
+            function=peak_rss,
+        )
+        # Every account has its own connection and flood limits
+        self.accounts = AccountPool(
+            [
+                AccountShard(
+                    "main",
+                    client,
+                    self.sender_pool,
+                    self.connection_budget,
+                    self.rate_limiter,
+                    self.shared_senders,
+                    primary=True,
+                ),
+                *[
+                    AccountShard(
+                        name,
+                        extra_client,
+                        SenderPool(
+                            extra_client,
+                            max_connections=settings.MAX_CONNECTIONS,
+                            idle_timeout=settings.POOL_IDLE_TIMEOUT,
+                            cache=self.startup_cache,
+                        ),
+                        ConnectionBudget(settings.MAX_CONNECTIONS),
+                        RateLimiter(settings.REQUESTS_PER_SECOND),
+                    )
+                    for name, extra_client in (extra_clients or {}).items()
+                ],
+            ]
+        )
+        # Re-uploads run next to the downloads and share their connections
+        self.mirror: Optional["ChannelMirror"] = None
+        if settings.MIRROR_TO:
+            from src.channel_mirror import ChannelMirror
+
+            self.mirror = ChannelMirror(
+                client,
+                settings.MIRROR_TO,
+                self,
+                settings.MIRROR_UPLOADS,
+                max(
+                    1,
+                    settings.MAX_CONNECTIONS
+                    // max(1, settings.MAX_CONCURRENT_DOWNLOADS),
+                ),
+            )
+        # Hashes come from the downloaded data, files are only read back on resumes
+        self.post_processor: Optional["PostProcessor"] = None
+        if (
+            settings.METADATA_SIDECARS
+            or settings.POST_PROCESS_HOOKS
+            or settings.DEDUP_VERIFY_HASH
+        ):
+            # Loads multiprocessing, which most runs don't need
+            from src.post_processing import PostProcessor
+
+            self.post_processor = PostProcessor(
+                settings.POST_PROCESS_WORKERS,
+                settings.METADATA_SIDECARS,
+                settings.POST_PROCESS_HOOKS,
+                on_processed=self.store_hash,
+            )
+
+    def store_hash(self, metadata: dict):
+        self.manifest.set_hash(
+            metadata["channel"], metadata["message_id"], metadata["sha256"]
+        )
+
+    async def close(self):
+        if self.mirror:
+            await self.mirror.close()
+        if self.post_processor:
+            await self.post_processor.close()
+        if self.tuner:
+            self.tuner.save()
+        if self.startup_cache:
+            self.startup_cache.save()
+        await self.accounts.close()
+        self.writer_executor.shutdown()
+        self.manifest.close()
 
 
 class DownloadManager:
-    def __init__(self, client: TelegramClient):
+    def __init__(
+        self,
+        client: TelegramClient,
+        channel: Optional[str] = None,
+        resources: Optional[DownloadResources] = None,
+    ):
         self.client = client
-        self.statistics = DownloadStatistics()
-        self.output_dir = settings.OUTPUT_DIR
+        self.channel = channel or settings.CHANNELS[0]
+        self.statistics = DownloadStatistics(self.channel)
+        self.output_dir = settings.get_output_dir(self.channel)
         self.allowed_formats = settings.ALLOWED_FORMATS
         self.download_all = settings.DOWNLOAD_ALL
         self.max_retries = settings.MAX_RETRIES
+        self.verify_hash = settings.DEDUP_VERIFY_HASH
+        # Several managers share these so one process can serve many channels
+        self.owns_resources = resources is None
+        self.resources = resources or DownloadResources(client)
+        self.manifest = self.resources.manifest
+        self.connection_budget = self.resources.connection_budget
+        self.sender_pool = self.resources.sender_pool
+        self.shared_senders = self.resources.shared_senders
+        self.small_file_size = settings.SMALL_FILE_SIZE * 1024 * 1024
+        self.writer_executor = self.resources.writer_executor
+        self.tuner = self.resources.tuner
+        self.rate_limiter = self.resources.rate_limiter
+        self.retry_policy = self.resources.retry_policy
+        self.mirror = self.resources.mirror
+        self.accounts = self.resources.accounts
+        self.post_processor = self.resources.post_processor
+        # Every concurrent download gets an equal share of the connection budget
+        self.connections_per_file = max(
+            1, settings.MAX_CONNECTIONS // max(1, settings.MAX_CONCURRENT_DOWNLOADS)
+        )
         self.progress = None
 
         os.makedirs(self.output_dir, exist_ok=True)
 
     @lru_cache()
     def should_download_file(self, filename: str) -> bool:
-        if self.download_all:
-            return True
-        ext = os.path.splitext(filename)[1].lstrip(".").lower()
-        return ext in self.allowed_formats
+        return is_allowed_format(filename, self.allowed_formats, self.download_all)
 
     def get_file_extension(self, message) -> Optional[str]:
-        if isinstance(message.media, MessageMediaPhoto):
-            return ".jpg"
-        elif isinstance(message.media, MessageMediaDocument):
-            for attr in message.media.document.attributes:
-                if isinstance(attr, DocumentAttributeFilename):
-                    return f".{attr.file_name.split('.')[-1]}"
-
-            # Fallback to mime type if available
-            mime_type = getattr(message.media.document, "mime_type", "")
-            if "image" in mime_type:
-                return ".jpg"
-            elif "audio" in mime_type:
-                return ".mp3"
-            elif "video" in mime_type:
-                return ".mp4"
-        return ".unknown"
+        return get_file_extension(message)
 
     def get_file_name(self, message) -> str:
         """Get the original filename from a message"""
-        if isinstance(message.media, MessageMediaDocument):
-            for attr in message.media.document.attributes:
-                if isinstance(attr, DocumentAttributeFilename):
-                    return attr.file_name
-        # Fallback to message ID with extension
-        return f"{message.id}{self.get_file_extension(message)}"
+        return get_file_name(message)
+
+    def get_media_id(self, message) -> Optional[int]:
+        """Get the ID of the document or photo attached to a message"""
+        return getattr(message.file.media, "id", None) if message.file else None
+
+    def get_media_size(self, message) -> int:
+        """Get the size of the media that is downloaded, the largest size of a photo"""
+        try:
+            return get_media_location(message.media)[2]
+        except (TypeError, ValueError):
+            return message.file.size
+
+    def get_file_path(
+        self, message, filename: str, entry: Optional[ManifestEntry]
+    ) -> str:
+        """Get the output path, keeping different media with the same name apart"""
+        if entry:
+            # Keep the path of the earlier attempt so its partial file is resumed
+            return entry.path
+        filepath = os.path.join(str(self.output_dir), filename)
+        owner = self.manifest.get_by_path(filepath)
+        if owner and owner.document_id != self.get_media_id(message):
+            stem, ext = os.path.splitext(filename)
+            filepath = os.path.join(str(self.output_dir), f"{stem}_{message.id}{ext}")
+        return filepath
 
     def set_progress(self, progress: Progress):
         self.progress = progress
 
     async def download_with_retry(
-        self, message, filepath, filename
+        self, message, filepath, filename, hasher: Optional[PartHasher] = None
     ) -> Tuple[bool, str]:
-        for retry_number in range(1, self.max_retries + 1):
-            try:
-                with open(filepath, "wb") as file:
-                    file_size = message.media.document.size
-                    task_id = self.progress.add_task(
-                        f"[magenta]Downloading [bold red]{filename}",
-                        total=file_size,
-                        progress_type="download",
-                    )
+        media = message.file.media
+        try:
+            dc_id, _, file_size = get_media_location(message.media)
+        except (TypeError, ValueError) as e:
+            self.statistics.failed_downloads.inc()
+            return False, f"Error downloading {filename}: {e}"
+        part_size = None
+        if self.tuner and file_size > self.small_file_size:
+            default_kb = utils.get_appropriated_part_size(file_size)
+            part_size = self.tuner.choose_part_size(dc_id, file_size, default_kb) * 1024
+        # Retries and later runs continue from the parts already on disk
+        checkpoint = DownloadCheckpoint.load(filepath, media.id, file_size, part_size)
+        task_id = self.progress.add_task(
+            f"[magenta]Downloading [bold red]{filename}",
+            total=file_size,
+            completed=checkpoint.downloaded_bytes,
+            progress_type="download",
+        )
 
-                    async def progress_callback(downloaded, total):
-                        self.progress.update(task_id, completed=downloaded)
+        def progress_callback(downloaded, total):
+            profile.mark("first_byte")
+            # Applied on the next refresh, not for every part
+            self.progress.set_completed(task_id, downloaded)
 
-                    await download_file(
-                        self.client,
-                        message.media.document,
-                        file,
-                        progress_callback=progress_callback,
-                    )
+        try:
+            for retry_number in range(1, self.max_retries + 1):
+                if hasher:
+                    hasher.reset()
+                shard, shard_media = await self.choose_account(dc_id, message)
+                try:
+                    with checkpoint.open() as file:
+                        await download_file(
+                            shard.client,
+                            shard_media,
+                            file,
+                            progress_callback=progress_callback,
+                            budget=shard.budget,
+                            pool=shard.pool,
+                            window=settings.PIPELINE_WINDOW,
+                            connection_count=ParallelTransferrer._get_connection_count(
+                                file_size, max_count=self.connections_per_file
+                            ),
+                            checkpoint=checkpoint,
+                            executor=self.writer_executor,
+                            tuner=self.tuner,
+                            rate_limiter=shard.rate_limiter,
+                            retry_policy=self.retry_policy,
+                            shared=shard.shared_senders,
+                            small_file_size=self.small_file_size,
+                            hasher=hasher,
+                            verify=settings.VERIFY_PARTS,
+                            use_cdn=settings.CDN_DOWNLOADS,
+                            buffers=self.resources.buffer_pool,
+                        )
+                    checkpoint.complete()
+                    self.accounts.release(shard, file_size)
+                    self.statistics.bytes_downloaded.inc(file_size)
                     self.progress.update(
                         task_id, description=f"[green]Downloaded [bold red]{filename}"
                     )
-                    self.progress.remove_task(task_id)
-                self.statistics.total_downloads += 1
-                return True, filename
-            except Exception as e:
-                if retry_number == self.max_retries:
-                    self.statistics.failed_downloads += 1
-                    if self.progress and task_id:
-                        self.progress.remove_task(task_id)
-                    return (
-                        False,
-                        f"Error downloading {filename}: {type(e).__name__} - {str(e)}",
+                    self.statistics.total_downloads.inc()
+                    return True, filename
+                except Exception as e:
+                    self.accounts.release(shard)
+                    if isinstance(e, FLOOD_ERRORS):
+                        # Longer than we wait out, the next attempt uses another account
+                        shard.pause(dc_id, e.seconds)
+                    if retry_number == self.max_retries:
+                        self.statistics.failed_downloads.inc()
+                        return (
+                            False,
+                            f"Error downloading {filename}: {type(e).__name__} - {str(e)}",
+                        )
+                    print(
+                        f"Retrying download {filename} ({retry_number}/{self.max_retries})"
                     )
-                print(
-                    f"Retrying download {filename} ({retry_number}/{self.max_retries})"
-                )
-                await asyncio.sleep(1)
+                    if isinstance(e, errors.FileReferenceExpiredError):
+                        # Fetching the message again gives a fresh file reference
+                        message = await self.client.get_messages(
+                            message.chat_id, ids=message.id
+                        )
+                        if not message or not message.media:
+                            self.statistics.failed_downloads.inc()
+                            return False, f"Message of {filename} was deleted"
+                        # choose_account hands its media to the next attempt
+                        continue
+                    if isinstance(e, FLOOD_ERRORS) and len(self.accounts) > 1:
+                        continue
+                    # Parts are already retried, so this is a longer outage
+                    await asyncio.sleep(self.retry_policy.delay(retry_number + 2))
+        finally:
+            self.progress.remove_task(task_id)
+
+    async def choose_account(self, dc_id: int, message) -> Tuple[AccountShard, object]:
+        """Pick the account for the next attempt and get the media as it sees it"""
+        shard = self.accounts.acquire(self.accounts.choose(dc_id))
+        shard_message = await shard.get_message(self.channel, message)
+        if shard_message and shard_message.file:
+            return shard, shard_message.file.media
+        # This account can't see the message, the main one always can
+        self.accounts.release(shard)
+        return self.accounts.acquire(self.accounts.primary), message.file.media
 
     async def download_file(self, message) -> Tuple[bool, str]:
         if not message.media:
@@ -116,20 +436,221 @@ class DownloadManager:
             return False, "Could not determine filename"
 
         if not self.should_download_file(filename):
-            self.statistics.filtered_files += 1
+            self.statistics.filtered_files.inc()
             return False, f"File format not allowed: {filename}"
 
-        filepath = os.path.join(str(self.output_dir), filename)
-        if os.path.exists(filepath):
-            self.statistics.skipped_files += 1
-            return False, f"File already exists: {filepath}"
+        entry = self.manifest.get(self.channel, message.id)
+        if entry and entry.status == STATUS_COMPLETED:
+            self.statistics.skipped_files.inc()
+            # Downloaded by an earlier run, but not mirrored yet
+            if (
+                self.mirror
+                and os.path.exists(entry.path)
+                and self.mirror.get_pending(self.channel, [message.id])
+            ):
+                await self.mirror.submit(self.channel, message, entry.path)
+            return False, f"File already exists: {entry.path}"
+
+        media_id = self.get_media_id(message)
+        file_size = self.get_media_size(message)
+        filepath = self.get_file_path(message, filename, entry)
+        # Finished files only appear under their final name, but files written by
+        # versions without a manifest may have been left truncated by a crash
+        if not entry and os.path.exists(filepath):
+            if os.path.getsize(filepath) == file_size:
+                self.manifest.record(
+                    self.channel,
+                    message.id,
+                    media_id,
+                    file_size,
+                    filepath,
+                    STATUS_COMPLETED,
+                )
+                self.statistics.skipped_files.inc()
+                return False, f"File already exists: {filepath}"
+
+        self.manifest.record(
+            self.channel, message.id, media_id, file_size, filepath, STATUS_DOWNLOADING
+        )
+        in_flight = self.resources.in_flight
+        while media_id is not None and media_id in in_flight:
+            # Another message carries the same document, link its download instead
+            await asyncio.shield(in_flight[media_id])
+        if media_id is not None:
+            in_flight[media_id] = asyncio.get_running_loop().create_future()
+        success = False
+        try:
+            hasher = PartHasher() if self.post_processor else None
+            if self.is_in_place(media_id, file_size, filepath):
+                # Another message downloaded the same document to the same path
+                linked = f"{os.path.basename(filepath)} (same file as another message)"
+                self.statistics.deduplicated_files.inc()
+                self.statistics.bytes_saved.inc(file_size)
+            else:
+                linked = await self.link_existing_copy(media_id, file_size, filepath)
+            if linked:
+                success, result = True, linked
+            else:
+                success, result = await self.download_with_retry(
+                    message, filepath, os.path.basename(filepath), hasher
+                )
+            self.manifest.record(
+                self.channel,
+                message.id,
+                media_id,
+                file_size,
+                filepath,
+                STATUS_COMPLETED if success else STATUS_FAILED,
+            )
+        finally:
+            if media_id is not None:
+                in_flight.pop(media_id).set_result(filepath if success else None)
+        if success and self.post_processor:
+            sha256 = None if linked else hasher.hexdigest(file_size)
+            await self.post_processor.submit(self.channel, message, filepath, sha256)
+        if success and self.mirror:
+            await self.mirror.submit(self.channel, message, filepath)
+        return success, result
+
+    def is_in_place(
+        self, media_id: Optional[int], file_size: int, filepath: str
+    ) -> bool:
+        if media_id is None or not os.path.exists(filepath):
+            return False
+        return any(
+            copy.path == filepath
+            for copy in self.manifest.get_copies(media_id, file_size)
+        )
+
+    async def link_existing_copy(
+        self, media_id: Optional[int], file_size: int, filepath: str
+    ) -> Optional[str]:
+        """Link a completed download of the same document instead of fetching it"""
+        if media_id is None:
+            return None
+        for copy in self.manifest.get_copies(media_id, file_size):
+            if copy.path == filepath or not os.path.exists(copy.path):
+                continue
+            if self.verify_hash:
+                sha256 = await self.hash_file(copy.path)
+                if copy.sha256 and copy.sha256 != sha256:
+                    # The local copy changed since it was downloaded
+                    continue
+                self.manifest.set_hash(copy.channel, copy.message_id, sha256)
+
+            temp_path = f"{filepath}.link"
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            method = await asyncio.get_running_loop().run_in_executor(
+                self.writer_executor, link_file, copy.path, temp_path
+            )
+            os.replace(temp_path, filepath)
+            if os.path.exists(temp_path):
+                # Renaming a hardlink over another one of the same file does nothing
+                os.remove(temp_path)
+            self.statistics.deduplicated_files.inc()
+            self.statistics.bytes_saved.inc(file_size)
+            return f"{os.path.basename(filepath)} ({method} of {copy.path})"
+        return None
+
+    async def hash_file(self, path: str) -> str:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.writer_executor, hash_file, path
+        )
+
+    def select_downloads(self, messages: List) -> List:
+        """Run the local checks of :meth:`download_file` on a batch of messages.
 
-        return await self.download_with_retry(message, filepath, filename)
+        Returns the messages that still need a download, so the rest never
+        occupies a download slot. The manifest is queried once per batch.
+        """
+        if not messages:
+            return []
+        message_ids = [message.id for message in messages]
+        entries = self.manifest.get_many(self.channel, message_ids)
+        unmirrored = (
+            set(self.mirror.get_pending(self.channel, message_ids))
+            if self.mirror
+            else set()
+        )
+        selected = []
+        for message in messages:
+            if not message.media or not message.file:
+                continue
+            if not self.should_download_file(self.get_file_name(message)):
+                self.statistics.filtered_files.inc()
+                continue
+            entry = entries.get(message.id)
+            if (
+                entry
+                and entry.status == STATUS_COMPLETED
+                and message.id not in unmirrored
+            ):
+                self.statistics.skipped_files.inc()
+                continue
+            selected.append(message)
+        return selected
+
+    def plan_downloads(self, messages: List) -> List[PlannedFile]:
+        """Decide what :meth:`download_file` would do with a batch of messages.
+
+        Only reads the manifest and the output directory, nothing is recorded
+        or counted, so planning can run as often as wanted.
+        """
+        if not messages:
+            return []
+        entries = self.manifest.get_many(self.channel, [m.id for m in messages])
+        planned = []
+        for message in messages:
+            if not message.media or not message.file:
+                continue
+            filename = self.get_file_name(message)
+            entry = entries.get(message.id)
+            media_id = self.get_media_id(message)
+            file_size = self.get_media_size(message)
+            filepath = self.get_file_path(message, filename, entry)
+            if not self.should_download_file(filename):
+                action = ACTION_FILTERED
+            elif entry and entry.status == STATUS_COMPLETED:
+                action = ACTION_PRESENT
+            elif (
+                not entry
+                and os.path.exists(filepath)
+                and os.path.getsize(filepath) == file_size
+            ):
+                action = ACTION_PRESENT
+            elif media_id is not None and any(
+                copy.path != filepath and os.path.exists(copy.path)
+                for copy in self.manifest.get_copies(media_id, file_size)
+            ):
+                action = ACTION_LINK
+            else:
+                action = ACTION_DOWNLOAD
+            try:
+                dc_id = get_media_location(message.media)[0]
+            except (TypeError, ValueError):
+                dc_id = None
+            planned.append(
+                PlannedFile(
+                    channel=self.channel,
+                    message_id=message.id,
+                    filename=filename,
+                    format=os.path.splitext(filename)[1].lstrip(".").lower()
+                    or "unknown",
+                    size=file_size,
+                    dc_id=dc_id,
+                    path=filepath,
+                    action=action,
+                )
+            )
+        return planned
 
     def get_statistics(self) -> dict:
         return {
-            "total_downloads": self.statistics.total_downloads,
-            "skipped_files": self.statistics.skipped_files,
-            "filtered_files": self.statistics.filtered_files,
-            "failed_downloads": self.statistics.failed_downloads,
+            **self.statistics.as_dict(),
+            "connection_pool": self.sender_pool.stats(),
         }
+
+    async def close(self):
+        if self.owns_resources:
+            await self.resources.close()
@@ -0,0 +1,219 @@
+import sqlite3
+import time
+from typing import Dict, List, Optional, Set
+
+from pydantic import BaseModel
+
+STATUS_DOWNLOADING = "downloading"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+
+
+class ManifestEntry(BaseModel):
+    channel: str
+    message_id: int
+    document_id: Optional[int]
+    size: Optional[int]
+    path: str
+    status: str
+    sha256: Optional[str] = None
+
+
+class DownloadManifest:
+    """SQLite record of every media handled per channel and message.
+
+    Skip decisions are an index lookup on ``(channel, message_id)`` instead of
+    a stat of the output directory, and the highest message ID processed per
+    channel lets a sync only request messages newer than the last run.
+    """
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                channel TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                document_id INTEGER,
+                size INTEGER,
+                path TEXT NOT NULL,
+                status TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                sha256 TEXT,
+                PRIMARY KEY (channel, message_id)
+            );
+            CREATE INDEX IF NOT EXISTS downloads_path ON downloads (path);
+            CREATE INDEX IF NOT EXISTS downloads_status ON downloads (channel, status);
+            CREATE INDEX IF NOT EXISTS downloads_document ON downloads (document_id, size);
+            CREATE TABLE IF NOT EXISTS channels (
+                channel TEXT PRIMARY KEY,
+                last_message_id INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS mirrors (
+                channel TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                target TEXT NOT NULL,
+                target_message_id INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (channel, message_id, target)
+            );
+            CREATE TABLE IF NOT EXISTS runs (
+                finished_at REAL NOT NULL,
+                bytes INTEGER NOT NULL,
+                seconds REAL NOT NULL
+            );
+            """)
+
+    def get(self, channel: str, message_id: int) -> Optional[ManifestEntry]:
+        row = self.connection.execute(
+            "SELECT * FROM downloads WHERE channel = ? AND message_id = ?",
+            (channel, message_id),
+        ).fetchone()
+        return self._to_entry(row)
+
+    def get_many(
+        self, channel: str, message_ids: List[int]
+    ) -> Dict[int, ManifestEntry]:
+        placeholders = ", ".join("?" * len(message_ids))
+        rows = self.connection.execute(
+            "SELECT * FROM downloads"
+            f" WHERE channel = ? AND message_id IN ({placeholders})",
+            (channel, *message_ids),
+        )
+        return {row["message_id"]: self._to_entry(row) for row in rows}
+
+    def get_by_path(self, path: str) -> Optional[ManifestEntry]:
+        row = self.connection.execute(
+            "SELECT * FROM downloads WHERE path = ?", (path,)
+        ).fetchone()
+        return self._to_entry(row)
+
+    def get_copies(self, document_id: int, size: int) -> List[ManifestEntry]:
+        """Get the completed downloads of the same document in any channel"""
+        rows = self.connection.execute(
+            "SELECT * FROM downloads"
+            " WHERE document_id = ? AND size = ? AND status = ?"
+            " ORDER BY updated_at",
+            (document_id, size, STATUS_COMPLETED),
+        )
+        return [self._to_entry(row) for row in rows]
+
+    def set_hash(self, channel: str, message_id: int, sha256: str):
+        with self.connection:
+            self.connection.execute(
+                "UPDATE downloads SET sha256 = ? WHERE channel = ? AND message_id = ?",
+                (sha256, channel, message_id),
+            )
+
+    def record(
+        self,
+        channel: str,
+        message_id: int,
+        document_id: Optional[int],
+        size: Optional[int],
+        path: str,
+        status: str,
+    ):
+        with self.connection:
+            self.connection.execute(
+                """
+                INSERT INTO downloads
+                    (channel, message_id, document_id, size, path, status, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (channel, message_id) DO UPDATE SET
+                    document_id = excluded.document_id,
+                    size = excluded.size,
+                    path = excluded.path,
+                    status = excluded.status,
+                    updated_at = excluded.updated_at
+                """,
+                (channel, message_id, document_id, size, path, status, time.time()),
+            )
+
+    def get_unfinished_message_ids(self, channel: str) -> List[int]:
+        rows = self.connection.execute(
+            "SELECT message_id FROM downloads WHERE channel = ? AND status != ?",
+            (channel, STATUS_COMPLETED),
+        )
+        return [row["message_id"] for row in rows]
+
+    def get_last_message_id(self, channel: str) -> int:
+        row = self.connection.execute(
+            "SELECT last_message_id FROM channels WHERE channel = ?", (channel,)
+        ).fetchone()
+        return row["last_message_id"] if row else 0
+
+    def set_last_message_id(self, channel: str, message_id: int):
+        with self.connection:
+            self.connection.execute(
+                """
+                INSERT INTO channels (channel, last_message_id) VALUES (?, ?)
+                ON CONFLICT (channel) DO UPDATE SET
+                    last_message_id = MAX(last_message_id, excluded.last_message_id)
+                """,
+                (channel, message_id),
+            )
+
+    def get_mirrored(
+        self, channel: str, message_ids: List[int], target: str
+    ) -> Set[int]:
+        """Get which of ``message_ids`` were already uploaded to ``target``"""
+        placeholders = ", ".join("?" * len(message_ids))
+        rows = self.connection.execute(
+            "SELECT message_id FROM mirrors WHERE channel = ? AND target = ?"
+            f" AND message_id IN ({placeholders})",
+            (channel, target, *message_ids),
+        )
+        return {row["message_id"] for row in rows}
+
+    def record_mirror(
+        self, channel: str, message_id: int, target: str, target_message_id: int
+    ):
+        with self.connection:
+            self.connection.execute(
+                """
+                INSERT OR REPLACE INTO mirrors
+                    (channel, message_id, target, target_message_id, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (channel, message_id, target, target_message_id, time.time()),
+            )
+
+    def record_run(self, downloaded_bytes: int, seconds: float):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO runs (finished_at, bytes, seconds) VALUES (?, ?, ?)",
+                (time.time(), downloaded_bytes, seconds),
+            )
+
+    def get_throughput(self, runs: int = 5) -> Optional[float]:
+        """Get the bytes per second of the last ``runs`` runs that downloaded anything"""
+        row = self.connection.execute(
+            """
+            SELECT SUM(bytes) AS bytes, SUM(seconds) AS seconds FROM (
+                SELECT bytes, seconds FROM runs WHERE bytes > 0 AND seconds > 0
+                ORDER BY finished_at DESC LIMIT ?
+            )
+            """,
+            (runs,),
+        ).fetchone()
+        return row["bytes"] / row["seconds"] if row["seconds"] else None
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def _to_entry(row: Optional[sqlite3.Row]) -> Optional[ManifestEntry]:
+        if row is None:
+            return None
+        return ManifestEntry(
+            channel=row["channel"],
+            message_id=row["message_id"],
+            document_id=row["document_id"],
+            size=row["size"],
+            path=row["path"],
+            status=row["status"],
+            sha256=row["sha256"],
+        )
@@ -0,0 +1,168 @@
+import csv
+import json
+import os
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+# What a run would do with a message
+ACTION_DOWNLOAD = "download"
+ACTION_LINK = "link"  # Linked from a completed download of the same document
+ACTION_PRESENT = "present"
+ACTION_FILTERED = "filtered"
+ACTIONS = (ACTION_DOWNLOAD, ACTION_LINK, ACTION_PRESENT, ACTION_FILTERED)
+
+
+def _empty_counts() -> Dict[str, Dict[str, int]]:
+    return {action: {"files": 0, "bytes": 0} for action in ACTIONS}
+
+
+class PlannedFile(BaseModel):
+    channel: str
+    message_id: int
+    filename: str
+    format: str
+    size: int
+    dc_id: Optional[int] = None
+    path: str
+    action: str
+
+
+class PlannedChannel(BaseModel):
+    title: str = ""
+    # Scanned up to here, an executed plan continues incremental syncs from it
+    last_message_id: int = 0
+
+
+class DownloadPlan(BaseModel):
+    """The files a run would download, found by scanning message metadata only.
+
+    Saved as JSON with a summary, or as CSV with one row per file. Executing a
+    plan fetches exactly its messages by ID instead of scanning the channels.
+    """
+
+    created: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    channels: Dict[str, PlannedChannel] = {}
+    files: List[PlannedFile] = []
+    # Bytes per second of all downloads together, None if never measured
+    throughput: Optional[float] = None
+
+    def add_channel(self, channel: str, title: str, last_message_id: int):
+        self.channels[channel] = PlannedChannel(
+            title=title, last_message_id=last_message_id
+        )
+
+    def get_message_ids(self, channel: str) -> List[int]:
+        """Get the messages of ``channel`` a run has to look at"""
+        return sorted(
+            planned.message_id
+            for planned in self.files
+            if planned.channel == channel and planned.action != ACTION_FILTERED
+        )
+
+    @property
+    def download_bytes(self) -> int:
+        return sum(
+            planned.size for planned in self.files if planned.action == ACTION_DOWNLOAD
+        )
+
+    @property
+    def eta_seconds(self) -> Optional[float]:
+        if not self.download_bytes:
+            return 0.0
+        return self.download_bytes / self.throughput if self.throughput else None
+
+    def summary(self) -> Dict[str, object]:
+        """Get the files and bytes of every action, in total and per format"""
+        totals = _empty_counts()
+        formats: Dict[str, Dict[str, Dict[str, int]]] = {}
+        for planned in self.files:
+            for counts in (totals, formats.setdefault(planned.format, _empty_counts())):
+                counts[planned.action]["files"] += 1
+                counts[planned.action]["bytes"] += planned.size
+        return {
+            "totals": totals,
+            "formats": dict(sorted(formats.items())),
+            "throughput": self.throughput,
+            "eta_seconds": self.eta_seconds,
+        }
+
+    def save(self, path: str):
+        """Write the plan as CSV if ``path`` ends with .csv, as JSON otherwise"""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", newline="") as file:
+            if path.lower().endswith(".csv"):
+                writer = csv.DictWriter(file, fieldnames=list(PlannedFile.model_fields))
+                writer.writeheader()
+                writer.writerows(planned.model_dump() for planned in self.files)
+            else:
+                json.dump(
+                    {**self.model_dump(), "summary": self.summary()}, file, indent=2
+                )
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "DownloadPlan":
+        with open(path, newline="") as file:
+            if not path.lower().endswith(".csv"):
+                state = json.load(file)
+                state.pop("summary", None)
+                return cls(**state)
+            files = [
+                PlannedFile(**{**row, "dc_id": row["dc_id"] or None})
+                for row in csv.DictReader(file)
+            ]
+        # CSV plans only have the files, the channels come from them
+        plan = cls(files=files)
+        for planned in files:
+            channel = plan.channels.setdefault(planned.channel, PlannedChannel())
+            channel.last_message_id = max(channel.last_message_id, planned.message_id)
+        return plan
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    return f"{minutes}m {seconds:02d}s"
+
+
+def print_plan(plan: DownloadPlan):
+    summary = plan.summary()
+    totals = summary["totals"]
+    print(
+        f"Plan for {len(plan.channels)} channels: "
+        + ", ".join(
+            f"{totals[action]['files']} {action} "
+            f"({format_size(totals[action]['bytes'])})"
+            for action in ACTIONS
+        )
+    )
+    for name, counts in summary["formats"].items():
+        print(
+            f"  {name:<8} "
+            + ", ".join(
+                f"{counts[action]['files']} {action} "
+                f"({format_size(counts[action]['bytes'])})"
+                for action in ACTIONS
+                if counts[action]["files"]
+            )
+        )
+    eta = plan.eta_seconds
+    if eta is None:
+        print("ETA: unknown, no earlier run measured the throughput yet")
+    else:
+        print(
+            f"ETA: {format_duration(eta)} at {format_size(plan.throughput or 0)}/s "
+            "measured in earlier runs"
+        )
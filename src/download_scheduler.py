@@ -0,0 +1,114 @@
+import asyncio
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from src import metrics
+from src.download_manager import DownloadManager
+
+ResultCallback = Callable[[object, bool, str], None]
+QueueItem = Tuple[object, Optional[ResultCallback]]
+
+
+class DownloadScheduler:
+    """Runs up to ``max_concurrent`` downloads while messages are still being fed in.
+
+    Every download manager (one per channel) gets its own bounded queue and
+    free download slots are handed out round-robin over the channels that
+    have work waiting, so one huge channel can't starve the others.
+    """
+
+    def __init__(self, max_concurrent: int, queue_size: Optional[int] = None):
+        self.max_concurrent = max(1, max_concurrent)
+        # Bounded so a channel scan can't run arbitrarily far ahead of its downloads
+        self.queue_size = queue_size or self.max_concurrent * 2
+        self.queues: Dict[DownloadManager, Deque[QueueItem]] = {}
+        self.unfinished: Dict[DownloadManager, int] = {}
+        self.turns: Deque[DownloadManager] = deque()
+        self.condition = asyncio.Condition()
+        self.workers: List[asyncio.Task] = []
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.join()
+        await self.cancel()
+
+    def start(self):
+        self.workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.max_concurrent)
+        ]
+
+    async def submit(
+        self,
+        download_manager: DownloadManager,
+        message,
+        on_result: Optional[ResultCallback] = None,
+    ):
+        async with self.condition:
+            if download_manager not in self.queues:
+                self.queues[download_manager] = deque()
+                self.unfinished[download_manager] = 0
+                self.turns.append(download_manager)
+            queue = self.queues[download_manager]
+            await self.condition.wait_for(lambda: len(queue) < self.queue_size)
+            queue.append((message, on_result))
+            metrics.queue_depth.labels(channel=download_manager.channel).set(len(queue))
+            self.unfinished[download_manager] += 1
+            self.condition.notify_all()
+
+    async def join(self, download_manager: Optional[DownloadManager] = None):
+        """Wait until every submitted download, or those of one manager, finished"""
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: (
+                    not any(self.unfinished.values())
+                    if download_manager is None
+                    else not self.unfinished.get(download_manager)
+                )
+            )
+
+    async def cancel(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def _has_work(self) -> bool:
+        return any(self.queues.values())
+
+    async def _next(self) -> Tuple[DownloadManager, QueueItem]:
+        async with self.condition:
+            await self.condition.wait_for(self._has_work)
+            while True:
+                download_manager = self.turns[0]
+                self.turns.rotate(-1)
+                queue = self.queues[download_manager]
+                if queue:
+                    self.condition.notify_all()
+                    item = queue.popleft()
+                    metrics.queue_depth.labels(channel=download_manager.channel).set(
+                        len(queue)
+                    )
+                    return download_manager, item
+
+    async def _worker(self):
+        while True:
+            download_manager, (message, on_result) = await self._next()
+            active = metrics.active_downloads.labels(channel=download_manager.channel)
+            active.inc()
+            try:
+                success, result = await download_manager.download_file(message)
+            except Exception as e:
+                success, result = False, f"Error processing message {message.id}: {e}"
+            finally:
+                active.dec()
+            try:
+                if on_result:
+                    on_result(message, success, result)
+            finally:
+                async with self.condition:
+                    self.unfinished[download_manager] -= 1
+                    self.condition.notify_all()
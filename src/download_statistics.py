@@ -1,8 +1,34 @@
-from pydantic import BaseModel
+from typing import Dict
 
+from src import metrics
 
-class DownloadStatistics(BaseModel):
-    total_downloads: int = 0
-    skipped_files: int = 0
-    filtered_files: int = 0
-    failed_downloads: int = 0
+
+class DownloadStatistics:
+    """Counters of one channel, kept in the metrics registry so they are exported"""
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.total_downloads = metrics.files.labels(
+            channel=channel, result="downloaded"
+        )
+        self.skipped_files = metrics.files.labels(channel=channel, result="skipped")
+        self.filtered_files = metrics.files.labels(channel=channel, result="filtered")
+        self.failed_downloads = metrics.files.labels(channel=channel, result="failed")
+        self.deduplicated_files = metrics.files.labels(
+            channel=channel, result="deduplicated"
+        )
+        self.mirrored_files = metrics.files.labels(channel=channel, result="mirrored")
+        self.bytes_saved = metrics.saved_bytes.labels(channel=channel)
+        self.bytes_downloaded = metrics.completed_bytes.labels(channel=channel)
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "total_downloads": int(self.total_downloads.value),
+            "skipped_files": int(self.skipped_files.value),
+            "filtered_files": int(self.filtered_files.value),
+            "failed_downloads": int(self.failed_downloads.value),
+            "deduplicated_files": int(self.deduplicated_files.value),
+            "mirrored_files": int(self.mirrored_files.value),
+            "bytes_saved": int(self.bytes_saved.value),
+            "bytes_downloaded": int(self.bytes_downloaded.value),
+        }
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, List, Optional, Set
+
+
+def _preallocate(fd: int, size: int):
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            # Not supported by every filesystem, a sparse file works as well
+            pass
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+
+
+class PositionalWriter:
+    """Writes downloaded parts at their offset from a thread pool.
+
+    The target is preallocated to its final size so parts can land in any
+    order, and the event loop only waits for the disk once ``max_pending``
+    writes are outstanding. Written parts are fsynced in batches in the
+    background, at most every ``sync_interval`` seconds or ``sync_bytes``
+    bytes, and reported to ``on_synced`` only once they are durable.
+    """
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        size: int,
+        executor: ThreadPoolExecutor,
+        on_synced: Optional[Callable[[List[int]], None]] = None,
+        max_pending: int = 8,
+        sync_interval: float = 1.0,
+        sync_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.fd = file.fileno()
+        self.size = size
+        self.executor = executor
+        self.on_synced = on_synced
+        self.max_pending = max_pending
+        self.sync_interval = sync_interval
+        self.sync_bytes = sync_bytes
+        self.pending: Set[asyncio.Future] = set()
+        self.sync_task: Optional[asyncio.Task] = None
+        self.unsynced_parts: List[int] = []
+        self.unsynced_bytes = 0
+        self.last_sync = time.monotonic()
+        # Only used where os.pwrite is unavailable and seek+write must not interleave
+        self.lock = threading.Lock()
+
+    async def preallocate(self):
+        await self._run(_preallocate, self.fd, self.size)
+
+    async def write(
+        self,
+        offset: int,
+        data: bytes,
+        part: int,
+        on_written: Optional[Callable[[], None]] = None,
+    ):
+        """Queue ``data`` for writing at ``offset`` without waiting for the disk.
+
+        ``on_written`` is called once the writer no longer holds ``data``,
+        whether the write succeeded or not.
+        """
+        try:
+            self._collect_done()
+            while len(self.pending) >= self.max_pending:
+                await asyncio.wait(self.pending, return_when=asyncio.FIRST_COMPLETED)
+                self._collect_done()
+            self._collect_sync()
+        except BaseException:
+            if on_written:
+                on_written()
+            raise
+
+        self.pending.add(
+            asyncio.ensure_future(self._write(offset, data, part, on_written))
+        )
+
+        if self.sync_task is None and (
+            self.unsynced_bytes >= self.sync_bytes
+            or time.monotonic() - self.last_sync >= self.sync_interval
+        ):
+            # Parts keep arriving while the disk catches up
+            self.sync_task = asyncio.ensure_future(self._sync_written())
+
+    async def sync(self):
+        """Wait for every queued write and fsync them as one batch.
+
+        Raises the first error of a write or of a background fsync.
+        """
+        await self._wait_running()
+        self._collect_sync()
+        self._collect_done()
+        await self._sync_written()
+
+    async def close(self):
+        """Sync whatever was written, even if the download is being aborted.
+
+        Errors are left to :meth:`sync`, so an abort keeps its own exception.
+        """
+        await self._wait_running()
+        # Retrieved, so failures aren't reported as never retrieved
+        for future in [*self.pending, *([self.sync_task] if self.sync_task else [])]:
+            if not future.cancelled():
+                future.exception()
+        self.pending.clear()
+        self.sync_task = None
+        await self._sync_written()
+
+    async def _wait_running(self):
+        # asyncio.wait doesn't raise, so no write is forgotten while it still runs
+        running = [*self.pending, *([self.sync_task] if self.sync_task else [])]
+        if running:
+            await asyncio.wait(running)
+
+    async def _sync_written(self):
+        """Fsync the parts whose writes finished so far"""
+        parts, self.unsynced_parts = self.unsynced_parts, []
+        self.unsynced_bytes = 0
+        self.last_sync = time.monotonic()
+        if not parts:
+            return
+        await self._run(os.fsync, self.fd)
+        if self.on_synced:
+            self.on_synced(parts)
+
+    def _collect_done(self):
+        for future in [future for future in self.pending if future.done()]:
+            self.pending.discard(future)
+            # Raises the error of a failed write
+            future.result()
+
+    def _collect_sync(self):
+        if self.sync_task and self.sync_task.done():
+            task, self.sync_task = self.sync_task, None
+            # Raises the error of a failed fsync
+            task.result()
+
+    async def _write(
+        self,
+        offset: int,
+        data: bytes,
+        part: int,
+        on_written: Optional[Callable[[], None]] = None,
+    ):
+        try:
+            await self._run(self._pwrite, offset, data)
+        finally:
+            if on_written:
+                on_written()
+        self.unsynced_parts.append(part)
+        self.unsynced_bytes += len(data)
+
+    def _pwrite(self, offset: int, data: bytes):
+        view = memoryview(data)
+        if hasattr(os, "pwrite"):
+            while view:
+                written = os.pwrite(self.fd, view, offset)
+                view = view[written:]
+                offset += written
+            return
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            while view:
+                view = view[os.write(self.fd, view) :]
+
+    def _run(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
+        )
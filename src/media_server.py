@@ -0,0 +1,372 @@
+import asyncio
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+from telethon import TelegramClient, errors
+from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto
+
+from src.FastTelethon import ParallelTransferrer, get_media_location
+from src.transfer_retry import CONNECTION_ERRORS
+
+# GetFileRequest can return at most 1 MB, with offsets a multiple of the limit
+BLOCK_SIZE = 1024 * 1024
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+
+# Messages kept for their file references, least recently used go first
+MESSAGE_CACHE_SIZE = 1024
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def _write_file(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(data)
+    os.replace(temp_path, path)
+
+
+class BlockCache:
+    """Least recently used media blocks in ``directory``, at most ``max_bytes``.
+
+    Blocks are stored as ``<directory>/<media_id>/<block_index>`` and blocks
+    left by an earlier run are reused, oldest first in line for eviction.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, executor: ThreadPoolExecutor):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.executor = executor
+        self.blocks: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+        self.size = 0
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        for media_id in os.listdir(directory):
+            media_dir = os.path.join(directory, media_id)
+            if not media_id.isdigit() or not os.path.isdir(media_dir):
+                continue
+            for block in os.listdir(media_dir):
+                if block.isdigit():
+                    stat = os.stat(os.path.join(media_dir, block))
+                    existing.append(
+                        (stat.st_mtime, (int(media_id), int(block)), stat.st_size)
+                    )
+        for _, key, size in sorted(existing):
+            self.blocks[key] = size
+            self.size += size
+
+    def _path(self, key: Tuple[int, int]) -> str:
+        return os.path.join(self.directory, str(key[0]), str(key[1]))
+
+    async def get(self, media_id: int, block: int) -> Optional[bytes]:
+        key = (media_id, block)
+        if key not in self.blocks:
+            return None
+        self.blocks.move_to_end(key)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, _read_file, self._path(key)
+            )
+        except OSError:
+            self.size -= self.blocks.pop(key, 0)
+            return None
+
+    async def put(self, media_id: int, block: int, data: bytes):
+        key = (media_id, block)
+        if key in self.blocks or len(data) > self.max_bytes:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, _write_file, self._path(key), data)
+        self.blocks[key] = len(data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            old_key, old_size = self.blocks.popitem(last=False)
+            self.size -= old_size
+            try:
+                await loop.run_in_executor(
+                    self.executor, os.remove, self._path(old_key)
+                )
+            except OSError:
+                pass
+
+
+class MediaStreamer:
+    """Fetches 1 MB blocks of channel media on demand through the shared senders.
+
+    Blocks are served from the :class:`BlockCache` when possible, a block that
+    is already being fetched is waited for instead of requested twice, and
+    every read starts fetching the next ``read_ahead`` blocks in the
+    background, so sequential readers rarely wait for the network.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        resources,
+        cache: BlockCache,
+        read_ahead: int = 8,
+        use_cdn: bool = False,
+    ):
+        self.client = client
+        self.resources = resources
+        self.cache = cache
+        self.read_ahead = read_ahead
+        self.use_cdn = use_cdn
+        self.messages: OrderedDict[Tuple[str, int], object] = OrderedDict()
+        self.fetching: Dict[Tuple[int, int], asyncio.Future] = {}
+        self.prefetches: set = set()
+
+    async def get_message(self, channel: str, message_id: int, refresh: bool = False):
+        key = (channel, message_id)
+        if refresh or key not in self.messages:
+            message = await self.client.get_messages(channel, ids=message_id)
+            if not message or not isinstance(
+                message.media, (MessageMediaDocument, MessageMediaPhoto)
+            ):
+                return None
+            self.messages[key] = message
+            if len(self.messages) > MESSAGE_CACHE_SIZE:
+                self.messages.popitem(last=False)
+        self.messages.move_to_end(key)
+        return self.messages[key]
+
+    async def read_block(self, channel: str, message_id: int, block: int) -> bytes:
+        message = await self.get_message(channel, message_id)
+        media = message.file.media
+        self._prefetch(channel, message_id, media, block + 1)
+        data = await self.cache.get(media.id, block)
+        if data is not None:
+            return data
+        future = self.fetching.get((media.id, block))
+        if not future:
+            future = self._start_fetch(channel, message_id, media, [block])[0]
+        return await asyncio.shield(future)
+
+    def _prefetch(self, channel: str, message_id: int, media, first: int):
+        size = get_media_location(media)[2]
+        last = min(first + self.read_ahead, -(-size // BLOCK_SIZE))
+        missing = [
+            block
+            for block in range(first, last)
+            if (media.id, block) not in self.cache.blocks
+            and (media.id, block) not in self.fetching
+        ]
+        # Fetched in batches, unless the reader is about to need the next block
+        if len(missing) >= max(1, self.read_ahead // 2) or first in missing:
+            for future in self._start_fetch(channel, message_id, media, missing):
+                # Nobody may wait for a prefetched block, don't log its errors
+                future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def _start_fetch(
+        self, channel: str, message_id: int, media, blocks: List[int]
+    ) -> List[asyncio.Future]:
+        loop = asyncio.get_running_loop()
+        futures = []
+        for block in blocks:
+            future = loop.create_future()
+            self.fetching[(media.id, block)] = future
+            futures.append(future)
+        task = loop.create_task(self._fetch(channel, message_id, media, blocks))
+        self.prefetches.add(task)
+        task.add_done_callback(self.prefetches.discard)
+        return futures
+
+    async def _fetch(self, channel: str, message_id: int, media, blocks: List[int]):
+        remaining = list(blocks)
+        try:
+            for attempt in range(2):
+                try:
+                    async for block, data in self._iter_blocks(media, remaining):
+                        remaining.remove(block)
+                        await self.cache.put(media.id, block, data)
+                        future = self.fetching.pop((media.id, block), None)
+                        if future and not future.done():
+                            future.set_result(data)
+                    return
+                except errors.FileReferenceExpiredError:
+                    if attempt:
+                        raise
+                    message = await self.get_message(channel, message_id, refresh=True)
+                    if not message:
+                        raise
+                    media = message.file.media
+        except Exception as e:
+            for block in remaining:
+                future = self.fetching.pop((media.id, block), None)
+                if future and not future.done():
+                    future.set_exception(e)
+
+    def _iter_blocks(self, media, blocks: List[int]):
+        dc_id, location, size = get_media_location(media)
+        transferrer = ParallelTransferrer(
+            self.client,
+            dc_id,
+            self.resources.connection_budget,
+            self.resources.sender_pool,
+            rate_limiter=self.resources.rate_limiter,
+            retry_policy=self.resources.retry_policy,
+            use_cdn=self.use_cdn,
+            executor=self.resources.writer_executor,
+            buffers=self.resources.buffer_pool,
+        )
+        return transferrer.iter_parts(
+            location,
+            size,
+            part_size_kb=BLOCK_SIZE // 1024,
+            connection_count=min(len(blocks), 4),
+            parts=blocks,
+        )
+
+    async def close(self):
+        for task in list(self.prefetches):
+            task.cancel()
+        await asyncio.gather(*self.prefetches, return_exceptions=True)
+
+
+class MediaServer:
+    """Local HTTP server that streams channel media while it downloads.
+
+    ``GET /<channel>/<message_id>`` answers with the media of that message
+    and supports ``Range`` requests, so players can start quickly and seek.
+    """
+
+    def __init__(
+        self, streamer: MediaStreamer, host: str = "127.0.0.1", port: int = 8080
+    ):
+        self.streamer = streamer
+        self.host = host
+        self.port = port
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def serve_forever(self):
+        await self.server.serve_forever()
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        await self.streamer.close()
+
+    @staticmethod
+    def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+        """Get the inclusive byte range of a ``Range`` header, ``None`` if invalid"""
+        match = RANGE_PATTERN.match(header.strip()) if header else None
+        if not match or match.groups() == ("", ""):
+            return None
+        start, end = match.groups()
+        if not start:
+            # The last ``end`` bytes, a zero-length suffix is unsatisfiable
+            if not int(end):
+                return None
+            return max(0, size - int(end)), size - 1
+        end = min(int(end), size - 1) if end else size - 1
+        if int(start) > end:
+            return None
+        return int(start), end
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1")
+                if not line.strip():
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) < 2 or request_line[0] not in ("GET", "HEAD"):
+                await self._respond(writer, "405 Method Not Allowed")
+                return
+            await self._serve(writer, request_line[0], request_line[1], headers)
+        except (*CONNECTION_ERRORS, asyncio.IncompleteReadError):
+            # The player closed the connection, e.g. to seek
+            pass
+        except Exception as e:
+            print(f"Failed to serve a request: {type(e).__name__} - {e}")
+            try:
+                await self._respond(writer, "500 Internal Server Error")
+            except (*CONNECTION_ERRORS, RuntimeError):
+                pass
+        finally:
+            writer.close()
+
+    async def _serve(
+        self, writer: asyncio.StreamWriter, method: str, path: str, headers
+    ):
+        parts = [unquote(part) for part in path.split("?")[0].strip("/").split("/")]
+        if len(parts) != 2 or not parts[1].isdigit():
+            await self._respond(writer, "404 Not Found")
+            return
+        channel, message_id = parts[0], int(parts[1])
+        try:
+            message = await self.streamer.get_message(channel, message_id)
+        except (ValueError, errors.RPCError):
+            message = None
+        if not message:
+            await self._respond(writer, "404 Not Found")
+            return
+
+        size = get_media_location(message.media)[2]
+        status, start, end = "200 OK", 0, size - 1
+        if "range" in headers:
+            byte_range = self.parse_range(headers["range"], size)
+            if not byte_range:
+                await self._respond(
+                    writer,
+                    "416 Range Not Satisfiable",
+                    {"Content-Range": f"bytes */{size}"},
+                )
+                return
+            status, (start, end) = "206 Partial Content", byte_range
+        response_headers = {
+            "Content-Type": message.file.mime_type or "application/octet-stream",
+            "Content-Length": str(end - start + 1),
+            "Accept-Ranges": "bytes",
+        }
+        if status.startswith("206"):
+            response_headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        await self._respond(writer, status, response_headers, send_length=False)
+        if method == "HEAD":
+            return
+
+        for block in range(start // BLOCK_SIZE, end // BLOCK_SIZE + 1):
+            try:
+                data = await self.streamer.read_block(channel, message_id, block)
+            except CONNECTION_ERRORS:
+                raise
+            except Exception as e:
+                # The headers are out, closing early tells the player it was cut off
+                print(
+                    f"Failed to stream {channel}/{message_id}: "
+                    f"{type(e).__name__} - {e}"
+                )
+                return
+            block_start = block * BLOCK_SIZE
+            writer.write(data[max(start - block_start, 0) : end - block_start + 1])
+            await writer.drain()
+
+    @staticmethod
+    async def _respond(
+        writer: asyncio.StreamWriter,
+        status: str,
+        headers: Optional[Dict[str, str]] = None,
+        send_length: bool = True,
+    ):
+        headers = dict(headers or {})
+        if send_length:
+            headers.setdefault("Content-Length", "0")
+        lines = [f"HTTP/1.1 {status}", "Connection: close"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
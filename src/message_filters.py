@@ -0,0 +1,104 @@
+from typing import AsyncGenerator, Iterable, List, Optional
+
+from telethon import TelegramClient
+from telethon.tl.types import (
+    InputMessagesFilterDocument,
+    InputMessagesFilterGif,
+    InputMessagesFilterMusic,
+    InputMessagesFilterPhotos,
+    InputMessagesFilterRoundVideo,
+    InputMessagesFilterVideo,
+    InputMessagesFilterVoice,
+    TypeMessagesFilter,
+)
+
+AUDIO_FORMATS = {
+    "mp3",
+    "wav",
+    "m4a",
+    "ogg",
+    "oga",
+    "aac",
+    "wma",
+    "flac",
+    "aiff",
+    "alac",
+    "opus",
+}
+VIDEO_FORMATS = {"mp4", "mkv", "webm", "mov", "avi", "m4v", "3gp"}
+PHOTO_FORMATS = {"jpg", "jpeg", "png", "webp"}
+
+
+def get_message_filters(
+    allowed_formats: Iterable[str], download_all: bool
+) -> List[Optional[TypeMessagesFilter]]:
+    """Get the server side search filters that cover the allowed formats.
+
+    Telegram files media by how it was sent, so audio, videos and images that
+    were sent as plain files only show up under the document filter. That one
+    is therefore always included. ``[None]`` means no filter can be applied.
+    """
+    if download_all:
+        return [None]
+
+    filters = {InputMessagesFilterDocument}
+    for file_format in allowed_formats:
+        file_format = file_format.lower()
+        if file_format in AUDIO_FORMATS:
+            filters |= {InputMessagesFilterMusic, InputMessagesFilterVoice}
+        elif file_format in VIDEO_FORMATS:
+            filters |= {InputMessagesFilterVideo, InputMessagesFilterRoundVideo}
+            if file_format == "mp4":
+                filters.add(InputMessagesFilterGif)
+        elif file_format in PHOTO_FORMATS:
+            filters.add(InputMessagesFilterPhotos)
+    return [message_filter() for message_filter in sorted(filters, key=str)]
+
+
+async def count_messages(
+    client: TelegramClient,
+    entity,
+    filters: List[Optional[TypeMessagesFilter]],
+    **options,
+) -> int:
+    """Count the messages matching any of the filters without fetching them"""
+    total = 0
+    for message_filter in filters:
+        messages = await client.get_messages(
+            entity, limit=0, filter=message_filter, **options
+        )
+        total += messages.total
+    return total
+
+
+async def iter_filtered_messages(
+    client: TelegramClient,
+    entity,
+    filters: List[Optional[TypeMessagesFilter]],
+    limit: Optional[int] = None,
+    reverse: bool = False,
+    **options,
+) -> AsyncGenerator:
+    """Merge one message scan per filter into a single scan in message order"""
+    scans = [
+        client.iter_messages(
+            entity, limit=limit, reverse=reverse, filter=message_filter, **options
+        ).__aiter__()
+        for message_filter in filters
+    ]
+    heads = [await anext(scan, None) for scan in scans]
+    seen = set()
+    while limit is None or len(seen) < limit:
+        candidates = [
+            (message.id, index)
+            for index, message in enumerate(heads)
+            if message is not None
+        ]
+        if not candidates:
+            break
+        _, index = min(candidates) if reverse else max(candidates)
+        message = heads[index]
+        heads[index] = await anext(scans[index], None)
+        if message.id not in seen:
+            seen.add(message.id)
+            yield message
@@ -0,0 +1,451 @@
+import asyncio
+import json
+import math
+import os
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+LabelValues = Tuple[str, ...]
+
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+THROUGHPUT_BUCKETS = tuple(
+    mb * 1024 * 1024 for mb in (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100)
+)
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class _GaugeValue(_Value):
+    __slots__ = ()
+
+    def set(self, value: float):
+        self.value = value
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    """A named metric with one value per combination of label values.
+
+    Hot paths should keep the object returned by :meth:`labels` instead of
+    looking it up for every update, updating it is a plain addition.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[LabelValues, object] = {}
+
+    def _new_value(self):
+        return _Value()
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = self._new_value()
+        return child
+
+    def samples(self) -> List[Tuple[Dict[str, str], object]]:
+        return [
+            (dict(zip(self.labelnames, key)), child)
+            for key, child in list(self.children.items())
+        ]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        function: Optional[Callable[[], float]] = None,
+    ):
+        super().__init__(name, help, labelnames)
+        # Evaluated when the metrics are read, nothing to update on the hot path
+        self.function = function
+
+    def _new_value(self):
+        return _GaugeValue()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def samples(self) -> List[Tuple[Dict[str, str], object]]:
+        if self.function:
+            value = _GaugeValue()
+            value.set(self.function())
+            return [({}, value)]
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+
+class MetricsRegistry:
+    """All metrics of the process, rendered as Prometheus text or JSON"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        # Registering again returns the existing metric, so modules can be reloaded
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        function: Optional[Callable[[], float]] = None,
+    ) -> Gauge:
+        gauge = self.register(Gauge(name, help, labelnames))
+        if function:
+            gauge.function = function
+        return gauge
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for labels, value in metric.samples():
+                if isinstance(value, _HistogramValue):
+                    cumulative = 0
+                    for bound, count in zip((*value.buckets, math.inf), value.counts):
+                        cumulative += count
+                        bucket_labels = {**labels, "le": _format_bound(bound)}
+                        lines.append(
+                            f"{metric.name}_bucket{_format_labels(bucket_labels)} "
+                            f"{cumulative}"
+                        )
+                    lines.append(
+                        f"{metric.name}_sum{_format_labels(labels)} {value.sum}"
+                    )
+                    lines.append(
+                        f"{metric.name}_count{_format_labels(labels)} {value.count}"
+                    )
+                else:
+                    lines.append(
+                        f"{metric.name}{_format_labels(labels)} "
+                        f"{_format_value(value.value)}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, object]:
+        snapshot = {}
+        for metric in self.metrics.values():
+            samples = []
+            for labels, value in metric.samples():
+                if isinstance(value, _HistogramValue):
+                    samples.append(
+                        {
+                            "labels": labels,
+                            "count": value.count,
+                            "sum": value.sum,
+                            "buckets": dict(
+                                zip(
+                                    map(_format_bound, (*value.buckets, math.inf)),
+                                    value.counts,
+                                )
+                            ),
+                        }
+                    )
+                else:
+                    samples.append({"labels": labels, "value": value.value})
+            snapshot[metric.name] = {"type": metric.type, "samples": samples}
+        return snapshot
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == math.inf else f"{bound:g}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+    return "{" + escaped + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsExporter:
+    """Serves the registry over HTTP and/or writes periodic JSON snapshots.
+
+    ``GET /metrics`` returns the Prometheus text format and
+    ``GET /metrics.json`` the same snapshot that goes into ``snapshot_path``,
+    which includes per-second rates of the counters since the previous one.
+    """
+
+    def __init__(
+        self,
+        registry: "MetricsRegistry",
+        host: str = "127.0.0.1",
+        port: int = 0,
+        snapshot_path: Optional[str] = None,
+        interval: float = 10.0,
+    ):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.writer_task: Optional[asyncio.Task] = None
+        self.previous: Optional[Tuple[float, Dict[str, object]]] = None
+
+    async def start(self):
+        if self.port:
+            self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        if self.snapshot_path:
+            self.writer_task = asyncio.create_task(self._write_periodically())
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if self.writer_task:
+            self.writer_task.cancel()
+            await asyncio.gather(self.writer_task, return_exceptions=True)
+            self.writer_task = None
+            # The last snapshot holds the totals of the whole run
+            self.write_snapshot()
+
+    def json_snapshot(self) -> Dict[str, object]:
+        now = time.time()
+        metrics = self.registry.snapshot()
+        rates = {}
+        if self.previous:
+            previous_time, previous_metrics = self.previous
+            elapsed = now - previous_time
+            for name, metric in metrics.items():
+                if metric["type"] != "counter" or name not in previous_metrics:
+                    continue
+                before = {
+                    json.dumps(sample["labels"], sort_keys=True): sample["value"]
+                    for sample in previous_metrics[name]["samples"]
+                }
+                rates[name] = [
+                    {
+                        "labels": sample["labels"],
+                        "per_second": (
+                            sample["value"]
+                            - before.get(
+                                json.dumps(sample["labels"], sort_keys=True), 0
+                            )
+                        )
+                        / elapsed,
+                    }
+                    for sample in metric["samples"]
+                ]
+        self.previous = (now, metrics)
+        return {"time": now, "metrics": metrics, "rates": rates}
+
+    def write_snapshot(self):
+        temp_path = f"{self.snapshot_path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.json_snapshot(), file, indent=2)
+        os.replace(temp_path, self.snapshot_path)
+
+    async def _write_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                print(f"Could not write metrics snapshot: {e}")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # Headers are not needed, but have to be read before answering
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            path = parts[1].split("?")[0] if len(parts) > 1 else ""
+            if path == "/metrics":
+                status = "200 OK"
+                content_type = "text/plain; version=0.0.4"
+                body = self.registry.render_prometheus().encode()
+            elif path == "/metrics.json":
+                status = "200 OK"
+                content_type = "application/json"
+                body = json.dumps(
+                    {"time": time.time(), "metrics": self.registry.snapshot()}
+                ).encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b""
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+registry = MetricsRegistry()
+
+# Updated by the transfer engine for every part
+downloaded_bytes = registry.counter(
+    "tgdl_downloaded_bytes_total", "Bytes received from telegram", ["dc"]
+)
+uploaded_bytes = registry.counter(
+    "tgdl_uploaded_bytes_total", "Bytes sent to telegram", ["dc"]
+)
+downloaded_parts = registry.counter(
+    "tgdl_downloaded_parts_total", "File parts received from telegram", ["dc"]
+)
+part_latency = registry.histogram(
+    "tgdl_part_latency_seconds", "Time from requesting a part to receiving it", ["dc"]
+)
+part_retries = registry.counter(
+    "tgdl_part_retries_total", "Part requests that were retried", ["dc", "reason"]
+)
+flood_wait_seconds = registry.counter(
+    "tgdl_flood_wait_seconds_total", "Seconds telegram asked us to wait", ["dc"]
+)
+reconnects = registry.counter(
+    "tgdl_reconnects_total", "Connections replaced after they failed", ["dc"]
+)
+cdn_redirects = registry.counter(
+    "tgdl_cdn_redirects_total", "Files telegram sent from a CDN DC instead", ["dc"]
+)
+file_throughput = registry.histogram(
+    "tgdl_file_throughput_bytes_per_second",
+    "Throughput of every completed file transfer",
+    ["dc"],
+    THROUGHPUT_BUCKETS,
+)
+# Updated per file and channel
+files = registry.counter(
+    "tgdl_files_total", "Messages handled by result", ["channel", "result"]
+)
+saved_bytes = registry.counter(
+    "tgdl_deduplicated_bytes_total", "Bytes linked from local copies", ["channel"]
+)
+queue_depth = registry.gauge(
+    "tgdl_queue_depth", "Downloads waiting for a free slot", ["channel"]
+)
+active_downloads = registry.gauge(
+    "tgdl_active_downloads", "Downloads currently running", ["channel"]
+)
+completed_bytes = registry.counter(
+    "tgdl_completed_bytes_total", "Size of the files downloaded", ["channel"]
+)
+# Updated per file and account
+account_bytes = registry.counter(
+    "tgdl_account_downloaded_bytes_total",
+    "Size of the files each account downloaded",
+    ["account"],
+)
+account_active_downloads = registry.gauge(
+    "tgdl_account_active_downloads", "Downloads running on each account", ["account"]
+)
+account_failovers = registry.counter(
+    "tgdl_account_failovers_total",
+    "Downloads moved off an account after a long flood wait",
+    ["account"],
+)
+
+
+class TransferMetrics:
+    """The metrics of one DC, looked up once per transfer instead of for every part"""
+
+    def __init__(self, dc_id: int):
+        dc = str(dc_id)
+        self.bytes = downloaded_bytes.labels(dc=dc)
+        self.parts = downloaded_parts.labels(dc=dc)
+        self.uploaded_bytes = uploaded_bytes.labels(dc=dc)
+        self.latency = part_latency.labels(dc=dc)
+        self.flood_wait_seconds = flood_wait_seconds.labels(dc=dc)
+        self.reconnects = reconnects.labels(dc=dc)
+        self.cdn_redirects = cdn_redirects.labels(dc=dc)
+        self.file_throughput = file_throughput.labels(dc=dc)
+        self.retries = {
+            reason: part_retries.labels(dc=dc, reason=reason)
+            for reason in (
+                "flood_wait",
+                "server_error",
+                "connection_error",
+                "hash_mismatch",
+                "cdn_reupload",
+            )
+        }
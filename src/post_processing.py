@@ -0,0 +1,141 @@
+import asyncio
+import importlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Set
+
+from telethon.tl.types import DocumentAttributeAudio, MessageMediaDocument
+
+from src.deduplication import hash_file
+
+
+def get_metadata(channel: str, message, path: str, sha256: Optional[str]) -> Dict:
+    """Collect what the sidecar and hooks get to know about a downloaded file.
+
+    Runs in the event loop, so the worker processes only receive plain values
+    instead of telethon objects.
+    """
+    metadata = {
+        "channel": channel,
+        "message_id": message.id,
+        "date": message.date.isoformat() if message.date else None,
+        "caption": message.message or None,
+        "path": path,
+        "size": os.path.getsize(path),
+        "mime_type": message.file.mime_type if message.file else None,
+        "sha256": sha256,
+    }
+    if isinstance(message.media, MessageMediaDocument):
+        for attribute in message.media.document.attributes:
+            if isinstance(attribute, DocumentAttributeAudio):
+                metadata.update(
+                    title=attribute.title,
+                    performer=attribute.performer,
+                    duration=attribute.duration,
+                    voice=bool(attribute.voice),
+                )
+    return metadata
+
+
+def load_hook(name: str) -> Callable[[str, Dict], None]:
+    """Import a hook given as ``package.module:function``"""
+    module_name, _, function_name = name.partition(":")
+    if not function_name:
+        raise ValueError(f"Hook {name} must look like module:function")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def process_file(metadata: Dict, sidecar: bool, hooks: List[str]) -> Dict:
+    """Hash, describe and hand over one file, in a worker process"""
+    path = metadata["path"]
+    if not metadata["sha256"]:
+        # Only when the download resumed parts that were never hashed
+        metadata["sha256"] = hash_file(path)
+    if sidecar:
+        temp_path = f"{path}.json.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(metadata, file, indent=2, ensure_ascii=False)
+        os.replace(temp_path, f"{path}.json")
+    for hook in hooks:
+        load_hook(hook)(path, metadata)
+    return metadata
+
+
+class PostProcessor:
+    """Runs :func:`process_file` for finished downloads on a process pool.
+
+    :meth:`submit` only waits when ``max_pending`` files are already queued, so
+    downloads continue while earlier files are processed. ``on_processed`` is
+    called in the event loop with the metadata of every processed file.
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        sidecars: bool = False,
+        hooks: Optional[List[str]] = None,
+        on_processed: Optional[Callable[[Dict], None]] = None,
+        max_pending: Optional[int] = None,
+    ):
+        self.workers = max(1, workers)
+        self.sidecars = sidecars
+        self.hooks = list(hooks or [])
+        self.on_processed = on_processed
+        self.slots = asyncio.Semaphore(max_pending or self.workers * 4)
+        self.pending: Set[asyncio.Future] = set()
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.processed = 0
+        self.failed = 0
+
+    async def submit(self, channel: str, message, path: str, sha256: Optional[str]):
+        metadata = get_metadata(channel, message, path, sha256)
+        if sha256 and not self.sidecars and not self.hooks:
+            # Nothing left that needs a worker
+            self._processed(metadata)
+            return
+        if not self.executor:
+            # Started on first use, so runs without post-processing fork nothing.
+            # Forking this process copies the locks of its writer and progress
+            # threads, so workers start from a clean forkserver or interpreter
+            methods = multiprocessing.get_all_start_methods()
+            self.executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context(
+                    "forkserver" if "forkserver" in methods else "spawn"
+                ),
+            )
+        await self.slots.acquire()
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, process_file, metadata, self.sidecars, self.hooks
+        )
+        self.pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future: asyncio.Future):
+        self.pending.discard(future)
+        self.slots.release()
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error:
+            self.failed += 1
+            print(f"Post-processing failed: {type(error).__name__} - {error}")
+            return
+        self._processed(future.result())
+
+    def _processed(self, metadata: Dict):
+        self.processed += 1
+        if self.on_processed:
+            self.on_processed(metadata)
+
+    async def join(self):
+        while self.pending:
+            await asyncio.wait(list(self.pending))
+
+    async def close(self):
+        await self.join()
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
@@ -1,35 +1,161 @@
+import threading
+from itertools import count
+from typing import Dict, Iterable, List, Sequence, Union
+
 from rich.progress import (
     BarColumn,
     DownloadColumn,
     Progress,
+    ProgressColumn,
+    Task,
+    TaskID,
     TaskProgressColumn,
     TextColumn,
     TimeElapsedColumn,
     TimeRemainingColumn,
     TransferSpeedColumn,
 )
+from rich.table import Column, Table
+from rich.text import Text
+
+TOTAL_COLUMNS = (
+    TextColumn("[progress.description]{task.description}"),
+    BarColumn(),
+    TaskProgressColumn(),
+    TextColumn("{task.completed}/{task.total}"),
+    TimeElapsedColumn(),
+    TimeRemainingColumn(),
+)
+DOWNLOAD_COLUMNS = (
+    TextColumn("[bold blue]{task.description}"),
+    BarColumn(),
+    TaskProgressColumn(),
+    DownloadColumn(),
+    TransferSpeedColumn(),
+    TimeElapsedColumn(),
+    TimeRemainingColumn(),
+)
+
+
+def make_table(
+    columns: Sequence[Union[str, ProgressColumn]], tasks: Iterable[Task]
+) -> Table:
+    """Like ``Progress.make_tasks_table``, but with the given columns"""
+    table = Table.grid(
+        *(
+            (
+                Column(no_wrap=True)
+                if isinstance(column, str)
+                else column.get_table_column().copy()
+            )
+            for column in columns
+        ),
+        padding=(0, 1),
+    )
+    for task in tasks:
+        if task.visible:
+            table.add_row(
+                *(
+                    (
+                        column.format(task=task)
+                        if isinstance(column, str)
+                        else column(task)
+                    )
+                    for column in columns
+                )
+            )
+    return table
 
 
 class MultipleProgress(Progress):
+    """Channel totals, the first ``max_rows`` downloads and a summary line.
+
+    Downloads report their progress with :meth:`set_completed`, which only
+    stores the value; it is applied once per refresh, so a callback for every
+    part costs a dictionary assignment instead of a full update. The render
+    thread swaps the pending values out under ``_pending_lock``.
+    """
+
+    def __init__(self, *args, max_rows: int = 10, **kwargs):
+        self.max_rows = max_rows
+        self._pending: Dict[TaskID, float] = {}
+        self._pending_lock = threading.Lock()
+        kwargs.setdefault("refresh_per_second", 4)
+        super().__init__(*args, **kwargs)
+
+    def set_completed(self, task_id: TaskID, completed: float):
+        with self._pending_lock:
+            self._pending[task_id] = completed
+
+    def remove_task(self, task_id: TaskID):
+        with self._pending_lock:
+            self._pending.pop(task_id, None)
+        super().remove_task(task_id)
+
+    def apply_pending(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        with self._lock:
+            for task_id, completed in pending.items():
+                if task_id in self._tasks:
+                    self.update(task_id, completed=completed)
+
     def get_renderables(self):
-        for task in self.tasks:
-            if task.fields.get("progress_type") == "total":
-                self.columns = (
-                    TextColumn("[progress.description]{task.description}"),
-                    BarColumn(),
-                    TaskProgressColumn(),
-                    TextColumn("{task.completed}/{task.total}"),
-                    TimeElapsedColumn(),
-                    TimeRemainingColumn(),
-                )
-            elif task.fields.get("progress_type") == "download":
-                self.columns = (
-                    TextColumn("[bold blue]{task.description}"),
-                    BarColumn(),
-                    TaskProgressColumn(),
-                    DownloadColumn(),
-                    TransferSpeedColumn(),
-                    TimeElapsedColumn(),
-                    TimeRemainingColumn(),
-                )
-            yield self.make_tasks_table([task])
+        self.apply_pending()
+        tasks = self.tasks
+        totals = [t for t in tasks if t.fields.get("progress_type") == "total"]
+        downloads = [t for t in tasks if t.fields.get("progress_type") == "download"]
+        if totals:
+            yield make_table(TOTAL_COLUMNS, totals)
+        if downloads:
+            yield make_table(DOWNLOAD_COLUMNS, downloads[: self.max_rows])
+            yield self.make_summary(downloads)
+
+    def make_summary(self, downloads: List[Task]) -> Text:
+        speed = sum(task.speed or 0 for task in downloads)
+        completed = sum(task.completed for task in downloads)
+        total = sum(task.total or 0 for task in downloads)
+        hidden = len(downloads) - self.max_rows
+        return Text(
+            f"{len(downloads)} downloads"
+            + (f" ({hidden} not shown)" if hidden > 0 else "")
+            + f", {completed / 1024 / 1024:.1f}/{total / 1024 / 1024:.1f} MB"
+            + f", {speed / 1024 / 1024:.1f} MB/s",
+            style="bold",
+        )
+
+
+class NullProgress:
+    """Same interface as :class:`MultipleProgress` without any terminal output"""
+
+    def __init__(self, *args, **kwargs):
+        self._ids = count()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def add_task(self, description: str, *args, **kwargs) -> TaskID:
+        return TaskID(next(self._ids))
+
+    def update(self, task_id: TaskID, *args, **kwargs):
+        pass
+
+    def advance(self, task_id: TaskID, advance: float = 1):
+        pass
+
+    def set_completed(self, task_id: TaskID, completed: float):
+        pass
+
+    def remove_task(self, task_id: TaskID):
+        pass
+
+
+def create_progress(
+    headless: bool = False, max_rows: int = 10
+) -> Union[MultipleProgress, NullProgress]:
+    if headless:
+        return NullProgress()
+    return MultipleProgress(max_rows=max_rows)
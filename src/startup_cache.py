@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from pydantic import BaseModel
+from telethon import TelegramClient, utils
+from telethon.crypto import AuthKey
+from telethon.tl.types import Channel, DcOption, InputPeerChannel
+
+
+class CachedChannel(BaseModel):
+    id: int
+    access_hash: int
+    title: str
+    resolved_at: float
+
+    @property
+    def input_peer(self) -> InputPeerChannel:
+        return InputPeerChannel(self.id, self.access_hash)
+
+
+class CachedDC(BaseModel):
+    ip_address: str
+    port: int
+
+
+class AccountCache(BaseModel):
+    """What one login resolved, access hashes and auth keys only work for it"""
+
+    channels: Dict[str, CachedChannel] = {}
+    # Authorized keys of the other DCs in hex, by DC ID
+    auth_keys: Dict[str, str] = {}
+
+
+class StartupCache:
+    """What a run resolves before its first download, kept for the next run.
+
+    Channels resolved within ``entity_ttl`` seconds, the addresses of DCs and
+    the auth keys exported to them let a run start downloading without asking
+    telegram for any of them again. Entries are grouped by login, so a new
+    session never uses what an old one resolved. The file holds auth keys and
+    is only readable by its owner.
+    """
+
+    def __init__(self, path: Optional[str] = None, entity_ttl: float = 24 * 3600):
+        self.path = path
+        self.entity_ttl = entity_ttl
+        self.accounts: Dict[str, AccountCache] = {}
+        self.dcs: Dict[str, CachedDC] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as file:
+                    state = json.load(file)
+                self.accounts = {
+                    key: AccountCache(**account)
+                    for key, account in state.get("accounts", {}).items()
+                }
+                self.dcs = {
+                    key: CachedDC(**dc) for key, dc in state.get("dcs", {}).items()
+                }
+            except (OSError, ValueError, TypeError):
+                self.accounts, self.dcs = {}, {}
+
+    def account(self, client: TelegramClient) -> AccountCache:
+        # A new login gets a new auth key and starts with an empty cache
+        key = hashlib.sha256(client.session.auth_key.key).hexdigest()[:16]
+        return self.accounts.setdefault(key, AccountCache())
+
+    def get_channel(
+        self, client: TelegramClient, channel: str
+    ) -> Optional[CachedChannel]:
+        cached = self.account(client).channels.get(channel)
+        if cached and time.time() - cached.resolved_at < self.entity_ttl:
+            return cached
+        return None
+
+    def set_channel(self, client: TelegramClient, channel: str, entity):
+        self.account(client).channels[channel] = CachedChannel(
+            id=entity.id,
+            access_hash=entity.access_hash,
+            title=entity.title,
+            resolved_at=time.time(),
+        )
+
+    def forget_channel(self, client: TelegramClient, channel: str):
+        self.account(client).channels.pop(channel, None)
+
+    @staticmethod
+    def _dc_key(dc_id: int, cdn: bool, ipv6: bool) -> str:
+        return f"{'cdn' if cdn else 'dc'}{dc_id}{'-ipv6' if ipv6 else ''}"
+
+    def get_dc(self, dc_id: int, cdn: bool, ipv6: bool) -> Optional[DcOption]:
+        cached = self.dcs.get(self._dc_key(dc_id, cdn, ipv6))
+        if not cached:
+            return None
+        return DcOption(
+            id=dc_id,
+            ip_address=cached.ip_address,
+            port=cached.port,
+            ipv6=ipv6,
+            cdn=cdn,
+        )
+
+    def set_dc(self, dc: DcOption, ipv6: bool):
+        self.dcs[self._dc_key(dc.id, bool(dc.cdn), ipv6)] = CachedDC(
+            ip_address=dc.ip_address, port=dc.port
+        )
+
+    def forget_dc(self, dc_id: int, cdn: bool, ipv6: bool):
+        self.dcs.pop(self._dc_key(dc_id, cdn, ipv6), None)
+
+    def get_auth_key(self, client: TelegramClient, dc_id: int) -> Optional[AuthKey]:
+        key = self.account(client).auth_keys.get(str(dc_id))
+        return AuthKey(bytes.fromhex(key)) if key else None
+
+    def set_auth_key(self, client: TelegramClient, dc_id: int, auth_key: AuthKey):
+        self.account(client).auth_keys[str(dc_id)] = auth_key.key.hex()
+
+    def forget_auth_key(self, client: TelegramClient, dc_id: int):
+        self.account(client).auth_keys.pop(str(dc_id), None)
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = f"{self.path}.tmp"
+        # Created without permissions for others, the auth keys are logins
+        descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        if hasattr(os, "fchmod"):
+            # A temporary file left by a crashed run keeps its old permissions
+            os.fchmod(descriptor, 0o600)
+        with os.fdopen(descriptor, "w") as file:
+            json.dump(
+                {
+                    "accounts": {
+                        key: account.model_dump()
+                        for key, account in self.accounts.items()
+                    },
+                    "dcs": {key: dc.model_dump() for key, dc in self.dcs.items()},
+                },
+                file,
+                indent=2,
+            )
+        os.replace(temp_path, self.path)
+
+
+async def resolve_channel(
+    client: TelegramClient, channel: str, cache: Optional[StartupCache] = None
+) -> Tuple[object, str]:
+    """Get an input peer and the title of ``channel``, from ``cache`` while fresh"""
+    cached = cache.get_channel(client, channel) if cache else None
+    if cached:
+        return cached.input_peer, cached.title
+    entity = await client.get_entity(channel)
+    if cache and isinstance(entity, Channel) and entity.access_hash is not None:
+        cache.set_channel(client, channel, entity)
+    return entity, utils.get_display_name(entity)
@@ -1,10 +1,27 @@
-from typing import Optional
+import asyncio
+import signal
+import time
+from typing import Dict, Optional
 
-from telethon import TelegramClient
+from telethon import TelegramClient, errors
 
+from src import metrics
+from src.buffer_pool import peak_rss
 from src.config import settings
-from src.download_manager import DownloadManager
-from src.progress import MultipleProgress
+from src.download_manager import DownloadManager, DownloadResources
+from src.download_plan import DownloadPlan, print_plan
+from src.download_scheduler import DownloadScheduler
+from src.message_filters import (
+    count_messages,
+    get_message_filters,
+    iter_filtered_messages,
+)
+from src.progress import MultipleProgress, create_progress
+from src.startup_cache import resolve_channel
+from src.startup_profile import profile
+
+# Messages whose local checks run together, matching telethon's request size
+SCAN_BATCH_SIZE = 100
 
 
 class TelegramDownloader:
@@ -12,61 +29,486 @@ class TelegramDownloader:
         self.api_id = settings.API_ID
         self.api_hash = settings.API_HASH
         self.phone_number = settings.PHONE_NUMBER
-        self.channel_username = settings.CHANNEL_USERNAME
+        self.channel_usernames = settings.CHANNELS
         self.client: Optional[TelegramClient] = None
-        self.download_manager: Optional[DownloadManager] = None
+        self.extra_clients: Dict[str, TelegramClient] = {}
+        self.resources: Optional[DownloadResources] = None
+        self.download_managers: Dict[str, DownloadManager] = {}
+        self.metrics_exporter = metrics.MetricsExporter(
+            metrics.registry,
+            settings.METRICS_HOST,
+            settings.METRICS_PORT,
+            settings.METRICS_FILE or None,
+            settings.METRICS_INTERVAL,
+        )
 
     async def initialize(self):
         self.client = TelegramClient("session_name", self.api_id, self.api_hash)
         await self.client.start(self.phone_number)
-        self.download_manager = DownloadManager(self.client)
+        for session_file in settings.SESSION_FILES:
+            # Asks for the phone number and code the first time
+            extra_client = TelegramClient(session_file, self.api_id, self.api_hash)
+            await extra_client.start()
+            self.extra_clients[session_file] = extra_client
+        profile.mark("login")
+        # One login, connection pool and download budget per account for every channel
+        self.resources = DownloadResources(self.client, self.extra_clients)
+        if self.resources.mirror:
+            await self.resources.mirror.start()
+        self.download_managers = {
+            channel_username: DownloadManager(
+                self.client, channel_username, self.resources
+            )
+            for channel_username in self.channel_usernames
+        }
+        profile.mark("setup")
+        await self.metrics_exporter.start()
+        if settings.METRICS_PORT:
+            print(
+                f"Metrics on http://{settings.METRICS_HOST}:{settings.METRICS_PORT}/metrics"
+            )
         return self
 
     async def close(self):
+        await self.metrics_exporter.close()
+        if self.resources:
+            await self.resources.close()
+        for extra_client in self.extra_clients.values():
+            await extra_client.disconnect()
         await self.client.disconnect()
 
-    async def download_channel_media(self):
+    async def download_all_channels(self):
         if not await self.client.is_user_authorized():
             print("Authorization failed!")
             return
 
-        channel = await self.client.get_entity(self.channel_username)
-        print(f"Downloading media from: {channel.title}")
         if settings.DEBUG:
             print(
                 f"Allowed formats: {'all' if settings.DOWNLOAD_ALL else ', '.join(settings.ALLOWED_FORMATS)}"
             )
 
+        await self.download_channels(self.download_channel_media)
+
+    async def download_channels(self, download_channel, *args):
+        """Run ``download_channel`` for every channel, sharing one scheduler"""
+        started = time.monotonic()
+        with create_progress(settings.HEADLESS, settings.PROGRESS_ROWS) as progress:
+            # Every account brings its own connections for more downloads
+            async with DownloadScheduler(
+                settings.MAX_CONCURRENT_DOWNLOADS * len(self.resources.accounts)
+            ) as scheduler:
+                results = await asyncio.gather(
+                    *[
+                        download_channel(download_manager, scheduler, progress, *args)
+                        for download_manager in self.download_managers.values()
+                    ],
+                    return_exceptions=True,
+                )
+            if self.resources.mirror:
+                # Uploads still queued when the last download finished
+                await self.resources.mirror.join()
+            if self.resources.post_processor:
+                await self.resources.post_processor.join()
+        # Plans estimate their duration from the speed of earlier runs
+        self.resources.manifest.record_run(
+            int(
+                sum(child.value for child in metrics.completed_bytes.children.values())
+            ),
+            time.monotonic() - started,
+        )
+        # A failing channel must not stop the others
+        for channel_username, result in zip(self.download_managers, results):
+            if isinstance(result, Exception):
+                self.forget_channel(channel_username)
+                print(f"Failed {channel_username}: {type(result).__name__} - {result}")
+
+    async def download_channel_media(
+        self,
+        download_manager: DownloadManager,
+        scheduler: DownloadScheduler,
+        progress: MultipleProgress,
+    ):
+        channel_username = download_manager.channel
+        resolved = await self.resolve_channel(channel_username)
+        if not resolved:
+            return
+        channel, title = resolved
+        print(f"Downloading media from: {title}")
+
+        scan_options, unfinished_messages, message_filters = await self.prepare_scan(
+            download_manager, channel
+        )
+        matching_messages = await count_messages(
+            self.client,
+            channel,
+            message_filters,
+            min_id=scan_options.get("min_id", 0),
+        )
+
         # Get total message count for progress bar
-        total_messages = settings.HISTORY_LIMIT
-
-        with MultipleProgress() as progress:
-            self.download_manager.set_progress(progress)
-            channel_task = progress.add_task(
-                "[bold blue]Processing Messages",
-                total=total_messages,
-                progress_type="total",
+        total_messages = min(settings.HISTORY_LIMIT, matching_messages) + len(
+            unfinished_messages
+        )
+        channel_task, submit_batch = self.create_submitter(
+            download_manager, scheduler, progress, total_messages
+        )
+
+        await submit_batch(unfinished_messages)
+        # Keep scanning while earlier messages are still downloading
+        last_message_id = 0
+        scanned_messages = len(unfinished_messages)
+        batch = []
+        async for message in iter_filtered_messages(
+            self.client, channel, message_filters, **scan_options
+        ):
+            last_message_id = max(last_message_id, message.id)
+            scanned_messages += 1
+            batch.append(message)
+            if len(batch) >= SCAN_BATCH_SIZE:
+                await submit_batch(batch)
+                batch = []
+        await submit_batch(batch)
+        progress.update(channel_task, total=scanned_messages)
+        await scheduler.join(download_manager)
+        download_manager.manifest.set_last_message_id(channel_username, last_message_id)
+        progress.update(
+            channel_task,
+            description=f"[green]Download Complete 🎉 {channel_username}",
+        )
+
+    async def resolve_channel(self, channel_username: str):
+        """Get the input peer and title of a channel, None if it can't be resolved"""
+        try:
+            resolved = await resolve_channel(
+                self.client, channel_username, self.resources.startup_cache
+            )
+        except (ValueError, errors.RPCError) as e:
+            print(f"Skipping {channel_username}: {type(e).__name__} - {e}")
+            return None
+        profile.mark("resolve")
+        return resolved
+
+    async def prepare_scan(self, download_manager: DownloadManager, channel):
+        """Get the scan options, the unfinished messages and the server-side filters"""
+        channel_username = download_manager.channel
+        manifest = download_manager.manifest
+        scan_options = {
+            "limit": settings.HISTORY_LIMIT,
+            "reverse": settings.REVERSE_ORDER,
+        }
+        unfinished_messages = []
+        if settings.INCREMENTAL_SYNC:
+            last_message_id = manifest.get_last_message_id(channel_username)
+            if last_message_id:
+                # Walk forward from the last processed message so nothing is left behind,
+                # a first run keeps the configured order and limit
+                scan_options.update(min_id=last_message_id, reverse=True)
+            unfinished_ids = manifest.get_unfinished_message_ids(channel_username)
+            if unfinished_ids:
+                unfinished_messages = [
+                    message
+                    for message in await self.client.get_messages(
+                        channel, ids=unfinished_ids
+                    )
+                    if message
+                ]
+
+        # Let the server drop text and other media before it is sent to us
+        message_filters = get_message_filters(
+            settings.ALLOWED_FORMATS, settings.DOWNLOAD_ALL
+        )
+        return scan_options, unfinished_messages, message_filters
+
+    def create_submitter(
+        self,
+        download_manager: DownloadManager,
+        scheduler: DownloadScheduler,
+        progress: MultipleProgress,
+        total_messages: int,
+    ):
+        """Add the progress task of a channel and a function that queues its batches"""
+        download_manager.set_progress(progress)
+        channel_task = progress.add_task(
+            f"[bold blue]Processing Messages of {download_manager.channel}",
+            total=total_messages,
+            progress_type="total",
+        )
+
+        def handle_result(message, success: bool, result: str):
+            progress.advance(channel_task)
+            if success:
+                print(f"Downloaded: {result}")
+            elif "not allowed" in result and settings.DEBUG:
+                print(result)
+
+        async def submit_batch(batch: list):
+            if batch:
+                profile.mark("scan")
+            selected = download_manager.select_downloads(batch)
+            progress.advance(channel_task, len(batch) - len(selected))
+            for message in selected:
+                await scheduler.submit(download_manager, message, handle_result)
+
+        return channel_task, submit_batch
+
+    async def plan_channel(self, download_manager: DownloadManager, plan: DownloadPlan):
+        """Scan a channel like a run would and add its files to ``plan``"""
+        channel_username = download_manager.channel
+        resolved = await self.resolve_channel(channel_username)
+        if not resolved:
+            return
+        channel, title = resolved
+        print(f"Planning media from: {title}")
+
+        scan_options, unfinished_messages, message_filters = await self.prepare_scan(
+            download_manager, channel
+        )
+        plan.files.extend(download_manager.plan_downloads(unfinished_messages))
+        last_message_id = 0
+        batch = []
+        async for message in iter_filtered_messages(
+            self.client, channel, message_filters, **scan_options
+        ):
+            last_message_id = max(last_message_id, message.id)
+            batch.append(message)
+            if len(batch) >= SCAN_BATCH_SIZE:
+                plan.files.extend(download_manager.plan_downloads(batch))
+                batch = []
+        plan.files.extend(download_manager.plan_downloads(batch))
+        plan.add_channel(channel_username, title, last_message_id)
+
+    async def execute_channel_plan(
+        self,
+        download_manager: DownloadManager,
+        scheduler: DownloadScheduler,
+        progress: MultipleProgress,
+        plan: DownloadPlan,
+    ):
+        """Download the planned messages of a channel without scanning it"""
+        channel_username = download_manager.channel
+        if channel_username not in plan.channels:
+            return
+        resolved = await self.resolve_channel(channel_username)
+        if not resolved:
+            return
+        channel, title = resolved
+        print(f"Downloading planned media from: {title}")
+
+        message_ids = plan.get_message_ids(channel_username)
+        channel_task, submit_batch = self.create_submitter(
+            download_manager, scheduler, progress, len(message_ids)
+        )
+        for start in range(0, len(message_ids), SCAN_BATCH_SIZE):
+            # File references expire, so the messages are fetched again by ID
+            batch = await self.client.get_messages(
+                channel, ids=message_ids[start : start + SCAN_BATCH_SIZE]
             )
+            messages = [message for message in batch if message]
+            # Deleted since the plan was made
+            progress.advance(channel_task, len(batch) - len(messages))
+            await submit_batch(messages)
+        await scheduler.join(download_manager)
+        download_manager.manifest.set_last_message_id(
+            channel_username, plan.channels[channel_username].last_message_id
+        )
+        progress.update(
+            channel_task,
+            description=f"[green]Download Complete 🎉 {channel_username}",
+        )
 
-            async for message in self.client.iter_messages(
-                channel, limit=settings.HISTORY_LIMIT, reverse=settings.REVERSE_ORDER
-            ):
-                success, result = await self.download_manager.download_file(message)
-                progress.advance(channel_task)
-                if success:
-                    print(f"Downloaded: {result}")
-                elif "not allowed" in result and settings.DEBUG:
-                    print(result)
-            progress.update(channel_task, description="[green]Download Complete 🎉")
+    def forget_channel(self, channel_username: str):
+        """Resolve a channel again next time, its cached access hash may be stale"""
+        if self.resources.startup_cache:
+            self.resources.startup_cache.forget_channel(self.client, channel_username)
 
     def print_statistics(self):
-        statistics = self.download_manager.get_statistics()
-        print(f"Completed: {statistics['total_downloads']} files downloaded")
-        print(f"Skipped: {statistics['skipped_files']} existing files")
-        print(f"Filtered: {statistics['filtered_files']} files (wrong format)")
+        for channel_username, download_manager in self.download_managers.items():
+            statistics = download_manager.get_statistics()
+            if len(self.download_managers) > 1:
+                print(f"{channel_username}:")
+            print(f"Completed: {statistics['total_downloads']} files downloaded")
+            print(f"Skipped: {statistics['skipped_files']} existing files")
+            print(f"Filtered: {statistics['filtered_files']} files (wrong format)")
+            print(f"Failed: {statistics['failed_downloads']} files")
+            if self.resources.mirror:
+                print(f"Mirrored: {statistics['mirrored_files']} files")
+            print(
+                f"Deduplicated: {statistics['deduplicated_files']} files, "
+                f"{statistics['bytes_saved'] / 1024 / 1024:.1f} MB not downloaded"
+            )
+        post_processor = self.resources.post_processor
+        if post_processor:
+            print(
+                f"Post-processed: {post_processor.processed} files, "
+                f"{post_processor.failed} failed"
+            )
+        if len(self.resources.accounts) > 1:
+            for name, account in self.resources.accounts.stats().items():
+                print(
+                    f"Account {name}: {account['files']} files, "
+                    f"{account['downloaded_bytes'] / 1024 / 1024:.1f} MB, "
+                    f"{account['bytes_per_second'] / 1024 / 1024:.2f} MB/s"
+                )
+        buffers = self.resources.buffer_pool.stats()
+        print(
+            f"Memory: {peak_rss() / 1024 / 1024:.1f} MB peak RSS, parts held "
+            f"{buffers['peak'] / 1024 / 1024:.1f}/{buffers['capacity'] / 1024 / 1024:.0f} MB "
+            f"at most, {buffers['waits']} requests waited for room"
+        )
+        pool = self.resources.sender_pool.stats()
+        print(
+            f"Connections: {pool['created']} opened, {pool['reused']} reused, "
+            f"{pool['closed']} closed"
+        )
+        downloaded = sum(
+            child.value for child in metrics.downloaded_bytes.children.values()
+        )
+        latency = list(metrics.part_latency.children.values())
+        parts = sum(child.count for child in latency)
+        if parts:
+            print(
+                f"Transferred: {downloaded / 1024 / 1024:.1f} MB in {parts} parts, "
+                f"{sum(child.sum for child in latency) / parts * 1000:.0f} ms per part"
+            )
+        retries = {
+            labels["reason"]: value.value
+            for labels, value in metrics.part_retries.samples()
+        }
+        if any(retries.values()):
+            print(
+                "Retries: "
+                + ", ".join(
+                    f"{int(count)} {reason}" for reason, count in retries.items()
+                )
+            )
+        if profile.enabled:
+            print(profile.report())
+
+    async def serve(self):
+        """Stream channel media over HTTP instead of downloading it"""
+        from src.media_server import BlockCache, MediaServer, MediaStreamer
+
+        await self.initialize()
+        cache = BlockCache(
+            str(settings.STREAM_CACHE_DIR),
+            settings.STREAM_CACHE_SIZE * 1024 * 1024,
+            self.resources.writer_executor,
+        )
+        server = MediaServer(
+            MediaStreamer(
+                self.client,
+                self.resources,
+                cache,
+                settings.STREAM_READ_AHEAD,
+                settings.CDN_DOWNLOADS,
+            ),
+            settings.SERVE_HOST,
+            settings.SERVE_PORT,
+        )
+        await server.start()
+        print(
+            f"Serving media on http://{settings.SERVE_HOST}:{settings.SERVE_PORT}"
+            "/<channel>/<message_id>"
+        )
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+            await self.close()
+
+    async def watch(self):
+        """Download new media as it is posted until SIGTERM or SIGINT"""
+        from src.channel_watcher import ChannelWatcher
+
+        await self.initialize()
+        if not await self.client.is_user_authorized():
+            print("Authorization failed!")
+            await self.close()
+            return
+
+        loop = asyncio.get_running_loop()
+        scheduler = DownloadScheduler(
+            settings.MAX_CONCURRENT_DOWNLOADS * len(self.resources.accounts)
+        )
+        watcher = ChannelWatcher(
+            self.client,
+            self.download_managers,
+            scheduler,
+            settings.WATCH_QUEUE_SIZE,
+            settings.WATCH_DRAIN_TIMEOUT,
+            cache=self.resources.startup_cache,
+        )
+        signals = [signal.SIGTERM, signal.SIGINT]
+        for signal_number in signals:
+            try:
+                loop.add_signal_handler(signal_number, watcher.stop)
+            except NotImplementedError:
+                # Windows, where Ctrl+C still interrupts the run
+                pass
+        with create_progress(settings.HEADLESS, settings.PROGRESS_ROWS) as progress:
+            for download_manager in self.download_managers.values():
+                download_manager.set_progress(progress)
+            scheduler.start()
+            try:
+                await watcher.run()
+            finally:
+                # Downloads left after the drain timeout resume on the next run
+                await scheduler.cancel()
+                for signal_number in signals:
+                    try:
+                        loop.remove_signal_handler(signal_number)
+                    except NotImplementedError:
+                        pass
+            if self.resources.mirror:
+                await self.resources.mirror.join()
+            if self.resources.post_processor:
+                await self.resources.post_processor.join()
+        self.print_statistics()
+        await self.close()
+
+    async def plan(self, path: str):
+        """Write what a run would download to ``path`` without downloading it"""
+        await self.initialize()
+        if not await self.client.is_user_authorized():
+            print("Authorization failed!")
+            await self.close()
+            return
+
+        plan = DownloadPlan(throughput=self.resources.manifest.get_throughput())
+        results = await asyncio.gather(
+            *[
+                self.plan_channel(download_manager, plan)
+                for download_manager in self.download_managers.values()
+            ],
+            return_exceptions=True,
+        )
+        for channel_username, result in zip(self.download_managers, results):
+            if isinstance(result, Exception):
+                self.forget_channel(channel_username)
+                print(f"Failed {channel_username}: {type(result).__name__} - {result}")
+        plan.save(path)
+        print_plan(plan)
+        print(f"Plan written to {path}")
+        await self.close()
+
+    async def execute_plan(self, path: str):
+        """Download exactly the files of a plan written by :meth:`plan`"""
+        plan = DownloadPlan.load(path)
+        await self.initialize()
+        if not await self.client.is_user_authorized():
+            print("Authorization failed!")
+            await self.close()
+            return
+
+        missing = set(plan.channels) - set(self.download_managers)
+        for channel_username in sorted(missing):
+            print(f"Skipping {channel_username}: not one of the configured channels")
+        await self.download_channels(self.execute_channel_plan, plan)
+        self.print_statistics()
+        await self.close()
 
     async def run(self):
         await self.initialize()
-        await self.download_channel_media()
+        await self.download_all_channels()
         self.print_statistics()
         await self.close()
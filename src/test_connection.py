@@ -3,7 +3,7 @@ import asyncio
 from telethon import TelegramClient, errors
 
 from src.config import settings
-from src.download_manager import DownloadManager
+from src.download_manager import get_file_name, is_allowed_format
 
 
 async def test_connection():
@@ -15,8 +15,6 @@ async def test_connection():
             api_id=settings.API_ID,
             api_hash=settings.API_HASH,
         )
-        download_manager = DownloadManager(client)
-
         # Test connection
         print("⌛ Connecting to Telegram...")
         await client.connect()
@@ -32,30 +30,35 @@ async def test_connection():
 
         # Test channel access
         print("⌛ Checking channel access...")
-        channel = await client.get_entity(settings.CHANNEL_USERNAME)
-        print(f"\n✅ Successfully accessed channel: {channel.title} (ID: {channel.id})")
-
-        # Get some basic info
-        async for message in client.iter_messages(channel, limit=1):
-            if message:
-                print(f"📅 Last message date: {message.date}")
-                print(f"📝 Last message ID: {message.id}")
-
-        # Test finding latest audio file
-        print("\n⌛ Checking for latest audio file...")
-        latest_audio = None
-        async for message in client.iter_messages(channel):
-            if message.media:
-                filename = download_manager.get_file_name(message)
-                if download_manager.should_download_file(filename):
-                    latest_audio = message
-                    break
+        for channel_username in settings.CHANNELS:
+            channel = await client.get_entity(channel_username)
+            print(
+                f"\n✅ Successfully accessed channel: {channel.title} (ID: {channel.id})"
+            )
 
-        if latest_audio:
-            filename = download_manager.get_file_name(latest_audio)
-            print(f"🎵 Latest audio file found: {filename}")
-        else:
-            print("ℹ️ No audio files found in the last 50 messages")
+            # Get some basic info
+            async for message in client.iter_messages(channel, limit=1):
+                if message:
+                    print(f"📅 Last message date: {message.date}")
+                    print(f"📝 Last message ID: {message.id}")
+
+            # Test finding latest audio file
+            print("\n⌛ Checking for latest audio file...")
+            latest_audio = None
+            async for message in client.iter_messages(channel, limit=50):
+                if message.media:
+                    filename = get_file_name(message)
+                    if is_allowed_format(
+                        filename, settings.ALLOWED_FORMATS, settings.DOWNLOAD_ALL
+                    ):
+                        latest_audio = message
+                        break
+
+            if latest_audio:
+                filename = get_file_name(latest_audio)
+                print(f"🎵 Latest audio file found: {filename}")
+            else:
+                print("ℹ️ No audio files found in the last 50 messages")
 
         await client.disconnect()
         return True
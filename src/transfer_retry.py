@@ -0,0 +1,103 @@
+import asyncio
+import random
+import time
+from typing import Dict, Optional
+
+from pydantic import BaseModel
+from telethon import errors
+
+# The server asks us to wait before sending more requests of this kind
+FLOOD_ERRORS = (errors.FloodWaitError, errors.FloodPremiumWaitError)
+# Telegram had an internal problem, the same request usually works a moment later
+SERVER_ERRORS = (errors.ServerError, errors.TimedOutError)
+# The connection itself is broken and has to be replaced
+CONNECTION_ERRORS = (
+    ConnectionError,
+    OSError,
+    EOFError,
+    asyncio.TimeoutError,
+    errors.InvalidBufferError,
+)
+
+
+class RetryPolicy(BaseModel):
+    """How often and how patiently a single request is retried"""
+
+    attempts: int = 5
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+    # Longer flood waits fail the request instead of stalling the transfer
+    max_flood_wait: int = 300
+
+    def delay(self, attempt: int) -> float:
+        """Exponential backoff with jitter, so failed senders don't retry in lockstep"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+class _Bucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+
+class RateLimiter:
+    """Token bucket per DC, shared by every transfer.
+
+    Every request takes a token and tokens refill at ``rate`` per second up to
+    ``burst``. A flood wait pauses all requests to that DC for as long as the
+    server asked and halves its rate, which then recovers slowly while requests
+    succeed. A ``rate`` of 0 only applies the flood wait pauses.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.buckets: Dict[int, _Bucket] = {}
+        self.flood_waits = 0
+
+    def _get_bucket(self, dc_id: int) -> _Bucket:
+        if dc_id not in self.buckets:
+            self.buckets[dc_id] = _Bucket(self.rate, self.burst)
+        return self.buckets[dc_id]
+
+    async def acquire(self, dc_id: int):
+        bucket = self._get_bucket(dc_id)
+        async with bucket.lock:
+            while True:
+                now = time.monotonic()
+                if now < bucket.paused_until:
+                    await asyncio.sleep(bucket.paused_until - now)
+                    continue
+                if bucket.rate <= 0:
+                    return
+                bucket.tokens = min(
+                    self.burst, bucket.tokens + (now - bucket.updated) * bucket.rate
+                )
+                bucket.updated = now
+                if bucket.tokens >= 1:
+                    bucket.tokens -= 1
+                    return
+                await asyncio.sleep((1 - bucket.tokens) / bucket.rate)
+
+    def flood_wait(self, dc_id: int, seconds: float):
+        bucket = self._get_bucket(dc_id)
+        self.flood_waits += 1
+        bucket.paused_until = max(bucket.paused_until, time.monotonic() + seconds)
+        if bucket.rate > 0:
+            bucket.rate = max(1.0, bucket.rate / 2)
+            bucket.tokens = 0
+
+    def success(self, dc_id: int):
+        bucket = self._get_bucket(dc_id)
+        if 0 < bucket.rate < self.rate:
+            bucket.rate = min(self.rate, bucket.rate + self.rate / 100)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "flood_waits": self.flood_waits,
+            "rates": {dc_id: bucket.rate for dc_id, bucket in self.buckets.items()},
+        }
@@ -0,0 +1,205 @@
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+# GetFileRequest limits must divide 1 MB, smaller parts only add round trips
+PART_SIZES_KB = [128, 256, 512, 1024]
+
+
+class DCProfile(BaseModel):
+    """What was learned about downloading from one DC"""
+
+    connections: Optional[int] = None
+    part_size_kb: Optional[int] = None
+    # Best sustained bytes per second seen for each part size
+    throughput: Dict[str, float] = {}
+    transfers: int = 0
+
+
+class TransferSession:
+    """Measures one transfer and hill-climbs its connection count.
+
+    Every ``interval`` seconds :meth:`decide` compares the throughput of the
+    last interval with the one before and keeps adding (or removing)
+    connections while that helps, reversing direction when it hurts.
+    """
+
+    def __init__(
+        self,
+        dc_id: int,
+        part_size: int,
+        part_count: int,
+        connections: int,
+        max_connections: int,
+        interval: float = 2.0,
+    ):
+        self.dc_id = dc_id
+        self.part_size = part_size
+        self.part_count = part_count
+        self.connections = connections
+        self.max_connections = max_connections
+        self.interval = interval
+        self.direction = 1
+        self.started = time.monotonic()
+        self.window_started = self.started
+        self.window_bytes = 0
+        self.window_latency = 0.0
+        self.window_parts = 0
+        self.total_bytes = 0
+        self.last_throughput: Optional[float] = None
+        self.last_latency = 0.0
+        self.best_throughput = 0.0
+        self.best_connections = connections
+
+    def record(self, size: int, latency: float):
+        self.window_bytes += size
+        self.window_latency += latency
+        self.window_parts += 1
+        self.total_bytes += size
+
+    @property
+    def throughput(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.total_bytes / elapsed if elapsed > 0 else 0.0
+
+    def decide(self, connections: int) -> int:
+        """Return +1 to add a connection, -1 to remove one or 0 to keep them"""
+        now = time.monotonic()
+        elapsed = now - self.window_started
+        if not self.window_parts or elapsed <= 0:
+            return 0
+        throughput = self.window_bytes / elapsed
+        latency = self.window_latency / self.window_parts
+        self.window_started = now
+        self.window_bytes = self.window_latency = self.window_parts = 0
+
+        if throughput > self.best_throughput:
+            self.best_throughput = throughput
+            self.best_connections = connections
+        last_throughput, last_latency = self.last_throughput, self.last_latency
+        self.last_throughput, self.last_latency = throughput, latency
+        if last_throughput is not None:
+            if throughput < last_throughput * 0.95:
+                self.direction = -self.direction
+            elif throughput < last_throughput * 1.05:
+                # The extra connection only made every part wait longer
+                if self.direction > 0 and latency > last_latency * 1.25:
+                    self.direction = -1
+                    return -1 if connections > 1 else 0
+                return 0
+
+        if self.direction > 0 and connections >= self.max_connections:
+            return 0
+        if self.direction < 0 and connections <= 1:
+            return 0
+        return self.direction
+
+
+class TransferTuner:
+    """Picks connection counts and part sizes per DC and learns from transfers.
+
+    The best settings seen for every DC are saved to ``state_path`` so new
+    transfers, also in later runs, start close to them. Every
+    ``explore_every``-th large transfer tries a neighbouring part size.
+    """
+
+    def __init__(
+        self,
+        state_path: Optional[str] = None,
+        max_connections: int = 20,
+        explore_every: int = 5,
+    ):
+        self.state_path = state_path
+        self.max_connections = max_connections
+        self.explore_every = explore_every
+        self.profiles: Dict[int, DCProfile] = {}
+        if state_path and os.path.exists(state_path):
+            try:
+                with open(state_path) as file:
+                    state = json.load(file)
+                self.profiles = {
+                    int(dc_id): DCProfile(**profile) for dc_id, profile in state.items()
+                }
+            except (OSError, ValueError):
+                self.profiles = {}
+
+    def get_profile(self, dc_id: int) -> DCProfile:
+        return self.profiles.setdefault(dc_id, DCProfile())
+
+    def choose_part_size(self, dc_id: int, file_size: int, default_kb: int) -> int:
+        """Get the part size in KB for a new download from ``dc_id``"""
+        profile = self.get_profile(dc_id)
+        part_size_kb = profile.part_size_kb or default_kb
+        # Only files with enough parts say anything about the part size
+        if file_size < 16 * part_size_kb * 1024:
+            return default_kb
+        if profile.transfers % self.explore_every == self.explore_every - 1:
+            candidates = self._neighbour_part_sizes(part_size_kb)
+            untried = [
+                size for size in candidates if str(size) not in profile.throughput
+            ]
+            part_size_kb = (untried or candidates)[0]
+        return part_size_kb
+
+    def start(
+        self, dc_id: int, part_size: int, part_count: int, default_connections: int
+    ) -> TransferSession:
+        profile = self.get_profile(dc_id)
+        # Never start above the caller's share, the session grows past it later
+        connections = min(
+            profile.connections or default_connections, default_connections, part_count
+        )
+        return TransferSession(
+            dc_id,
+            part_size,
+            part_count,
+            max(1, connections),
+            min(self.max_connections, part_count),
+        )
+
+    def finish(self, session: TransferSession):
+        """Learn from a transfer that completed"""
+        profile = self.get_profile(session.dc_id)
+        if session.part_count < 16:
+            # Mostly connection setup and latency, nothing to learn from
+            return
+        profile.transfers += 1
+        if session.best_throughput:
+            profile.connections = session.best_connections
+        key = str(session.part_size // 1024)
+        throughput = session.throughput
+        # Moving average, so one slow transfer doesn't discard what was learned
+        previous = profile.throughput.get(key)
+        profile.throughput[key] = (
+            throughput if previous is None else previous * 0.7 + throughput * 0.3
+        )
+        profile.part_size_kb = int(max(profile.throughput, key=profile.throughput.get))
+
+    def save(self):
+        if not self.state_path:
+            return
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(
+                {
+                    dc_id: profile.model_dump()
+                    for dc_id, profile in self.profiles.items()
+                },
+                file,
+                indent=2,
+            )
+        os.replace(temp_path, self.state_path)
+
+    @staticmethod
+    def _neighbour_part_sizes(part_size_kb: int) -> List[int]:
+        if part_size_kb not in PART_SIZES_KB:
+            return [PART_SIZES_KB[-1]]
+        index = PART_SIZES_KB.index(part_size_kb)
+        return [
+            PART_SIZES_KB[i]
+            for i in (index + 1, index - 1)
+            if 0 <= i < len(PART_SIZES_KB)
+        ]